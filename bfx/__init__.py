@@ -30,3 +30,29 @@ __all__ = [
     "trimmomatic",
     "vcftools"
 ]
+
+# Python Standard Modules
+import importlib
+import pkgutil
+
+# Wrapper modules are only loaded when one of their attributes is first used, e.g. when a step creates its jobs,
+# so that pipelines importing dozens of them with 'from bfx import <module>' start quickly
+class LazyModule(object):
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        return "<lazy module '" + self._name + "'>"
+
+# 'from bfx import <module>' finds the lazy module attribute without importing the wrapper module,
+# which replaces it in this package once actually imported
+for module_loader, module_name, is_package in pkgutil.iter_modules(__path__):
+    globals()[module_name] = LazyModule(__name__ + "." + module_name)
+del module_loader, module_name, is_package
@@ -19,16 +19,50 @@
 # along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
 ################################################################################
 
+import collections
 import os
 import json
+from multiprocessing import Pool
 
 # MUGQIC Modules
 from core.config import *
 from core.job import *
+from core.sample_json import FileLock, materialize, write_sample_json, applied_running_jobs, running_jobs_of_steps, write_running_jobs, sample_json_exists, is_store, store_index_filepath, read_json, read_store_step, write_store, remove_store
+
+# (pipeline, samples, general information, software versions, steps by sample) while sample json files are written
+_shared_info = None
 
 # Start creating the json dump for the passed sample
 def create(pipeline, sample):
-    # Prepare the general information hash
+    return create_all(pipeline, [sample])[0]
+
+# Create the json dumps of the passed samples and return their file paths
+# Information shared by all samples and the records of their jobs are prepared once, then sample json files are
+# written by "[DEFAULT] json_workers" processes (default: 1)
+def create_all(pipeline, samples):
+    global _shared_info
+
+    if not os.path.exists(os.path.join(pipeline.output_dir, "json")):
+        os.makedirs(os.path.join(pipeline.output_dir, "json"))
+
+    _shared_info = (pipeline, samples, general_information(pipeline), software_versions(), sample_steps(pipeline, samples))
+    workers = min(config.param('DEFAULT', 'json_workers', type='posint', required=False) or 1, len(samples))
+    if workers > 1:
+        # Worker processes are forked after shared information is prepared, hence inherit it
+        pool = Pool(workers)
+        try:
+            # Samples are passed by index to avoid pickling them
+            filepaths = pool.map(create_sample, range(len(samples)), max(1, len(samples) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        filepaths = [create_sample(index) for index in range(len(samples))]
+    _shared_info = None
+    return filepaths
+
+# Prepare the general information hash
+def general_information(pipeline):
     general_info = {}
     if pipeline.__class__.__name__ == "AmpliconSeq":
         general_info = {
@@ -68,8 +102,14 @@ def create(pipeline, sample):
     general_info['server'] = config.param("DEFAULT", 'cluster_server', required=True)
     general_info['analysis_folder'] = pipeline.output_dir + "/"
 
-    # Prepare the software hash by first retrieving all unique module version values in config files
-    # assuming that all module key names start with "module_"
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "VERSION"), 'r') as version_file:
+        general_info['pipeline_version'] = re.sub("\n?$", "", version_file.readlines()[0])
+
+    return general_info
+
+# Prepare the software hash by first retrieving all unique module version values in config files
+# assuming that all module key names start with "module_"
+def software_versions():
     modules = []
     for section in config.sections():
         for name, value in config.items(section):
@@ -77,165 +117,174 @@ def create(pipeline, sample):
                 modules.append(value)
 
     # Then from the modules, build the list of softwares with names and versions
-    softwares = []
-    for module in modules:
-        softwares.append({
-            'name' : module.split("/")[-2],
-            'version' : module.split("/")[-1]
-        })
-
-    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "VERSION"), 'r') as version_file:
-        general_info['pipeline_version'] = re.sub("\n?$", "", version_file.readlines()[0])
+    return [{
+        'name' : module.split("/")[-2],
+        'version' : module.split("/")[-1]
+    } for module in modules]
 
-    # Check if 'force_jobs' is 'True'
-    # Or    if the json file has not been created yet :
-    if pipeline.force_jobs or not os.path.exists(os.path.join(pipeline.output_dir, "json", sample.json_file)) or os.stat(os.path.join(pipeline.output_dir, "json", sample.json_file)).st_size == 0:
-        # Then (re-)create it !!
-        if pipeline.__class__.__name__ == "PacBioAssembly":
-            json_hash = {
-                'version': '1.0.0',
-                'sample_name' : sample.name,
-                'readset' : [{
-                    "name" : readset.name,
-                    "run" : readset.run,
-                    "smartcell" : readset.smartcell,
-                    "protocol" : readset.protocol,
-                    "nb_base_pairs" : readset.nb_base_pairs,
-                    "estimated_genome_size" : readset.estimated_genome_size,
-                    "bas" : [os.path.realpath(bas) for bas in readset.bas_files],
-                    "bax" : [os.path.realpath(bax) for bax in readset.bax_files]
-                } for readset in sample.readsets],
-                'pipeline' : {
-                    'name' : pipeline.__class__.__name__,
-                    'general_information': general_info,
-                    'software' : [{
-                        'name' : software['name'],
-                        'version' : software['version']
-                    } for software in softwares],
-                    'step': []
+# Return the (step name, job records) of each sample, for steps with jobs of the sample only, in a single pass over jobs
+def sample_steps(pipeline, samples):
+    steps_by_sample = dict([(sample, []) for sample in samples])
+    for step in pipeline.step_range:
+        jobs_by_sample = collections.OrderedDict()
+        for job in step.jobs:
+            job_samples = [sample for sample in collections.OrderedDict.fromkeys(job.samples) if sample in steps_by_sample]
+            if job_samples:
+                # Job records are shared by all samples of the job
+                job_record = {
+                    "name": job.name,
+                    "id": job.id,
+                    "command": re.sub("\\\\\n", "", job.command_with_modules),
+                    "input_file": job.input_files,
+                    "output_file": job.output_files,
+                    "dependency": [dependency_job.id for dependency_job in job.dependency_jobs]
                 }
-            }
-        else :
-            json_hash = {
-                'version': '1.0.0',
-                'sample_name' : sample.name,
-                'readset' : [{
-                    "name" : readset.name,
-                    "library" : readset.library,
-                    "runType" : readset.run_type,
-                    "run" : readset.run,
-                    "lane" : readset.lane,
-                    "adapter1" : readset.adapter1,
-                    "adapter2" : readset.adapter2,
-                    "qualityoffset" : readset.quality_offset,
-                    "bed" : [bed for bed in readset.beds],
-                    "fastq1" : os.path.realpath(readset.fastq1) if readset.fastq1 else "",
-                    "fastq2" : os.path.realpath(readset.fastq2) if readset.fastq2 else "",
-                    "bam" : os.path.realpath(readset.bam) if readset.bam else ""
-                } for readset in sample.readsets],
-                'pipeline' : {
-                    'name' : pipeline.__class__.__name__,
-                    'general_information': general_info,
-                    'software' : [{
-                        'name' : software['name'],
-                        'version' : software['version']
-                    } for software in softwares],
-                    'step': []
+                for sample in job_samples:
+                    jobs_by_sample.setdefault(sample, []).append(job_record)
+        for sample, job_records in jobs_by_sample.items():
+            steps_by_sample[sample].append((step.name, job_records))
+    return steps_by_sample
+
+# Write the json dump of a sample, given by index, from shared information and return its file path
+def create_sample(index):
+    pipeline, samples, general_info, softwares, steps_by_sample = _shared_info
+    sample = samples[index]
+    filepath = os.path.join(pipeline.output_dir, "json", sample.json_file)
+
+    # Jobs of previous pipeline executions may still be updating the json file
+    with FileLock(filepath):
+        # Apply their pending job events first
+        if sample_json_exists(filepath):
+            materialize(filepath)
+
+        # Steps of the json object by name, in their order, given as None if only found in the step store
+        steps = collections.OrderedDict()
+        existing_store = False
+
+        # Check if 'force_jobs' is 'True'
+        # Or    if the json file has not been created yet :
+        if pipeline.force_jobs or not sample_json_exists(filepath):
+            # Then (re-)create it !!
+            if pipeline.__class__.__name__ == "PacBioAssembly":
+                json_hash = {
+                    'version': '1.0.0',
+                    'sample_name' : sample.name,
+                    'readset' : [{
+                        "name" : readset.name,
+                        "run" : readset.run,
+                        "smartcell" : readset.smartcell,
+                        "protocol" : readset.protocol,
+                        "nb_base_pairs" : readset.nb_base_pairs,
+                        "estimated_genome_size" : readset.estimated_genome_size,
+                        "bas" : [os.path.realpath(bas) for bas in readset.bas_files],
+                        "bax" : [os.path.realpath(bax) for bax in readset.bax_files]
+                    } for readset in sample.readsets],
+                    'pipeline' : {
+                        'name' : pipeline.__class__.__name__,
+                        'general_information': general_info,
+                        'software' : [{
+                            'name' : software['name'],
+                            'version' : software['version']
+                        } for software in softwares],
+                        'step': []
+                    }
                 }
-            }
-        for step in pipeline.step_range:
-            # First verify if the step is meant to be "jsonified"
-            jsonify_step = False
-            for job in step.jobs:
-                if sample in job.samples:
-                    jsonify_step = True
-            if jsonify_step:
-                json_hash['pipeline']['step'].append(
-                    {
-                        'name': step.name,
-                        'job': [{
-                            "name": job.name,
-                            "id": job.id,
-                            "command": re.sub("\\\\\n", "", job.command_with_modules),
-                            "input_file": job.input_files,
-                            "output_file": job.output_files,
-                            "dependency": [dependency_job.id for dependency_job in job.dependency_jobs]
-                        } for job in step.jobs if sample in job.samples]
+            else :
+                json_hash = {
+                    'version': '1.0.0',
+                    'sample_name' : sample.name,
+                    'readset' : [{
+                        "name" : readset.name,
+                        "library" : readset.library,
+                        "runType" : readset.run_type,
+                        "run" : readset.run,
+                        "lane" : readset.lane,
+                        "adapter1" : readset.adapter1,
+                        "adapter2" : readset.adapter2,
+                        "qualityoffset" : readset.quality_offset,
+                        "bed" : [bed for bed in readset.beds],
+                        "fastq1" : os.path.realpath(readset.fastq1) if readset.fastq1 else "",
+                        "fastq2" : os.path.realpath(readset.fastq2) if readset.fastq2 else "",
+                        "bam" : os.path.realpath(readset.bam) if readset.bam else ""
+                    } for readset in sample.readsets],
+                    'pipeline' : {
+                        'name' : pipeline.__class__.__name__,
+                        'general_information': general_info,
+                        'software' : [{
+                            'name' : software['name'],
+                            'version' : software['version']
+                        } for software in softwares],
+                        'step': []
                     }
-                )
-        current_json = json.dumps(json_hash, indent=4)
+                }
+            current_json_hash = json_hash
 
-    # If the json file has already been created (during a previous pipeline execution for instance) :
-    else :
-        with open(os.path.join(pipeline.output_dir, "json", sample.json_file), 'r') as json_file:
-            current_json_hash = json.load(json_file)
+        # If the json file has already been created (during a previous pipeline execution for instance) :
+        else :
+            if is_store(filepath):
+                existing_store = True
+                current_json_hash = read_json(store_index_filepath(filepath))
+                for step_name in current_json_hash['pipeline']['step']:
+                    steps[step_name] = None
+            else:
+                current_json_hash = read_json(filepath)
+                for jstep in current_json_hash['pipeline']['step']:
+                    steps[jstep['name']] = jstep
 
-        # Then check if information is up-to-date by comparing it with the previously retrieved informations
-        for info_key in general_info.keys():
-            if not current_json_hash['pipeline']['general_information'].has_key(info_key) or current_json_hash['pipeline']['general_information'][info_key] != general_info[info_key] :
-                current_json_hash['pipeline']['general_information'][info_key] = general_info[info_key]
+            # Then check if information is up-to-date by comparing it with the previously retrieved informations
+            current_json_hash['pipeline']['general_information'].update(general_info)
 
-        # And do the same checking with the list of softwares
-        for soft in softwares:
-            soft_found = False
+            # And do the same checking with the list of softwares
+            jsofts_by_name = collections.defaultdict(list)
             for jsoft in current_json_hash['pipeline']['software']:
-                if soft['name'] == jsoft['name']:
-                    soft_found = True
-                    if soft['version'] != jsoft['version']:
+                jsofts_by_name[jsoft['name']].append(jsoft)
+            for soft in softwares:
+                if soft['name'] in jsofts_by_name:
+                    for jsoft in jsofts_by_name[soft['name']]:
                         jsoft['version'] = soft['version']
-            if not soft_found:
-                current_json_hash['pipeline']['software'].append({
-                    'name' : soft['name'],
-                    'version' : soft['version']
-                })
-
-        # Finally check if the requested steps/jobs are already in the JSON :
-        #   if so  : update them with the current information
-        #   if not : add them to the json object
-        for step in pipeline.step_range:
-            # First make sure the step is meant to be "jsonified"
-            jsonify_step = False
-            if step.jobs:
-                for job in step.jobs:
-                    if sample in job.samples:
-                        jsonify_step = True
-
-            if jsonify_step:
-                # Then check if the step is found in the current json
-                step_found = False
-                for jstep in current_json_hash['pipeline']['step']:
-                    if step.name == jstep['name']:
-                        step_found = True
-
-                # If step is found, then remove it from the json object (so that it can be replaced by the new one if needed)
-                if step_found:
-                    for i in range(len(current_json_hash['pipeline']['step'])):
-                        if current_json_hash['pipeline']['step'][i]['name'] == step.name:
-                            del current_json_hash['pipeline']['step'][i]
-                            break
-
-                # Now it is time to add the current step record (with its jobs) to the json object
-                current_json_hash['pipeline']['step'].append(
-                    {
-                        'name': step.name,
-                        'job': [{
-                            "name": job.name,
-                            "id": job.id,
-                            "command": re.sub("\\\\\n", "", job.command_with_modules),
-                            "input_file": job.input_files,
-                            "output_file": job.output_files,
-                            "dependency": [dependency_job.id for dependency_job in job.dependency_jobs]
-                        } for job in step.jobs if sample in job.samples]
+                else:
+                    jsoft = {
+                        'name' : soft['name'],
+                        'version' : soft['version']
                     }
-                )
-        current_json = json.dumps(current_json_hash, indent=4)
+                    current_json_hash['pipeline']['software'].append(jsoft)
+                    jsofts_by_name[soft['name']].append(jsoft)
 
-    if not os.path.exists(os.path.join(pipeline.output_dir, "json")):
-        os.makedirs(os.path.join(pipeline.output_dir, "json"))
+        # Finally add the requested steps to the json object, replacing the ones found in the previous json object,
+        # which are moved at the end of the steps
+        for step_name, job_records in steps_by_sample[sample]:
+            steps.pop(step_name, None)
+            steps[step_name] = {
+                'name': step_name,
+                'job': job_records
+            }
 
-    # Print to file
-    filepath = os.path.join(pipeline.output_dir, "json", sample.json_file)
-    with open(filepath, 'w') as out_json:
-        out_json.write(current_json)
+        # Jobs marked running, for job2json to know when the last running job of the sample ends
+        running_jobs = set()
+        previous_running_jobs = applied_running_jobs(filepath) if existing_store else set()
+        for step_name, step in steps.items():
+            if step is None:
+                running_jobs.update([job for job in previous_running_jobs if job[0] == step_name])
+            else:
+                running_jobs.update(running_jobs_of_steps([step]))
+
+        # Print to file
+        if config.param('DEFAULT', 'json_step_store', type='boolean', required=False):
+            if existing_store:
+                # Only the steps of this pipeline execution are written
+                write_store(filepath, current_json_hash, steps, [step_name for step_name, job_records in steps_by_sample[sample]])
+            else:
+                remove_store(filepath)
+                write_store(filepath, current_json_hash, steps)
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+        else:
+            for step_name in steps:
+                if steps[step_name] is None:
+                    steps[step_name] = read_store_step(filepath, step_name)
+            current_json_hash['pipeline']['step'] = steps.values()
+            write_sample_json(filepath, current_json_hash)
+            remove_store(filepath)
+        write_running_jobs(filepath, running_jobs)
 
     return filepath
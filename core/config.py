@@ -21,12 +21,18 @@
 
 # Python Standard Modules
 import ConfigParser
+import collections
 import glob
+import hashlib
+import json
 import logging
 import os
 import re
 import subprocess
 import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger(__name__)
 
@@ -34,11 +40,34 @@ class Config(ConfigParser.SafeConfigParser):
 
     def __init__(self):
         ConfigParser.SafeConfigParser.__init__(self)
+        # Typed parameter values by (section, option, required, type), see param()
+        self._param_cache = {}
 
     @property
     def filepath(self):
         return self._filepath
 
+    # Any config modification invalidates the parameter cache
+    def _read(self, fp, fpname):
+        self._param_cache = {}
+        ConfigParser.SafeConfigParser._read(self, fp, fpname)
+
+    def set(self, section, option, value=None):
+        self._param_cache = {}
+        ConfigParser.SafeConfigParser.set(self, section, option, value)
+
+    def add_section(self, section):
+        self._param_cache = {}
+        ConfigParser.SafeConfigParser.add_section(self, section)
+
+    def remove_option(self, section, option):
+        self._param_cache = {}
+        return ConfigParser.SafeConfigParser.remove_option(self, section, option)
+
+    def remove_section(self, section):
+        self._param_cache = {}
+        return ConfigParser.SafeConfigParser.remove_section(self, section)
+
     def parse_files(self, config_files):
         # Make option names case sensitive
         self.optionxform = str
@@ -51,33 +80,69 @@ class Config(ConfigParser.SafeConfigParser):
         self.check_modules()
 
     # Check by a system call if all modules defined in config files are available
+    # Module checks are run concurrently and successful checks are cached for a while (see module_check_cache())
     def check_modules(self):
-        modules = []
+        modules = collections.OrderedDict()
         query_module = "show"
         # Retrieve all unique module version values in config files
         # assuming that all module key names start with "module_"
         for section in self.sections():
             for name, value in self.items(section):
-                if re.search("^module_", name) and value not in modules:
-                    modules.append(value)
+                if re.search("^module_", name):
+                    modules[value] = True
                 if re.search("^query_module", name):
                     query_module = value
 
         log.info("Check modules...")
         cmd_query_module = "module {query_module} ".format(query_module  = query_module)
+
+        # Successfully checked modules are cached with the module query command and module path fingerprint
+        cache_ttl = self.param('DEFAULT', 'module_check_cache_ttl', type='int', required=False)
+        cache_ttl = 86400 if cache_ttl == "" else cache_ttl
+        cache_filepath = module_check_cache()
+        cache_prefix = cmd_query_module + module_path_fingerprint() + " "
+        cache = read_module_check_cache(cache_filepath) if cache_ttl > 0 else {}
+        now = time.time()
+        unchecked_modules = [module for module in modules if now - cache.get(cache_prefix + module, 0) >= cache_ttl]
         for module in modules:
-            # Bash shell must be invoked in order to find "module" cmd
-            module_show_output = subprocess.check_output(["bash", "-c", cmd_query_module + module], stderr=subprocess.STDOUT)
-            ## "Error" result for module show while "error" for module spider. seems to be handeled well by re.IGNORECASE
-            if re.search("Error", module_show_output, re.IGNORECASE):
-                raise Exception("Error in config file(s) with " + module + ":\n" + module_show_output)
-            else:
-                log.info("Module " + module + " OK")
+            if module not in unchecked_modules:
+                log.info("Module " + module + " OK (cached)")
+
+        if unchecked_modules:
+            threads = self.param('DEFAULT', 'module_check_threads', type='posint', required=False) or 8
+            pool = ThreadPool(min(threads, len(unchecked_modules)))
+            try:
+                # Bash shell must be invoked in order to find "module" cmd
+                module_show_outputs = pool.map(lambda module: subprocess.check_output(["bash", "-c", cmd_query_module + module], stderr=subprocess.STDOUT), unchecked_modules)
+            finally:
+                pool.close()
+                pool.join()
+
+            for module, module_show_output in zip(unchecked_modules, module_show_outputs):
+                ## "Error" result for module show while "error" for module spider. seems to be handeled well by re.IGNORECASE
+                if re.search("Error", module_show_output, re.IGNORECASE):
+                    raise Exception("Error in config file(s) with " + module + ":\n" + module_show_output)
+                else:
+                    log.info("Module " + module + " OK")
+                    cache[cache_prefix + module] = now
+
+            if cache_ttl > 0:
+                # Remove expired entries before saving
+                write_module_check_cache(cache_filepath, dict([(key, timestamp) for key, timestamp in cache.items() if now - timestamp < cache_ttl]))
         log.info("Module check finished\n")
 
     # Retrieve param in config files with optional definition check and type validation
     # By default, parameter is required to be defined in one of the config file
+    # Values are memoized until config is modified since param() is called many times for each job
     def param(self, section, option, required=True, type='string'):
+        key = (section, option, required, type)
+        if key not in self._param_cache:
+            self._param_cache[key] = self.typed_param(section, option, required, type)
+        value = self._param_cache[key]
+        # Return a copy of list values which may be modified by the caller
+        return list(value) if isinstance(value, list) else value
+
+    def typed_param(self, section, option, required, type):
         # Store original section for future error message, in case 'DEFAULT' section is used eventually
         original_section = section
 
@@ -130,5 +195,42 @@ class Config(ConfigParser.SafeConfigParser):
         else:
             return ""
 
+# Module check cache file path, in the user cache directory
+def module_check_cache():
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "mugqic_pipelines", "module_check.json")
+
+# Fingerprint of the module search path: MODULEPATH value and modification times of its directories,
+# so that module checks are done again if module directories are added, removed or modified
+def module_path_fingerprint():
+    module_path = os.environ.get('MODULEPATH', "")
+    mtimes = []
+    for module_dir in module_path.split(":"):
+        try:
+            mtimes.append(str(os.stat(module_dir).st_mtime))
+        except OSError:
+            mtimes.append("")
+    return hashlib.md5(module_path + ":" + ":".join(mtimes)).hexdigest()
+
+def read_module_check_cache(cache_filepath):
+    try:
+        with open(cache_filepath, 'r') as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+
+def write_module_check_cache(cache_filepath, cache):
+    # The cache is only an optimization: never fail because of it
+    try:
+        if not os.path.isdir(os.path.dirname(cache_filepath)):
+            os.makedirs(os.path.dirname(cache_filepath))
+        # Write to a temporary file renamed afterwards since several pipelines or jobs may write the cache concurrently
+        tmp_fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(cache_filepath))
+        with os.fdopen(tmp_fd, 'w') as tmp_file:
+            json.dump(cache, tmp_file)
+        os.rename(tmp_filepath, cache_filepath)
+    except (IOError, OSError) as e:
+        log.warning("Module check cache " + cache_filepath + " could not be written: " + str(e))
+
 # Global config object used throughout the whole pipeline
 config = Config()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Content fingerprints of job input and output files, used to decide if a job is up to date
+# when file modification times are not reliable (e.g. after a project copy or restore).
+# This module is also used at job runtime by utils/job_fingerprint.py, hence it must not import the pipeline config.
+
+# Python Standard Modules
+import errno
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+# MUGQIC Modules
+from stat_cache import stat_cache
+
+log = logging.getLogger(__name__)
+
+# Fingerprint methods:
+# - "sampled": file size and MD5 of a fixed number of blocks evenly spaced in the file, cheap even for large BAMs
+# - "full": MD5 of the whole file content
+methods = ["sampled", "full"]
+
+sample_block_count = 16
+sample_block_size = 64 * 1024
+read_block_size = 1024 * 1024
+
+# Return the fingerprint of a file or directory content, following symbolic links
+def fingerprint(path, method):
+    if method not in methods:
+        raise Exception("Error: fingerprint method \"" + method + "\" is invalid (should be one of " + ", ".join(methods) + ")!")
+
+    md5 = hashlib.md5()
+    if os.path.isdir(path):
+        # Directory content is only represented by its file names
+        md5.update("\n".join(sorted(os.listdir(path))))
+        return "directory:" + md5.hexdigest()
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        if method == "sampled" and size > sample_block_count * sample_block_size:
+            # Blocks start at evenly spaced offsets, the last one ending at the end of file
+            for i in range(sample_block_count):
+                file.seek((size - sample_block_size) * i // (sample_block_count - 1))
+                md5.update(file.read(sample_block_size))
+        else:
+            for block in iter(lambda: file.read(read_block_size), ""):
+                md5.update(block)
+    return method + ":" + str(size) + ":" + md5.hexdigest()
+
+# Write the fingerprints of the given files into a job .done file
+def write_done_file(done_file, files, method):
+    done_content = {
+        'method': method,
+        'files': dict([(file, fingerprint(file, method)) for file in files])
+    }
+    # Write to a temporary file first so that a partially written .done file is never seen
+    tmp_done_file = done_file + ".tmp"
+    with open(tmp_done_file, 'w') as out_done:
+        json.dump(done_content, out_done)
+    os.rename(tmp_done_file, done_file)
+
+# Return the fingerprints recorded in a job .done file with the given method, or None if there is none
+# e.g. if the .done file was created with 'touch' when staleness was checked with modification times
+def read_done_file(done_file, method):
+    try:
+        with open(done_file, 'r') as done:
+            done_content = json.load(done)
+    except (IOError, ValueError):
+        return None
+    if isinstance(done_content, dict) and done_content.get('method') == method:
+        return done_content.get('files')
+    return None
+
+# Persistent cache of file fingerprints keyed on file path, size and modification time,
+# so that unchanged files are never read again when jobs are re-created
+class FingerprintCache(object):
+
+    def __init__(self, filepath, method):
+        if method not in methods:
+            raise Exception("Error: fingerprint method \"" + method + "\" is invalid (should be one of " + ", ".join(methods) + ")!")
+        self._method = method
+        self._filepath = filepath
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        self._connection = sqlite3.connect(filepath)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS fingerprint (path TEXT, method TEXT, size INTEGER, mtime REAL, fingerprint TEXT, PRIMARY KEY (path, method))")
+        self._new_fingerprints = {}
+        self._computed_count = 0
+
+    @property
+    def method(self):
+        return self._method
+
+    # Number of fingerprints actually computed by reading files
+    @property
+    def computed_count(self):
+        return self._computed_count
+
+    # Files are stat'ed through the pipeline stat cache, where they were already stat'ed to check that they exist
+    def fingerprint(self, path):
+        path_stat = stat_cache.stat(path)
+        if path_stat is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        if path in self._new_fingerprints and self._new_fingerprints[path][:2] == (path_stat.st_size, path_stat.st_mtime):
+            return self._new_fingerprints[path][2]
+
+        row = self._connection.execute("SELECT size, mtime, fingerprint FROM fingerprint WHERE path = ? AND method = ?", (path, self.method)).fetchone()
+        if row and tuple(row[:2]) == (path_stat.st_size, path_stat.st_mtime):
+            return row[2]
+
+        path_fingerprint = fingerprint(path, self.method)
+        self._computed_count += 1
+        self._new_fingerprints[path] = (path_stat.st_size, path_stat.st_mtime, path_fingerprint)
+        return path_fingerprint
+
+    # Save the fingerprints computed since the cache was opened
+    def close(self):
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?, ?, ?)", [(path, self.method, size, mtime, path_fingerprint) for path, (size, mtime, path_fingerprint) in self._new_fingerprints.items()])
+        self._connection.close()
+        log.info("Fingerprint cache " + self._filepath + ": " + str(self.computed_count) + " fingerprint" + ("s" if self.computed_count > 1 else "") + " computed")
@@ -27,79 +27,177 @@ import os
 
 # MUGQIC Modules
 from config import *
+from fingerprint import read_done_file
+from stat_cache import stat_cache
 
 log = logging.getLogger(__name__)
 
-class Job:
+# List of unique items in insertion order, with constant time membership tests
+class OrderedSet(object):
+    __slots__ = ['items', '_item_set']
+
+    def __init__(self, items=[]):
+        self.items = []
+        self._item_set = set()
+        self.update(items)
+
+    def __contains__(self, item):
+        return item in self._item_set
+
+    # Append items not already in this set nor in the excluded ones
+    def update(self, items, excluded=()):
+        for item in items:
+            if item not in self._item_set and item not in excluded:
+                self._item_set.add(item)
+                self.items.append(item)
+
+# Remove undefined files if any, and intern file paths since the same paths are shared by many jobs
+# e.g. the output files of a job are the input files of the next ones
+def intern_files(files):
+    return [intern(file) if type(file) is str else file for file in files if file]
+
+class Job(object):
+
+    # Large cohorts create hundreds of thousands of jobs: slots avoid an attribute dictionary per job
+    __slots__ = ['_input_files', '_output_files', '_report_files', '_removable_files', '_modules', '_name', '_command', '_command_with_modules', '_samples', '_cluster_params', '_id', '_done', '_output_dir', '_dependency_jobs']
 
     def __init__(self, input_files=[], output_files=[], module_entries = [], name="", command="", report_files=[], removable_files=[], samples=[]):
         # Remove undefined input/output/removable files if any
-        self._input_files = filter(None, input_files)
-        self._output_files = filter(None, output_files)
-        self._report_files = filter(None, report_files)
-        self._removable_files = filter(None, removable_files)
+        self._input_files = intern_files(input_files)
+        self._output_files = intern_files(output_files)
+        self._report_files = intern_files(report_files)
+        self._removable_files = intern_files(removable_files)
 
         # Retrieve modules from config, removing duplicates but keeping the order
-        self._modules = list(collections.OrderedDict.fromkeys([config.param(section, option) for section, option in module_entries]))
+        self._modules = tuple(OrderedSet([config.param(section, option) for section, option in module_entries]).items)
 
         self._name = name
         self._command = command
+        self._command_with_modules = None
         self._samples = samples
 
+        # Cluster settings overriding config ones for this job only, e.g. tuned from previous job runs
+        self._cluster_params = {}
+
     @property
     def id(self):
         return self._id
 
+    @id.setter
+    def id(self, value):
+        self._id = value
+
     @property
     def name(self):
         return self._name
 
+    @name.setter
+    def name(self, value):
+        self._name = value
+
     @property
     def output_dir(self):
         return self._output_dir
 
+    @output_dir.setter
+    def output_dir(self, value):
+        self._output_dir = value
+
     @property
     def input_files(self):
         return self._input_files
 
+    @input_files.setter
+    def input_files(self, value):
+        self._input_files = intern_files(value)
+
     @property
     def output_files(self):
         return self._output_files
 
+    @output_files.setter
+    def output_files(self, value):
+        self._output_files = intern_files(value)
+
     @property
     def report_files(self):
         return self._report_files
 
+    @report_files.setter
+    def report_files(self, value):
+        self._report_files = intern_files(value)
+
     @property
     def removable_files(self):
         return self._removable_files
 
+    @removable_files.setter
+    def removable_files(self, value):
+        self._removable_files = intern_files(value)
+
     @property
     def done(self):
         return self._done
 
+    @done.setter
+    def done(self, value):
+        self._done = value
+
     @property
     def dependency_jobs(self):
         return self._dependency_jobs
 
+    @dependency_jobs.setter
+    def dependency_jobs(self, value):
+        self._dependency_jobs = value
+
+    # Modules are stored as a tuple: they can only be replaced, which updates command_with_modules,
+    # and not modified in place, which would make command and command_with_modules inconsistent
     @property
     def modules(self):
         return self._modules
 
+    @modules.setter
+    def modules(self, value):
+        command = self.command
+        self._modules = tuple(value)
+        self.command = command
+
     @property
     def command(self):
+        # Once command_with_modules is computed, the command is only kept at its end
+        if self._command is None:
+            return self._command_with_modules[len(self.module_load()):]
         return self._command
 
+    @command.setter
+    def command(self, value):
+        self._command = value
+        self._command_with_modules = None
+
     @property
     def samples(self):
         return self._samples
 
+    @samples.setter
+    def samples(self, value):
+        self._samples = value
+
+    @property
+    def cluster_params(self):
+        return self._cluster_params
+
+    def module_load(self):
+        return "module load " + " ".join(self.modules) + " && \\\n" if self.modules else ""
+
+    # Computed once since it is used for the job .done file name, by job schedulers and for sample JSON files;
+    # the command is then not stored separately to keep a single copy of large commands in memory
     @property
     def command_with_modules(self):
-        command = self.command
-        if self.modules:
-            command = "module load " + " ".join(self.modules) + " && \\\n" + command
-        return command
+        if self._command_with_modules is None:
+            self._command_with_modules = self.module_load() + self._command
+            self._command = None
+        return self._command_with_modules
 
     def abspath(self, file):
         tmp_file = os.path.expandvars(file)
@@ -108,7 +206,21 @@ class Job:
             tmp_file = os.path.normpath(os.path.join(self.output_dir, tmp_file))
         return tmp_file
 
-    def is_up2date(self):
+    # Return the path of a file relative to the job output directory if it is inside it, absolute otherwise,
+    # so that content fingerprints recorded in .done files remain valid if the output directory is moved
+    def fingerprint_path(self, file):
+        abspath_file = self.abspath(file)
+        if abspath_file.startswith(os.path.join(self.output_dir, "")):
+            return os.path.relpath(abspath_file, self.output_dir)
+        return abspath_file
+
+    # Return the absolute paths of .done, input and output files checked by is_up2date()
+    def up2date_files(self):
+        return [self.abspath(file) for file in [self.done] + self.input_files + self.output_files]
+
+    # If a fingerprint cache is given, a job is up to date if its input and output file contents are identical
+    # to the ones recorded in its .done file when it completed, whatever their modification times
+    def is_up2date(self, fingerprint_cache=None):
         # If job has dependencies, job is not up to date
         if self.dependency_jobs:
             log.debug("Job " + self.name + " NOT up to date")
@@ -123,19 +235,33 @@ class Job:
         # If any .done, input or output file is missing, job is not up to date
         for file in [abspath_done] + abspath_input_files + abspath_output_files:
             # Use 'exists' instead of 'isfile' since input/output files can be directories
-            if not os.path.exists(file):
+            if not stat_cache.exists(file):
                 log.debug("Job " + self.name + " NOT up to date")
                 log.debug("Input, output or .done file missing: " + file)
                 return False
 
+        if fingerprint_cache:
+            done_fingerprints = read_done_file(abspath_done, fingerprint_cache.method)
+            files = self.input_files + self.output_files
+            if done_fingerprints is not None and all([self.fingerprint_path(file) in done_fingerprints for file in files]):
+                for file in files:
+                    if fingerprint_cache.fingerprint(self.abspath(file)) != done_fingerprints[self.fingerprint_path(file)]:
+                        log.debug("Job " + self.name + " NOT up to date")
+                        log.debug("File content differs from the one recorded in .done file: " + self.abspath(file) + "\n")
+                        return False
+                return True
+            else:
+                # e.g. the .done file was created when staleness was checked with modification times
+                log.debug("Job " + self.name + ": no content fingerprints in .done file, checking modification times")
+
         # Retrieve latest input file by modification time i.e. maximum stat mtime
         # Use lstat to avoid following symbolic links
-        latest_input_file = max(abspath_input_files, key=lambda input_file: os.lstat(input_file).st_mtime)
-        latest_input_time = os.lstat(latest_input_file).st_mtime
+        latest_input_file = max(abspath_input_files, key=lambda input_file: stat_cache.lstat(input_file).st_mtime)
+        latest_input_time = stat_cache.lstat(latest_input_file).st_mtime
 
         # Same with earliest output file by modification time
-        earliest_output_file = min(abspath_output_files, key=lambda output_file:os.lstat(output_file).st_mtime)
-        earliest_output_time = os.lstat(earliest_output_file).st_mtime
+        earliest_output_file = min(abspath_output_files, key=lambda output_file: stat_cache.lstat(output_file).st_mtime)
+        earliest_output_time = stat_cache.lstat(earliest_output_file).st_mtime
 
         # If any input file is strictly more recent than all output files, job is not up to date
         if latest_input_time > earliest_output_time:
@@ -149,23 +275,24 @@ class Job:
 # Create a new job by concatenating a list of jobs together
 def concat_jobs(jobs, name="", samples=[]):
 
-    # Merge all input/output/report/removable files and modules
-    input_files = []
-    output_files = []
-    report_files = []
-    removable_files = []
-    modules = []
-    sample_list = samples
+    # Merge all input/output/report/removable files, modules and samples, removing duplicates but keeping the order;
+    # input files created by previous jobs are not input files of the concatenated job
+    input_files = OrderedSet()
+    output_files = OrderedSet()
+    report_files = OrderedSet()
+    removable_files = OrderedSet()
+    modules = OrderedSet()
+    sample_list = OrderedSet(samples)
     for job_item in jobs:
-        input_files.extend([input_file for input_file in job_item.input_files if input_file not in input_files and input_file not in output_files])
-        output_files.extend([output_file for output_file in job_item.output_files if output_file not in output_files])
-        report_files.extend([report_file for report_file in job_item.report_files if report_file not in report_files])
-        removable_files.extend([removable_file for removable_file in job_item.removable_files if removable_file not in removable_files])
-        modules.extend([module for module in job_item.modules if module not in modules])
-        sample_list.extend([sample for sample in job_item.samples if sample not in sample_list])
+        input_files.update(job_item.input_files, excluded=output_files)
+        output_files.update(job_item.output_files)
+        report_files.update(job_item.report_files)
+        removable_files.update(job_item.removable_files)
+        modules.update(job_item.modules)
+        sample_list.update(job_item.samples)
 
-    job = Job(input_files, output_files, name=name, report_files=report_files, removable_files=removable_files, samples=sample_list)
-    job.modules = modules
+    job = Job(input_files.items, output_files.items, name=name, report_files=report_files.items, removable_files=removable_files.items, samples=sample_list.items)
+    job.modules = modules.items
 
     # Merge commands
     job.command = " && \\\n".join([job_item.command for job_item in jobs if job_item.command])
@@ -177,26 +304,21 @@ def pipe_jobs(jobs, name="", samples=[]):
 
     job = Job(jobs[0].input_files, jobs[-1].output_files, name=name)
 
-    # Merge all report/removable files and modules
-    report_files = []
-    removable_files = []
-    modules = []
-    sample_list = samples
+    # Merge all report/removable files, modules and samples, removing duplicates but keeping the order
+    report_files = OrderedSet()
+    removable_files = OrderedSet()
+    modules = OrderedSet()
+    sample_list = OrderedSet(samples)
     for job_item in jobs:
-        report_files.extend(job_item.report_files)
-        removable_files.extend(job_item.removable_files)
-        modules.extend(job_item.modules)
-        sample_list.extend([sample for sample in job_item.samples if sample not in sample_list])
-
-    # Remove duplicates if any, keeping the order
-    report_files = list(collections.OrderedDict.fromkeys([report_file for report_file in report_files]))
-    job.report_files = report_files
-    removable_files = list(collections.OrderedDict.fromkeys([removable_file for removable_file in removable_files]))
-    job.removable_files = removable_files
-    modules = list(collections.OrderedDict.fromkeys([module for module in modules]))
-    job.modules = modules
-    sample_list = list(collections.OrderedDict.fromkeys([sample for sample in sample_list]))
-    job.samples = sample_list
+        report_files.update(job_item.report_files)
+        removable_files.update(job_item.removable_files)
+        modules.update(job_item.modules)
+        sample_list.update(job_item.samples)
+
+    job.report_files = report_files.items
+    job.removable_files = removable_files.items
+    job.modules = modules.items
+    job.samples = sample_list.items
 
     # Merge commands
     job.command = " | \\\n".join([job_item.command for job_item in jobs])
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Job accounting database of resources used by previous job runs, collected from job logs listed in job list files,
+# and tuning of job cluster settings from these resources.
+# This module is also used by utils/job_accounting.py, hence it must not import the pipeline config.
+
+# Python Standard Modules
+import datetime
+import glob
+import logging
+import math
+import os
+import re
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+# Patterns of CPU, memory and walltime values in PBS and Slurm cluster settings,
+# e.g. "-l nodes=1:ppn=4", "-N 1 -n 8", "--mem=16G", "-l walltime=24:00:00" or "--time=24:00:00"
+cpu_patterns = [r"(ppn=)(\d+)", r"(--cpus-per-task[= ])(\d+)", r"((?:^|\s)-c\s*)(\d+)", r"(--ntasks[= ])(\d+)", r"((?:^|\s)-n\s*)(\d+)"]
+memory_patterns = [r"(--mem[= ])(\d+[kKmMgGtT]?)", r"((?<![a-z])mem=)(\d+[kKmMgGtT]?[bB]?)"]
+walltime_patterns = [r"(--time[= ])([\d:-]+)", r"(walltime=)([\d:]+)", r"((?:^|\s)-t\s*)([\d:-]+)"]
+
+# Tuned resources are never lower than these values, to absorb run-to-run variations of small jobs
+min_walltime = 15 * 60
+min_memory = 1024
+
+# Options of job config sections and arguments of job commands giving the memory or number of threads
+# used by job commands, e.g. "ram=55G", "jellyfish_memory=24G", "threads=8", "-Xmx55G", "--java-mem-size=55G",
+# "-nt 11" or "-t 10"
+memory_option_pattern = r"(?:^|_)(?:ram|memory)$"
+thread_option_pattern = r"(?:^|_)(?:threads?|cpus?)$"
+memory_argument_pattern = r"(?:^|\s)(?:-Xmx|--java-mem-size=)(\d+[kKmMgGtT]?)(?=\s|$)"
+thread_argument_pattern = r"(?:^|\s)(?:-nt|-nct|-t|-@|--threads|--num_threads)(?:=|\s*)(\d+)(?=\s|$)"
+# Java heaps and other tool memory settings are increased by this factor, and at least by this number of MB,
+# for the memory used outside of them
+memory_overhead = 1.2
+min_memory_overhead = 1024
+
+# Return the first match of the given patterns in cluster settings
+def search_patterns(patterns, cluster_args):
+    for pattern in patterns:
+        match = re.search(pattern, cluster_args)
+        if match:
+            return match
+    return None
+
+# Return the duration in seconds of "[days-]hours:minutes:seconds", "minutes:seconds" or "minutes" values
+def duration_seconds(duration):
+    days = 0
+    if "-" in duration:
+        days, duration = duration.split("-", 1)
+    seconds = 0
+    for value in duration.split(":"):
+        seconds = seconds * 60 + float(value)
+    if len(duration.split(":")) == 1:
+        # Slurm "--time=<minutes>"
+        seconds *= 60
+    return int(days) * 86400 + seconds
+
+# Return the size in MB of memory values like "16G", "4096M" or "1000kb"
+# Values without unit are in MB for Slurm "--mem" and "MaxRSS" values, in bytes for PBS "mem=" values
+def memory_mb(memory, default_unit='m'):
+    match = re.match(r"(\d+(?:\.\d+)?)([kKmMgGtT]?)([bB]?)$", memory)
+    if not match:
+        return None
+    unit = match.group(2).lower() or ('b' if match.group(3) else default_unit)
+    return float(match.group(1)) * {'b': 1.0 / 1024 / 1024, 'k': 1.0 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}[unit]
+
+# Number of CPUs requested by cluster settings, 1 if none
+def cluster_cpu(cluster_args):
+    match = search_patterns(cpu_patterns, cluster_args)
+    return int(match.group(2)) if match else 1
+
+# Memory in MB requested by cluster settings, 0 if none
+def cluster_memory(cluster_args):
+    match = search_patterns(memory_patterns, cluster_args)
+    return int(memory_mb(match.group(2), 'm' if match.group(1).startswith("--") else 'b') or 0) if match else 0
+
+# Walltime in seconds requested by cluster settings, None if none
+def cluster_walltime(cluster_args):
+    match = search_patterns(walltime_patterns, cluster_args)
+    return duration_seconds(match.group(2)) if match else None
+
+# Return cluster settings where the first value matching the given patterns is replaced by the formatted value
+def replace_cluster_value(patterns, cluster_args, format_value):
+    for pattern in patterns:
+        match = re.search(pattern, cluster_args)
+        if match:
+            return cluster_args[:match.start(2)] + format_value(match) + cluster_args[match.end(2):]
+    return cluster_args
+
+# Parse a job log file written by PBS, Slurm, batch or local job schedulers
+# Return a dict of resources used by the job, or None if the job has not completed yet
+def parse_job_log(path):
+    job_log = {'walltime': None, 'max_rss': None, 'cpus': None, 'cpu_time': None}
+    begin_date = end_date = None
+    exit_status = None
+    sstat_header = sstat_columns = None
+    with open(path) as log_file:
+        for line in log_file:
+            match = re.search(r"MUGQICexitStatus:(\d+)", line)
+            if match:
+                exit_status = int(match.group(1))
+                continue
+
+            # Batch and local job schedulers
+            match = re.match(r"(Begin|End) MUGQIC Job \S+ at (\S+)", line)
+            if match:
+                date = datetime.datetime.strptime(match.group(2), "%Y-%m-%dT%H:%M:%S")
+                if match.group(1) == "Begin":
+                    begin_date = date
+                else:
+                    end_date = date
+                continue
+
+            # PBS epilogue
+            match = re.match(r"Resources:\s+cput=(\S+),mem=(\S+),vmem=(\S+),walltime=(\d+:\d+:\d+)", line)
+            if match:
+                job_log['cpu_time'] = duration_seconds(match.group(1))
+                job_log['max_rss'] = memory_mb(match.group(2), 'b')
+                job_log['walltime'] = duration_seconds(match.group(4))
+                continue
+            match = re.match(r"Limits:\s+\S*ppn=(\d+)", line)
+            if match:
+                job_log['cpus'] = int(match.group(1))
+                continue
+
+            # Slurm fake epilogue: "scontrol show job" and "sstat" outputs, the last ones being the most recent
+            for field, key, parse in [("RunTime", 'walltime', duration_seconds), ("NumCPUs", 'cpus', int)]:
+                match = re.search(r"(?:^|\s)" + field + r"=(\S+)", line)
+                if match:
+                    job_log[key] = parse(match.group(1))
+            if "MaxRSS" in line.split():
+                sstat_header = line
+                continue
+            if sstat_header is not None and re.match(r"-+( -+)*\s*$", line):
+                sstat_columns = dict([(sstat_header[column.start():column.end()].strip(), (column.start(), column.end())) for column in re.finditer(r"-+", line)])
+                continue
+            if sstat_columns and line.strip():
+                for column, key, parse in [("MaxRSS", 'max_rss', memory_mb), ("AveCPU", 'cpu_time', duration_seconds)]:
+                    if column in sstat_columns:
+                        value = line[sstat_columns[column][0]:sstat_columns[column][1]].strip()
+                        if value:
+                            try:
+                                job_log[key] = parse(value)
+                            except ValueError:
+                                pass
+                sstat_header = sstat_columns = None
+
+            # memtime output
+            match = re.search(r"Max RSS = (\d+)KB", line)
+            if match:
+                job_log['max_rss'] = max(job_log['max_rss'], int(match.group(1)) / 1024.0)
+
+    if exit_status is None:
+        return None
+    job_log['exit_status'] = exit_status
+    if job_log['walltime'] is None and begin_date and end_date:
+        job_log['walltime'] = (end_date - begin_date).total_seconds()
+    return job_log
+
+# Return (memory in MB, number of CPUs) used by a job command according to the (name, value) options of its
+# config section and its arguments, 0 if unknown: tuned cluster settings must never be lower,
+# or jobs would be killed for exceeding their memory or would oversubscribe their CPUs
+def command_resources(options, command):
+    # Memory option values must have a unit, e.g. not "max_records_in_ram=3750000"
+    memories = [memory_mb(value.strip()) for name, value in options if re.search(memory_option_pattern, name) and re.match(r"\d+(?:\.\d+)?[kKmMgGtT][bB]?$", value.strip())]
+    # Java heap sizes without unit are in bytes
+    memories.extend([memory_mb(match.group(1), 'b') for match in re.finditer(memory_argument_pattern, command)])
+    cpus = [int(value.strip()) for name, value in options if re.search(thread_option_pattern, name) and value.strip().isdigit()]
+    cpus.extend([int(match.group(1)) for match in re.finditer(thread_argument_pattern, command)])
+    return int(math.ceil(max([0] + [max(memory * memory_overhead, memory + min_memory_overhead) for memory in memories]))), max([0] + cpus)
+
+# Nearest-rank percentile of a list of values
+def percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+class JobAccounting(object):
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        self._connection = sqlite3.connect(filepath)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS job_run (log_path TEXT PRIMARY KEY, job_name TEXT, job_name_prefix TEXT, input_size INTEGER, exit_status INTEGER, walltime REAL, max_rss REAL, cpus INTEGER, cpu_time REAL, collected_time REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS job_run_prefix ON job_run (job_name_prefix)")
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+    # Collect completed job runs listed in the job list files of a job output directory
+    # input_sizes: total input file size by job name, if known
+    # Return the number of collected job runs
+    def collect(self, job_output_dir, input_sizes={}):
+        collected_log_paths = set([row[0] for row in self._connection.execute("SELECT log_path FROM job_run")])
+        rows = []
+        input_size_rows = []
+        for job_list in sorted(glob.glob(os.path.join(job_output_dir, "*_job_list_*"))):
+            with open(job_list) as job_list_file:
+                for line in job_list_file:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) < 4:
+                        continue
+                    job_name, log_path = fields[1], os.path.join(os.path.dirname(os.path.abspath(job_list)), fields[3])
+                    if log_path in collected_log_paths:
+                        if input_sizes.get(job_name) is not None:
+                            input_size_rows.append((input_sizes[job_name], log_path))
+                        continue
+                    try:
+                        job_log = parse_job_log(log_path)
+                    except IOError:
+                        # Job not started yet
+                        continue
+                    if job_log:
+                        collected_log_paths.add(log_path)
+                        rows.append((log_path, job_name, job_name.split(".")[0], input_sizes.get(job_name), job_log['exit_status'], job_log['walltime'], job_log['max_rss'], job_log['cpus'], job_log['cpu_time'], time.time()))
+
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO job_run VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._connection.executemany("UPDATE job_run SET input_size = ? WHERE log_path = ? AND input_size IS NULL", input_size_rows)
+        log.info("Job accounting " + self.filepath + ": " + str(len(rows)) + " job run" + ("s" if len(rows) > 1 else "") + " collected from " + job_output_dir)
+        return len(rows)
+
+    def job_name_prefixes(self):
+        return [row[0] for row in self._connection.execute("SELECT DISTINCT job_name_prefix FROM job_run")]
+
+    # Return the successful runs of jobs with the given name prefix, restricted to runs with an input size
+    # within a factor 2 of the given one if there are at least min_runs of them
+    def successful_runs(self, job_name_prefix, input_size=None, min_runs=1):
+        runs = self._connection.execute("SELECT input_size, walltime, max_rss, cpus, cpu_time FROM job_run WHERE job_name_prefix = ? AND exit_status = 0", (job_name_prefix,)).fetchall()
+        if input_size:
+            similar_runs = [run for run in runs if run[0] and input_size / 2.0 <= run[0] <= input_size * 2.0]
+            if len(similar_runs) >= min_runs:
+                return similar_runs
+        return runs
+
+    # Return (walltime in seconds, memory in MB, number of CPUs) percentiles of the given successful runs,
+    # None for resources not recorded in at least min_runs runs
+    def resources(self, job_name_prefix, input_size=None, percent=95, min_runs=5):
+        runs = self.successful_runs(job_name_prefix, input_size, min_runs)
+        walltimes = [run[1] for run in runs if run[1] is not None]
+        max_rsses = [run[2] for run in runs if run[2] is not None]
+        # Number of CPUs actually used, i.e. CPU time / walltime
+        used_cpus = [run[4] / run[1] for run in runs if run[4] is not None and run[1]]
+        return (
+            percentile(walltimes, percent) if len(walltimes) >= min_runs else None,
+            percentile(max_rsses, percent) if len(max_rsses) >= min_runs else None,
+            percentile(used_cpus, percent) if len(used_cpus) >= min_runs else None
+        )
+
+    # Return the given cluster settings with walltime, memory and CPUs tuned from previous successful runs:
+    # percentiles times margin, but never more than the configured values,
+    # nor less than the memory and CPUs used by the job command (see command_resources())
+    def tune_cluster_params(self, job_name_prefix, input_size, cluster_params, percent=95, margin=1.2, min_runs=5, command_memory=0, command_cpus=0):
+        walltime, memory, cpus = self.resources(job_name_prefix, input_size, percent, min_runs)
+        tuned_cluster_params = {}
+        for param, value in cluster_params.items():
+            if walltime is not None and cluster_walltime(value):
+                seconds = int(min(cluster_walltime(value), max(min_walltime, walltime * margin)))
+                value = replace_cluster_value(walltime_patterns, value, lambda match: "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60))
+            if memory is not None and cluster_memory(value):
+                mb = int(min(cluster_memory(value), max(min_memory, command_memory, memory * margin)))
+                value = replace_cluster_value(memory_patterns, value, lambda match: str(mb) + ("M" if match.group(1).startswith("--") else "mb"))
+            if cpus is not None and search_patterns(cpu_patterns, value):
+                cpu_count = int(min(cluster_cpu(value), max(1, command_cpus, math.ceil(cpus * margin))))
+                value = replace_cluster_value(cpu_patterns, value, lambda match: str(cpu_count))
+            tuned_cluster_params[param] = value
+        return tuned_cluster_params
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import json
+import logging
+import os
+import sqlite3
+
+# MUGQIC Modules
+from stat_cache import FileStat
+
+log = logging.getLogger(__name__)
+
+# On-disk manifest of job files states recorded at the end of job creation.
+#
+# When jobs are re-created, file stats recorded in the manifest are restored into the stat cache
+# instead of stat'ing files again, as long as their parent directory modification time is unchanged,
+# i.e. no file was created, deleted or renamed in it since the manifest was written.
+# Output files of jobs whose .done directory changed (i.e. some jobs of the step were run again)
+# are always re-checked, since jobs may overwrite their output files in place.
+# Each job is recorded with the size and modification time of its .done file and input files:
+# input files of jobs whose .done file is trusted are always re-stat'ed, and if one of them was modified
+# in place since, the .done file and output files of the job are re-checked as well.
+class JobManifest(object):
+
+    # Incremented when the table layout changes: manifests of previous versions are discarded
+    version = 2
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        self._connection = sqlite3.connect(filepath)
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self._connection.executescript("""\
+DROP TABLE IF EXISTS job;
+DROP TABLE IF EXISTS file;
+DROP TABLE IF EXISTS directory;
+PRAGMA user_version = {version};
+""".format(version=self.version))
+        self._connection.executescript("""\
+CREATE TABLE IF NOT EXISTS job (done TEXT PRIMARY KEY, name TEXT, done_size INTEGER, done_mtime REAL, input_files TEXT, output_files TEXT);
+CREATE TABLE IF NOT EXISTS file (path TEXT PRIMARY KEY, lstat_exists INTEGER, exists_ INTEGER, mode INTEGER, size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS directory (path TEXT PRIMARY KEY, mtime REAL);
+""")
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+    # Restore into the stat cache all recorded file stats whose parent directory is unchanged,
+    # after re-stat'ing the input files of jobs whose .done file is trusted
+    # Return the number of restored file stats
+    def restore(self, stat_cache, threads=1):
+        unchanged_directories = set()
+        for path, mtime in self._connection.execute("SELECT path, mtime FROM directory"):
+            try:
+                if os.stat(path).st_mtime == mtime:
+                    unchanged_directories.add(path)
+            except OSError:
+                pass
+
+        # (size, mtime) of recorded files, (None, None) for missing ones
+        file_states = {}
+        for path, lstat_exists, size, mtime in self._connection.execute("SELECT path, lstat_exists, size, mtime FROM file"):
+            file_states[path] = (size, mtime) if lstat_exists else (None, None)
+
+        # .done and output files of jobs which may have been run since the manifest was written
+        rerun_files = set()
+        # Jobs whose .done file is trusted, as (.done file, output files, recorded input file states)
+        trusted_jobs = []
+        for done, done_size, done_mtime, input_files, output_files in self._connection.execute("SELECT done, done_size, done_mtime, input_files, output_files FROM job"):
+            if os.path.dirname(done) not in unchanged_directories:
+                rerun_files.update(json.loads(output_files))
+            elif file_states.get(done, (None, None)) != (done_size, done_mtime):
+                # Job recorded along with another state of its .done file, e.g. by a previous run of other steps
+                rerun_files.add(done)
+                rerun_files.update(json.loads(output_files))
+            elif done_mtime is not None:
+                trusted_jobs.append((done, json.loads(output_files), json.loads(input_files)))
+
+        # Input files modified in place do not change their directory: they are stat'ed again
+        input_files = [input_file for done, output_files, input_file_states in trusted_jobs for input_file, size, mtime in input_file_states]
+        stat_cache.prefetch(input_files, threads)
+        modified_input_files = set()
+        for done, output_files, input_file_states in trusted_jobs:
+            for input_file, size, mtime in input_file_states:
+                input_lstat = stat_cache.lstat(input_file)
+                if ((input_lstat.st_size, input_lstat.st_mtime) if input_lstat else (None, None)) != (size, mtime):
+                    modified_input_files.add(input_file)
+                    rerun_files.add(done)
+                    rerun_files.update(output_files)
+
+        restored_count = 0
+        for path, lstat_exists, exists, mode, size, mtime in self._connection.execute("SELECT path, lstat_exists, exists_, mode, size, mtime FROM file"):
+            if os.path.dirname(path) in unchanged_directories and path not in rerun_files:
+                stat_cache.prime(path, FileStat(mode, size, mtime) if lstat_exists else None, exists)
+                restored_count += 1
+
+        log.info("Job manifest " + self.filepath + ": " + str(restored_count) + " file stat" + ("s" if restored_count > 1 else "") + " restored from " + str(len(unchanged_directories)) + " unchanged director" + ("ies" if len(unchanged_directories) > 1 else "y") + ", " + str(len(modified_input_files)) + " input file" + ("s" if len(modified_input_files) > 1 else "") + " modified since")
+        return restored_count
+
+    # Record the given jobs and all stat cache entries
+    # Directories modified after planning_start_time are not recorded, since their file stats may be outdated
+    def record(self, jobs, stat_cache, planning_start_time):
+        file_rows = []
+        directories = set()
+        for path, path_lstat, exists in stat_cache.entries():
+            if path_lstat:
+                file_rows.append((path, 1, int(exists), path_lstat.st_mode, path_lstat.st_size, path_lstat.st_mtime))
+            else:
+                file_rows.append((path, 0, 0, None, None, None))
+            directories.add(os.path.dirname(path))
+
+        directory_rows = []
+        for directory in directories:
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            # Keep a 1 second margin for file systems with coarse modification time resolution
+            if mtime < planning_start_time - 1:
+                directory_rows.append((directory, mtime))
+
+        # (size, mtime) of cached files, recorded with each job for its .done and input files
+        file_states = dict([(path, (path_lstat.st_size, path_lstat.st_mtime) if path_lstat else (None, None)) for path, path_lstat, exists in stat_cache.entries()])
+        job_rows = []
+        for job in jobs:
+            done_size, done_mtime = file_states.get(job.abspath(job.done), (None, None))
+            input_file_states = [[input_file] + list(file_states.get(input_file, (None, None))) for input_file in [job.abspath(input_file) for input_file in job.input_files]]
+            job_rows.append((job.abspath(job.done), job.name, done_size, done_mtime, json.dumps(input_file_states), json.dumps([job.abspath(output_file) for output_file in job.output_files])))
+
+        with self._connection:
+            # Directories not recorded this time must not be trusted anymore
+            self._connection.executemany("DELETE FROM directory WHERE path = ?", [(directory,) for directory in directories])
+            self._connection.executemany("INSERT OR REPLACE INTO directory VALUES (?, ?)", directory_rows)
+            self._connection.executemany("INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?, ?, ?)", file_rows)
+            self._connection.executemany("INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?)", job_rows)
+
+        log.info("Job manifest " + self.filepath + ": " + str(len(job_rows)) + " job" + ("s" if len(job_rows) > 1 else "") + " and " + str(len(file_rows)) + " file" + ("s" if len(file_rows) > 1 else "") + " recorded")
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+# MUGQIC Modules
+from job import Job
+
+log = logging.getLogger(__name__)
+
+# On-disk plan of the jobs created by each step, saved at the end of job creation.
+#
+# The plan is keyed on the pipeline inputs (see Pipeline.plan_key()): if a pipeline is run again with
+# the same key, the saved jobs are restored instead of calling the create_jobs() method of each step,
+# and only their dependencies and up-to-date status are checked again.
+# The plan is also discarded if any pipeline source file was modified, or if any input file whose existence
+# decided which candidate input files were selected (see Pipeline.select_input_files()) was created or deleted.
+# Config file paths and other files checked by steps themselves are not checked again: use --force in that case.
+class JobPlan(object):
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+
+    @property
+    def filepath(self):
+        return self._filepath
+
+    # Return an ordered list of (step name, jobs) saved with the given key, None if the plan is missing or outdated
+    # Job samples are retrieved by name with the given function
+    def load(self, key, input_file_exists, sample_by_name):
+        try:
+            plan_file = open(self.filepath, 'r')
+        except IOError:
+            log.info("Job plan " + self.filepath + " not found... creating jobs")
+            return None
+
+        with plan_file:
+            # The first line is the plan header, followed by one line per job,
+            # so that the header is checked without reading jobs, and jobs are decoded one at a time
+            try:
+                header = json.loads(plan_file.readline())
+            except ValueError:
+                log.info("Job plan " + self.filepath + " is invalid... creating jobs")
+                return None
+
+            if header['key'] != key:
+                log.info("Job plan " + self.filepath + " created with different pipeline inputs... creating jobs")
+                return None
+
+            for source_file, md5 in header['source_files'].items():
+                if file_md5(source_file) != md5:
+                    log.info("Job plan " + self.filepath + " created with a different version of " + source_file + "... creating jobs")
+                    return None
+
+            for input_file, exists in header['input_files'].items():
+                if input_file_exists(input_file.encode('latin-1')) != exists:
+                    log.info("Job plan " + self.filepath + " created when " + input_file + (" existed" if exists else " did not exist") + "... creating jobs")
+                    return None
+
+            # JSON strings are unicode: encode them back to the original bytes, as created by pipeline steps
+            def encode(values):
+                return [value.encode('latin-1') for value in values]
+
+            steps = [(step_name.encode('latin-1'), []) for step_name in header['steps']]
+            job_count = 0
+            try:
+                for line in plan_file:
+                    planned_job = json.loads(line)
+                    job = Job(encode(planned_job['input_files']), encode(planned_job['output_files']), name=planned_job['name'].encode('latin-1'), command=planned_job['command'].encode('latin-1'), report_files=encode(planned_job['report_files']), removable_files=encode(planned_job['removable_files']), samples=[sample_by_name(sample) for sample in encode(planned_job['samples'])])
+                    job.modules = encode(planned_job['modules'])
+                    steps[planned_job['step']][1].append(job)
+                    job_count += 1
+            except KeyError as e:
+                log.info("Job plan " + self.filepath + " refers to unknown sample " + str(e) + "... creating jobs")
+                return None
+            except ValueError:
+                log.info("Job plan " + self.filepath + " is invalid... creating jobs")
+                return None
+
+        if job_count != header['job_count']:
+            log.info("Job plan " + self.filepath + " is incomplete... creating jobs")
+            return None
+
+        log.info("Job plan " + self.filepath + ": " + str(job_count) + " job" + ("s" if job_count > 1 else "") + " restored\n")
+        return steps
+
+    # Save the given ordered list of (step name, jobs) with the given key, along with the existence of selected input
+    # files and the checksums of all pipeline source files loaded so far
+    def save(self, key, steps, input_files):
+        header = {
+            'key': key,
+            'source_files': dict([(source_file, file_md5(source_file)) for source_file in loaded_source_files()]),
+            'input_files': input_files,
+            'steps': [name for name, jobs in steps],
+            'job_count': sum([len(jobs) for name, jobs in steps])
+        }
+
+        # Write to a temporary file renamed afterwards so that an interrupted pipeline never leaves a partial plan
+        if not os.path.isdir(os.path.dirname(self.filepath)):
+            os.makedirs(os.path.dirname(self.filepath))
+        tmp_fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(self.filepath))
+        with os.fdopen(tmp_fd, 'w') as tmp_file:
+            # Commands may contain any bytes: latin-1 encoding maps them losslessly to unicode
+            tmp_file.write(json.dumps(header, encoding='latin-1') + "\n")
+            for step_index, (name, jobs) in enumerate(steps):
+                for job in jobs:
+                    tmp_file.write(json.dumps({
+                        'step': step_index,
+                        'name': job.name,
+                        'command': job.command,
+                        'modules': job.modules,
+                        'input_files': job.input_files,
+                        'output_files': job.output_files,
+                        'report_files': job.report_files,
+                        'removable_files': job.removable_files,
+                        'samples': [sample.name for sample in job.samples]
+                    }, encoding='latin-1') + "\n")
+        os.rename(tmp_filepath, self.filepath)
+        log.info("Job plan " + self.filepath + ": " + str(header['job_count']) + " job" + ("s" if header['job_count'] > 1 else "") + " saved\n")
+
+# Return the MD5 of a file content, None if the file does not exist
+def file_md5(filepath):
+    try:
+        with open(filepath, 'rb') as file:
+            return hashlib.md5(file.read()).hexdigest()
+    except IOError:
+        return None
+
+# Return the source files of all loaded modules of MUGQIC Pipelines, including the pipeline script itself
+# bfx modules are only loaded when used by steps, hence this must be called after jobs are created
+def loaded_source_files():
+    root_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "")
+    source_files = set()
+    for module in sys.modules.values():
+        module_file = getattr(module, '__file__', None)
+        if module_file:
+            module_file = os.path.realpath(module_file)
+            if module_file.endswith(".pyc"):
+                module_file = module_file[:-1]
+            if module_file.startswith(root_dir):
+                source_files.add(module_file)
+    return sorted(source_files)
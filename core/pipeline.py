@@ -25,6 +25,7 @@ if sys.version_info < (2,7):
     raise SystemExit("Incompatible Python version: " + sys.version + "\nPython 2.7 or higher is required")
 
 # Python Standard Modules
+import ConfigParser
 import argparse
 import collections
 import datetime
@@ -33,12 +34,20 @@ import logging
 import os
 import re
 import textwrap
-from uuid import uuid4
+import time
+from StringIO import StringIO
 
 # MUGQIC Modules
 from config import config
+from fingerprint import FingerprintCache
 from job import *
+from job_accounting import JobAccounting, command_resources
+from job_manifest import JobManifest
+from job_plan import JobPlan, file_md5
+from profiler import profiler
+from sample_json import write_job2json_params
 from scheduler import *
+from stat_cache import stat_cache
 from step import *
 
 from bfx import jsonator
@@ -63,7 +72,6 @@ class Pipeline(object):
                 if self.protocol[i] == self.args.type:
                     pos = i
             step_list = self.steps[pos]
-        logging.basicConfig(level=getattr(logging, self.args.log.upper()))
 
         if self.args.help:
             print textwrap.dedent("""\
@@ -88,11 +96,38 @@ class Pipeline(object):
             )
             self.argparser.exit()
 
+        # Validate arguments and step range before parsing config files or creating any job
+        if not self.args.config:
+            self.argparser.error("argument -c/--config is required!")
+
+        step_counter = collections.Counter(step_list)
+        duplicated_steps = [step.__name__ for step in step_counter if step_counter[step] > 1]
+        if duplicated_steps:
+            raise Exception("Error: pipeline contains duplicated steps: " + ", ".join(duplicated_steps) + "!")
+        else:
+            self._step_list = [Step(step) for step in step_list]
+
+        if self.args.steps:
+            if re.search("^\d+([,-]\d+)*$", self.args.steps):
+                step_indexes = parse_range(self.args.steps)
+                if step_indexes[0] < 1 or step_indexes[-1] > len(self.step_list):
+                    raise Exception("Error: step range \"" + self.args.steps +
+                        "\" is out of pipeline steps 1-" + str(len(self.step_list)) + "!")
+                self._step_range = [self.step_list[i - 1] for i in step_indexes]
+            else:
+                raise Exception("Error: step range \"" + self.args.steps +
+                    "\" is invalid (should match \d+([,-]\d+)*)!")
+        else:
+            self.argparser.error("argument -s/--steps is required!")
+
+        logging.basicConfig(level=getattr(logging, self.args.log.upper()))
+
+        if self.args.profile:
+            profiler.enable()
+
         # Normal pipeline execution
-        if self.args.config:
+        with profiler.timer("pipeline", "config"):
             config.parse_files(self.args.config)
-        else:
-            self.argparser.error("argument -c/--config is required!")
 
         # Create a config trace from merged config file values
         with open(self.__class__.__name__ + ".config.trace.ini", 'wb') as config_trace:
@@ -107,28 +142,25 @@ class Pipeline(object):
             config.write(config_trace)
             config.filepath = os.path.abspath(config_trace.name)
 
+        # Jobs updating sample JSON files read their few parameters from this file instead of loading the config again
+        self._job2json_params_filepath = None
+        if self.args.json:
+            json_update_interval = config.param('DEFAULT', 'json_update_interval', type='int', required=False)
+            self._job2json_params_filepath = os.path.abspath(self.__class__.__name__ + ".job2json.json")
+            write_job2json_params(self._job2json_params_filepath, config.param('DEFAULT', 'portal_output_dir', required=False), json_update_interval if json_update_interval != "" else 60)
+
         self._output_dir = os.path.abspath(self.args.output_dir)
         self._scheduler = create_scheduler(self.args.job_scheduler, self.args.config)
 
-        step_counter = collections.Counter(step_list)
-        duplicated_steps = [step.__name__ for step in step_counter if step_counter[step] > 1]
-        if duplicated_steps:
-            raise Exception("Error: pipeline contains duplicated steps: " + ", ".join(duplicated_steps) + "!")
-        else:
-            self._step_list = [Step(step) for step in step_list]
-
-        if self.args.steps:
-            if re.search("^\d+([,-]\d+)*$", self.args.steps):
-                self._step_range = [self.step_list[i - 1] for i in parse_range(self.args.steps)]
-            else:
-                raise Exception("Error: step range \"" + self.args.steps +
-                    "\" is invalid (should match \d+([,-]\d+)*)!")
-        else:
-            self.argparser.error("argument -s/--steps is required!")
-
         self._sample_list = []
         self._sample_paths = []
 
+        # Statistics on candidate input files resolution
+        self._select_input_files_count = 0
+        self._candidate_input_files_count = 0
+        # Existence of input files checked to select candidate input files, by absolute path, saved in the job plan
+        self._input_file_states = {}
+
         # For job reporting, all jobs must be created first, no matter whether they are up to date or not
         if self.args.report:
             self._force_jobs = True
@@ -142,19 +174,24 @@ class Pipeline(object):
         else:
             self._force_jobs = self.args.force
             self.create_jobs()
-            self.submit_jobs()
+            with profiler.timer("pipeline", "submit_jobs"):
+                self.submit_jobs()
+
+        if self.args.profile:
+            profiler.report(os.path.join(self.output_dir, "job_output", self.__class__.__name__ + ".profile." + self.timestamp.replace(":", ".") + ".json"))
 
     # Pipeline command line arguments parser
     @property
     def argparser(self):
-        if self.protocol is None:
-            steps = "\n".join([str(idx + 1) + "- " + step.__name__  for idx, step in enumerate(self.steps)])
-        else:
-            steps = ""
-            for i in range(0, len(self.protocol)):
-                steps += "\n----\n"+self.protocol[i]+":\n"+"\n".join([str(idx + 1) + "- " + step.__name__  for idx, step in enumerate(self.steps[i])])
-
+        # Created once since pipelines add their own arguments to it before Pipeline.__init__ parses them
         if not hasattr(self, "_argparser"):
+            if self.protocol is None:
+                steps = "\n".join([str(idx + 1) + "- " + step.__name__  for idx, step in enumerate(self.steps)])
+            else:
+                steps = ""
+                for i in range(0, len(self.protocol)):
+                    steps += "\n----\n"+self.protocol[i]+":\n"+"\n".join([str(idx + 1) + "- " + step.__name__  for idx, step in enumerate(self.steps[i])])
+
             epilog = textwrap.dedent("""\
                 Steps:
                 ------
@@ -172,8 +209,14 @@ class Pipeline(object):
             self._argparser.add_argument("-c", "--config", help="config INI-style list of files; config parameters are overwritten based on files order", nargs="+", type=file)
             self._argparser.add_argument("-s", "--steps", help="step range e.g. '1-5', '3,6,7', '2,4-8'")
             self._argparser.add_argument("-o", "--output-dir", help="output directory (default: current)", default=os.getcwd())
-            self._argparser.add_argument("-j", "--job-scheduler", help="job scheduler type (default: pbs)", choices=["pbs", "batch", "daemon", "slurm"], default="slurm")
+            self._argparser.add_argument("-j", "--job-scheduler", help="job scheduler type (default: pbs)", choices=["pbs", "batch", "daemon", "slurm", "local"], default="slurm")
             self._argparser.add_argument("-f", "--force", help="force creation of jobs even if up to date (default: false)", action="store_true")
+            self._argparser.add_argument("--manifest", help="record job file states in a manifest under job_output/ and reuse them on next runs to only re-check files whose directory changed; ignored if --force is set (default: false)", action="store_true")
+            self._argparser.add_argument("--plan-cache", help="save the jobs created by each step in job_output/.plan/ and restore them on next runs with identical readset, design, pair and config files, step range and pipeline version and sources, instead of creating them again; only their dependencies and up-to-date status are checked again; with --force, jobs are created again and saved as the new plan (default: false)", action="store_true")
+            self._argparser.add_argument("--staleness", help="how to decide if a job is up to date: 'mtime' if no input file is more recent than its output files, 'hash' or 'full_hash' if its input and output file contents (sampled or full) are unchanged since it completed; jobs completed without content fingerprints are checked with 'mtime' (default: mtime)", choices=["mtime", "hash", "full_hash"], default="mtime")
+            self._argparser.add_argument("--job-scripts", help="write each job commands in its own script file under job_output/<step>/ and only submit these files from the generated submission script, for pbs and slurm job schedulers (default: false)", action="store_true")
+            self._argparser.add_argument("--tune-resources", help="collect resources used by previous job runs listed in job_output/ job lists into a job accounting database, then set each job walltime, memory and CPUs to percentiles of previous successful runs of jobs with the same name prefix and similar input size, never above config values (default: false)", action="store_true")
+            self._argparser.add_argument("--profile", help="log the time spent in each step to create jobs, resolve their dependencies and check if they are up to date, and the number of config parameter lookups, file stats and subprocesses; the profile is also written in job_output/ as JSON (default: false)", action="store_true")
             self._argparser.add_argument("--json", help="create a JSON file per analysed sample to track the analysis status (default: false)", action="store_true")
             self._argparser.add_argument("--report", help="create 'pandoc' command to merge all job markdown report files in the given step range into HTML, if they exist; if --report is set, --job-scheduler, --force, --clean options and job up-to-date status are ignored (default: false)", action="store_true")
             self._argparser.add_argument("--clean", help="create 'rm' commands for all job removable files in the given step range, if they exist; if --clean is set, --job-scheduler, --force options and job up-to-date status are ignored (default: false)", action="store_true")
@@ -198,6 +241,20 @@ class Pipeline(object):
     def report_template_dir(self):
         return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0])))), "bfx", "report")
 
+    # Fingerprint method matching --staleness option, None if staleness is checked with modification times
+    @property
+    def fingerprint_method(self):
+        return {'hash': "sampled", 'full_hash': "full"}.get(self.args.staleness)
+
+    # Job accounting database of resources used by previous job runs, see --tune-resources
+    @property
+    def job_accounting_filepath(self):
+        return os.path.expandvars(config.param('DEFAULT', 'job_accounting_db', required=False) or os.path.join(self.output_dir, "job_output", "mugqic_job_accounting.sqlite"))
+
+    @property
+    def job2json_params_filepath(self):
+        return self._job2json_params_filepath
+
     @property
     def scheduler(self):
         return self._scheduler
@@ -243,52 +300,63 @@ class Pipeline(object):
     def select_input_files(self, candidate_input_files):
         log.debug("candidate_input_files: \n" + str(candidate_input_files))
 
-        selected_input_files = []
-
-        # Create a reversed copy to pop the candidates ordered by priority
-        remaining_candidate_input_files = list(candidate_input_files)
-        remaining_candidate_input_files.reverse()
-        previous_jobs_output_files = set([output_file for job in self.jobs for output_file in job.output_files])
-
-        while not selected_input_files and remaining_candidate_input_files:
-            input_files = filter(None, remaining_candidate_input_files.pop())
+        self._select_input_files_count += 1
+        for candidate in candidate_input_files:
+            input_files = filter(None, candidate)
             # Skip empty candidate input files
             if input_files:
-                # dependency_jobs() checks if the current candidate input files is valid, otherwise raises an exception
-                try:
-                    job = Job(input_files=input_files)
-                    job.output_dir = self.output_dir
-                    self.dependency_jobs(job)
-                    selected_input_files = input_files
-                except Exception as e:
-                    log.debug("Caught Exception for candidate input file: " +  ", ".join(input_files))
-                    log.debug(e.message)
-
-        if selected_input_files:
-            log.debug("selected_input_files: " + ", ".join(input_files) + "\n")
-            return selected_input_files
-        else:
-            raise Exception("Error: missing candidate input files: " + str(candidate_input_files) +
-                " neither found in dependencies nor on file system!")
+                self._candidate_input_files_count += 1
+                missing_input_files = self.missing_input_files(input_files)
+                if missing_input_files:
+                    log.debug("Missing input files for candidate input file: " +  ", ".join(input_files))
+                    log.debug("Missing input files: " + ", ".join(missing_input_files))
+                else:
+                    log.debug("selected_input_files: " + ", ".join(input_files) + "\n")
+                    return input_files
+
+        raise Exception("Error: missing candidate input files: " + str(candidate_input_files) +
+            " neither found in dependencies nor on file system!")
+
+    # Return the absolute path of a file, relative paths being relative to the pipeline output directory
+    def abspath(self, file):
+        tmp_file = os.path.expandvars(file)
+        if not os.path.isabs(tmp_file):
+            tmp_file = os.path.normpath(os.path.join(self.output_dir, tmp_file))
+        return tmp_file
+
+    # Return the input files which are neither produced by previous jobs, nor listed in output files, nor found on file system
+    def missing_input_files(self, input_files, output_files=[]):
+        # Output files are included in case of "... && ..." command
+        # where first command output becomes second command input
+        return [input_file for input_file in collections.OrderedDict.fromkeys(input_files)
+            if input_file not in output_files
+            and not any([step.produces(input_file) for step in self.step_range])
+            and not self.input_file_exists(self.abspath(input_file))]
+
+    # Return True if the given input file exists, recording it for the job plan
+    # since the existence of input files decides which candidate input files are selected
+    def input_file_exists(self, input_file):
+        exists = stat_cache.exists(input_file)
+        self._input_file_states[input_file] = exists
+        return exists
 
     def dependency_jobs(self, current_job):
         dependency_jobs = []
         dependency_input_files = set()
+        input_files = set(current_job.input_files)
         for step in self.step_range:
-            for step_job in step.jobs:
-                # If current job input files intersect with step job output files, step job is a dependency
-                shared_files = set(current_job.input_files).intersection(set(step_job.output_files))
-                if shared_files:
-                    dependency_jobs.append(step_job)
-                    dependency_input_files.update(shared_files)
+            # If current job input files intersect with step job output files, step job is a dependency
+            step_dependency_jobs, shared_files = step.producer_jobs(input_files)
+            dependency_jobs.extend(step_dependency_jobs)
+            dependency_input_files.update(shared_files)
 
         # Check if job input files not found in dependencies are on file system
         missing_input_files = set()
         # Add current_job.output_files in case of "... && ..." command
         # where first command output becomes second command input
-        for remaining_input_file in set(current_job.input_files).difference(dependency_input_files).difference(set(current_job.output_files)):
+        for remaining_input_file in input_files.difference(dependency_input_files).difference(set(current_job.output_files)):
             # Use 'exists' instead of 'isfile' since input file can be a directory
-            if not os.path.exists(current_job.abspath(remaining_input_file)):
+            if not stat_cache.exists(current_job.abspath(remaining_input_file)):
                 missing_input_files.add(remaining_input_file)
         if missing_input_files:
             raise Exception("Error: missing input files for job " + current_job.name + ": " +
@@ -296,10 +364,149 @@ class Pipeline(object):
 
         return dependency_jobs
 
+    # Remove job dependencies already implied by other dependencies of the same job
+    # e.g. if job C depends on jobs A and B, and job B depends on job A, C only needs to depend on B
+    # Return the number of removed dependencies
+    def reduce_dependency_jobs(self, jobs):
+        # Jobs are sorted so that dependencies come first, hence a job is never reachable from jobs before it
+        job_positions = dict([(job, i) for i, job in enumerate(jobs)])
+        removed_count = 0
+        for job in jobs:
+            if len(job.dependency_jobs) < 2:
+                continue
+            # Search the ancestors of the job dependencies for the job dependencies themselves,
+            # not going further back than the first job dependency
+            dependency_jobs = set(job.dependency_jobs)
+            min_position = min([job_positions[dependency_job] for dependency_job in dependency_jobs])
+            implied_jobs = set()
+            visited_jobs = set()
+            remaining_jobs = [ancestor_job for dependency_job in dependency_jobs for ancestor_job in dependency_job.dependency_jobs]
+            while remaining_jobs:
+                ancestor_job = remaining_jobs.pop()
+                if ancestor_job in visited_jobs or job_positions[ancestor_job] < min_position:
+                    continue
+                visited_jobs.add(ancestor_job)
+                if ancestor_job in dependency_jobs:
+                    implied_jobs.add(ancestor_job)
+                remaining_jobs.extend(ancestor_job.dependency_jobs)
+            if implied_jobs:
+                reduced_dependency_jobs = [dependency_job for dependency_job in job.dependency_jobs if dependency_job not in implied_jobs]
+                removed_count += len(job.dependency_jobs) - len(reduced_dependency_jobs)
+                job.dependency_jobs = reduced_dependency_jobs
+        return removed_count
+
+    # Tune job cluster settings from resources used by previous job runs, recorded in the job accounting database
+    def tune_job_resources(self):
+        job_accounting = JobAccounting(self.job_accounting_filepath)
+
+        # Total size of existing input files by name of job to submit
+        # Input files created by jobs not run yet are missing, hence their size is only known once collected
+        input_sizes = {}
+        for job in self.jobs:
+            input_sizes[job.name] = sum([stat_cache.size(job.abspath(input_file)) or 0 for input_file in job.input_files])
+        job_accounting.collect(os.path.join(self.output_dir, "job_output"), input_sizes)
+
+        percent = config.param('DEFAULT', 'resource_tuning_percentile', type='float', required=False) or 95
+        margin = config.param('DEFAULT', 'resource_tuning_margin', type='float', required=False) or 1.2
+        min_runs = config.param('DEFAULT', 'resource_tuning_min_runs', type='posint', required=False) or 5
+        tuned_job_count = 0
+        # Config section options by job name prefix
+        section_options = {}
+        for job in self.jobs:
+            # Cluster settings section must match job name prefix before first "."
+            # e.g. "[trimmomatic] cluster_cpu=..." for job name "trimmomatic.readset1"
+            job_name_prefix = job.name.split(".")[0]
+            cluster_params = dict([(param, config.param(job_name_prefix, param)) for param in ['cluster_walltime', 'cluster_queue', 'cluster_cpu']])
+            if job_name_prefix not in section_options:
+                section_options[job_name_prefix] = self.section_options(job_name_prefix)
+            command_memory, command_cpus = command_resources(section_options[job_name_prefix], job.command)
+            tuned_cluster_params = job_accounting.tune_cluster_params(job_name_prefix, input_sizes.get(job.name), cluster_params, percent, margin, min_runs, command_memory, command_cpus)
+            for param in cluster_params:
+                if tuned_cluster_params[param] != cluster_params[param]:
+                    job.cluster_params[param] = tuned_cluster_params[param]
+                    log.debug("Job " + job.name + " " + param + ": " + cluster_params[param] + " tuned to " + tuned_cluster_params[param])
+            if job.cluster_params:
+                tuned_job_count += 1
+        job_accounting.close()
+        log.info("Job resources: " + str(tuned_job_count) + " job" + ("s" if tuned_job_count > 1 else "") + " tuned from previous job runs\n")
+
+    # Return the (name, value) options of a config section, including DEFAULT ones, values being interpolated if valid
+    def section_options(self, section):
+        if not config.has_section(section):
+            section = 'DEFAULT'
+        options = []
+        for option in (config.options(section) if section != 'DEFAULT' else config.defaults().keys()):
+            try:
+                options.append((option, config.get(section, option)))
+            except ConfigParser.InterpolationError:
+                options.append((option, config.get(section, option, raw=True)))
+        return options
+
+    # Key of the job plan: MD5 of all pipeline inputs which may change the jobs created by steps,
+    # i.e. pipeline version, output directory, step range, merged config values and the environment variables
+    # they refer to, and pipeline specific arguments with file arguments (readset, design, pair files) by content
+    def plan_key(self):
+        md5 = hashlib.md5()
+        md5.update("\n".join([self.__class__.__name__, getattr(self, "version", ""), self.output_dir] + [step.name for step in self.step_range]) + "\n")
+
+        config_values = StringIO()
+        config.write(config_values)
+        md5.update(config_values.getvalue())
+        for variable in sorted(set(re.findall("\$\{?(\w+)", config_values.getvalue()))):
+            md5.update(variable + "=" + os.environ.get(variable, "") + "\n")
+
+        # Common arguments not used by steps to create jobs
+        ignored_args = ["help", "config", "steps", "output_dir", "job_scheduler", "force", "manifest", "plan_cache", "staleness", "job_scripts", "tune_resources", "profile", "json", "report", "clean", "log"]
+        for name, value in sorted(vars(self.args).items()):
+            if name not in ignored_args:
+                md5.update(name + "=" + (str(file_md5(value.name)) if isinstance(value, file) else repr(value)) + "\n")
+
+        return md5.hexdigest()
+
     def create_jobs(self):
+        # Number of threads used to stat job files concurrently before checking if jobs are up to date
+        stat_threads = config.param('DEFAULT', 'stat_threads', type='posint', required=False) or 1
+
+        # Restore file stats recorded during previous runs to avoid stat'ing unchanged files again
+        planning_start_time = time.time()
+        job_manifest = None
+        if self.args.manifest and not self.force_jobs:
+            job_manifest = JobManifest(os.path.join(self.output_dir, "job_output", "mugqic_job_manifest.sqlite"))
+            with profiler.timer("pipeline", "job_manifest"):
+                job_manifest.restore(stat_cache, stat_threads)
+        fingerprint_cache = None
+        if self.fingerprint_method and not self.force_jobs:
+            fingerprint_cache = FingerprintCache(os.path.join(self.output_dir, "job_output", "mugqic_fingerprints.sqlite"), self.fingerprint_method)
+        created_jobs = []
+        # Samples of created jobs, for constant time membership tests
+        sample_set = set(self.sample_list)
+
+        # Restore the jobs created by each step during a previous run with identical pipeline inputs,
+        # unless jobs are forced: jobs are then created again and saved as the new plan
+        job_plan = None
+        planned_steps = None
+        if self.args.plan_cache:
+            job_plan = JobPlan(os.path.join(self.output_dir, "job_output", ".plan", self.__class__.__name__ + ".plan.json"))
+            samples_by_name = {}
+            def sample_by_name(name):
+                if not samples_by_name:
+                    samples_by_name.update([(sample.name, sample) for sample in self.samples])
+                return samples_by_name[name]
+            with profiler.timer("pipeline", "job_plan"):
+                plan_key = self.plan_key()
+                restored_steps = None if self.force_jobs else job_plan.load(plan_key, stat_cache.exists, sample_by_name)
+            if restored_steps is not None:
+                planned_steps = dict(restored_steps)
+        new_steps = []
+
         for step in self.step_range:
-            log.info("Create jobs for step " + step.name + "...")
-            jobs = step.create_jobs()
+            if planned_steps is not None:
+                jobs = planned_steps[step.name]
+            else:
+                log.info("Create jobs for step " + step.name + "...")
+                with profiler.timer(step.name, "create_jobs"):
+                    jobs = step.create_jobs()
+                new_steps.append((step.name, jobs))
             for job in jobs:
                 # Job name is mandatory to create job .done file name
                 if not job.name:
@@ -313,23 +520,59 @@ class Pipeline(object):
                 # Thus, if the command is modified, the job is not up-to-date anymore.
                 job.done = os.path.join("job_output", step.name, job.name + "." + hashlib.md5(job.command_with_modules).hexdigest() + ".mugqic.done")
                 job.output_dir = self.output_dir
-                job.dependency_jobs = self.dependency_jobs(job)
+                created_jobs.append(job)
 
-                if not self.force_jobs and job.is_up2date():
+            if stat_threads > 1 and not self.force_jobs:
+                with profiler.timer(step.name, "stat_prefetch"):
+                    stat_cache.prefetch([file for job in jobs for file in job.up2date_files()], stat_threads)
+
+            for job in jobs:
+                with profiler.timer(step.name, "dependency_jobs"):
+                    job.dependency_jobs = self.dependency_jobs(job)
+
+                with profiler.timer(step.name, "is_up2date"):
+                    is_up2date = not self.force_jobs and job.is_up2date(fingerprint_cache)
+                if is_up2date:
                     log.info("Job " + job.name + " up to date... skipping")
                 else:
                     step.add_job(job)
                     if job.samples:
                         for sample in job.samples:
-                            if sample not in self.sample_list:
+                            if sample not in sample_set:
+                                sample_set.add(sample)
                                 self.sample_list.append(sample)
 
             log.info("Step " + step.name + ": " + str(len(step.jobs)) + " job" + ("s" if len(step.jobs) > 1 else "") + " created" + ("" if step.jobs else "... skipping") + "\n")
 
+        if self._select_input_files_count:
+            log.info("Candidate input files: " + str(self._candidate_input_files_count) + " candidate" + ("s" if self._candidate_input_files_count > 1 else "") + " evaluated for " + str(self._select_input_files_count) + " selection" + ("s" if self._select_input_files_count > 1 else ""))
+        log.info("File stat cache: " + str(stat_cache.stat_count) + " file" + ("s" if stat_cache.stat_count > 1 else "") + " stat'ed on file system, " + str(stat_cache.hit_count) + " cache hit" + ("s" if stat_cache.hit_count > 1 else "") + "\n")
+
+        dependency_count = sum([len(job.dependency_jobs) for job in self.jobs])
+        if dependency_count:
+            with profiler.timer("pipeline", "reduce_dependency_jobs"):
+                removed_dependency_count = self.reduce_dependency_jobs(self.jobs)
+            log.info("Job dependencies: " + str(removed_dependency_count) + " of " + str(dependency_count) + " dependenc" + ("ies" if dependency_count > 1 else "y") + " removed since already implied by other dependencies\n")
+
+        if self.args.tune_resources:
+            with profiler.timer("pipeline", "tune_job_resources"):
+                self.tune_job_resources()
+
+        if job_plan and planned_steps is None:
+            with profiler.timer("pipeline", "job_plan"):
+                job_plan.save(plan_key, new_steps, self._input_file_states)
+
+        if fingerprint_cache:
+            fingerprint_cache.close()
+        if job_manifest:
+            with profiler.timer("pipeline", "job_manifest"):
+                job_manifest.record(created_jobs, stat_cache, planning_start_time)
+            job_manifest.close()
+
         # Now create the json dumps for all the samples if not already done
         if self.args.json:
-            for sample in self.sample_list:
-                self.sample_paths.append(jsonator.create(self, sample))
+            with profiler.timer("pipeline", "jsonator.create"):
+                self.sample_paths.extend(jsonator.create_all(self, self.sample_list))
 
         log.info("TOTAL: " + str(len(self.jobs)) + " job" + ("s" if len(self.jobs) > 1 else "") + " created" + ("" if self.jobs else "... skipping") + "\n")
 
@@ -341,12 +584,26 @@ class Pipeline(object):
         if self.args.json and portal_output_dir != "":
             if not os.path.isdir(os.path.expandvars(portal_output_dir)):
                 raise Exception("Directory path \"" + portal_output_dir + "\" does not exist or is not a valid directory!")
-            copy_commands = []
-            for i, sample in enumerate(self.sample_list):
-                input_file = self.sample_paths[i]
-                output_file = os.path.join(portal_output_dir, '$USER.' + sample.name + '.' + uuid4().get_hex() + '.json')
-                copy_commands.append("cp \"{input_file}\" \"{output_file}\"".format(
-                    input_file=input_file, output_file=output_file))
+            # Imported here since uuid loads libuuid through ctypes, which slows down pipeline startup
+            from uuid import uuid4
+            output_files = [os.path.join(portal_output_dir, '$USER.' + sample.name + '.' + uuid4().get_hex() + '.json') for sample in self.sample_list]
+            if config.param('DEFAULT', 'json_step_store', type='boolean', required=False):
+                # Sample JSON step stores are assembled into single documents, by chunks of samples
+                # since a single command argument may not exceed 128 KB on Linux (MAX_ARG_STRLEN)
+                script = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utils", "sample_json_assemble.py")
+                chunk_size = 100
+                copy_commands = ["module load " + config.param('DEFAULT', 'module_python')]
+                for i in range(0, len(self.sample_paths), chunk_size):
+                    copy_commands.append("{script} \\\n  -j \"{input_files}\" \\\n  -o \"{output_files}\"".format(
+                        script=script,
+                        input_files=",".join(self.sample_paths[i:i + chunk_size]),
+                        output_files=",".join(output_files[i:i + chunk_size])))
+                copy_commands.append("module unload " + config.param('DEFAULT', 'module_python'))
+            else:
+                copy_commands = []
+                for input_file, output_file in zip(self.sample_paths, output_files):
+                    copy_commands.append("cp \"{input_file}\" \"{output_file}\"".format(
+                        input_file=input_file, output_file=output_file))
 
             print(textwrap.dedent("""
                 #------------------------------------------------------------------------------
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+# MUGQIC Modules
+from config import Config
+
+log = logging.getLogger(__name__)
+
+# Context manager used when profiling is disabled
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+class Timer(object):
+
+    def __init__(self, profiler, section, phase):
+        self._profiler = profiler
+        self._key = (section, phase)
+
+    def __enter__(self):
+        self._start_time = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._profiler.add_time(self._key, time.time() - self._start_time)
+        return False
+
+# Profiler of pipeline job creation: wall time by section (e.g. a step name) and phase (e.g. "create_jobs"),
+# and counts of config parameter lookups, file stats and subprocesses
+class Profiler(object):
+
+    def __init__(self):
+        self._enabled = False
+        self._null_timer = NullTimer()
+        self._times = collections.OrderedDict()
+        self._calls = collections.Counter()
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    # Start profiling: os.stat, os.lstat, subprocess.Popen and Config.param are wrapped to be counted
+    def enable(self):
+        if self._enabled:
+            return
+        self._enabled = True
+        self._start_time = time.time()
+
+        for module, name, counter in [(os, 'stat', "os.stat"), (os, 'lstat', "os.lstat"), (Config, 'param', "Config.param")]:
+            setattr(module, name, self.counted(getattr(module, name), counter))
+
+        profiler = self
+        class CountedPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                profiler.count("subprocess")
+                subprocess_popen.__init__(self, *args, **kwargs)
+        subprocess_popen = subprocess.Popen
+        subprocess.Popen = CountedPopen
+
+    def counted(self, function, counter):
+        def counted_function(*args, **kwargs):
+            self.count(counter)
+            return function(*args, **kwargs)
+        return counted_function
+
+    # Return a context manager adding its wall time to the given section and phase
+    def timer(self, section, phase):
+        return Timer(self, section, phase) if self._enabled else self._null_timer
+
+    def add_time(self, key, seconds):
+        self._times[key] = self._times.get(key, 0) + seconds
+        self._calls[key] += 1
+
+    # Thread-safe since files can be stat'ed by several threads
+    def count(self, counter, value=1):
+        with self._lock:
+            self._counts[counter] += value
+
+    # Log a table of phase times sorted by decreasing time, and write the same profile as JSON in the given file
+    def report(self, filepath):
+        total_time = time.time() - self._start_time
+        phases = sorted([{'section': section, 'phase': phase, 'seconds': seconds, 'calls': self._calls[(section, phase)]} for (section, phase), seconds in self._times.items()], key=lambda phase: -phase['seconds'])
+
+        lines = ["Profile (total " + "%.3f" % total_time + " s):", "%-40s %-24s %10s %8s %10s" % ("Section", "Phase", "Seconds", "%", "Calls")]
+        for phase in phases:
+            lines.append("%-40s %-24s %10.3f %8.1f %10d" % (phase['section'], phase['phase'], phase['seconds'], 100 * phase['seconds'] / total_time if total_time else 0, phase['calls']))
+        for counter, value in sorted(self._counts.items()):
+            lines.append("%-65s %10d" % (counter + " calls", value))
+        log.info("\n".join(lines) + "\n")
+
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, 'w') as profile_file:
+            json.dump({'total_seconds': total_time, 'phases': phases, 'counts': dict(self._counts)}, profile_file, indent=4)
+        log.info("Profile written in " + filepath)
+
+# Global profiler object used throughout the whole pipeline
+profiler = Profiler()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import errno
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+
+log = logging.getLogger(__name__)
+
+# Sample JSON files (see bfx/jsonator.py) are updated by the jobs of all pipeline runs of a sample:
+# each job start and end is appended as an event to "<sample JSON file>.events", and events are only applied to
+# the sample JSON file itself from time to time (see materialize()). Both files are only modified under FileLock.
+#
+# With "[DEFAULT] json_step_store=True", a sample JSON file is stored as a step store instead, i.e. as directory
+# "<sample JSON file>.d" holding "index.json", the sample JSON document whose steps are replaced by their names, and one
+# "steps/<step name>.json" file per step, so that updates only rewrite the files of the steps they change.
+# The sample JSON file path remains the name of the sample JSON document: assemble() returns the document of a store.
+
+# Advisory lock of a file, held on "<file>.flock" so that the file itself can be replaced
+# POSIX locks are released by the system when their process dies, hence a crashed job never leaves a stale lock
+class FileLock(object):
+
+    def __init__(self, filepath, min_delay=0.01, max_delay=1.0):
+        self._lock_filepath = filepath + ".flock"
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._lock_file = None
+
+    def __enter__(self):
+        self._lock_file = open(self._lock_filepath, 'a')
+        delay = self._min_delay
+        while True:
+            try:
+                fcntl.lockf(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except IOError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    self._lock_file.close()
+                    raise
+            # Exponential backoff with jitter, bounded so that the lock is taken soon after being released
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, self._max_delay)
+
+    def __exit__(self, type, value, traceback):
+        fcntl.lockf(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        return False
+
+def events_filepath(json_filepath):
+    return json_filepath + ".events"
+
+# Append a job event to the event log of a sample JSON file: FileLock must be held
+def append_job_event(json_filepath, event):
+    with open(events_filepath(json_filepath), 'a') as events_file:
+        events_file.write(json.dumps(event) + "\n")
+
+# Return the job events not applied to a sample JSON file yet, in their order of occurrence
+def pending_job_events(json_filepath):
+    events = []
+    try:
+        with open(events_filepath(json_filepath), 'r') as events_file:
+            for line in events_file:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # Partial line of a job killed while writing its event
+                    log.warning("Invalid job event in " + events_filepath(json_filepath) + ": " + line.strip())
+    except IOError:
+        pass
+    return events
+
+# Return True if pending events must be applied to a sample JSON file now, i.e. if it was not updated for
+# interval seconds, or if no job of the sample is running anymore once they are applied, so that the last job end
+# of a sample is never left pending
+def materialization_due(json_filepath, events, interval):
+    if not events:
+        return False
+    try:
+        if time.time() - last_update_time(json_filepath) >= interval:
+            return True
+    except OSError:
+        return True
+    running_jobs = applied_running_jobs(json_filepath)
+    for event in events:
+        if event['status'] == "running":
+            running_jobs.add((event['step'], event['job']))
+        else:
+            running_jobs.discard((event['step'], event['job']))
+    return not running_jobs
+
+def running_jobs_filepath(json_filepath):
+    return json_filepath + ".running"
+
+# Return the (step name, job name) of the jobs marked running in sample JSON steps
+def running_jobs_of_steps(steps):
+    return set([(jstep['name'], jjob['name']) for jstep in steps for jjob in jstep['job'] if jjob.get('status') == "running"])
+
+# Return the jobs marked running in a sample JSON file, as recorded in "<sample JSON file>.running" whenever it is written
+def applied_running_jobs(json_filepath):
+    try:
+        return set([tuple(job) for job in read_json(running_jobs_filepath(json_filepath))])
+    except IOError:
+        # Sample JSON file written by a previous pipeline version
+        try:
+            return running_jobs_of_steps(assemble(json_filepath)['pipeline']['step'])
+        except (IOError, OSError, ValueError):
+            return set()
+
+def write_running_jobs(json_filepath, running_jobs):
+    write_json(running_jobs_filepath(json_filepath), sorted(running_jobs))
+
+# Apply job events to the jobs of sample JSON steps
+def apply_job_events(steps, events, analysis_folder, sample_name):
+    jobs = dict([((jstep['name'], jjob['name']), jjob) for jstep in steps for jjob in jstep['job']])
+    for event in events:
+        jjob = jobs.get((event['step'], event['job']))
+        if jjob is None:
+            log.warning("Job " + event['job'] + ", within step " + event['step'] + ", was not found in sample " + sample_name + " JSON")
+            continue
+
+        if event['status'] == "running":
+            jjob['job_start_date'] = event['date']
+            jjob['status'] = "running"
+        else:
+            # Make sure the job log file is not in absolute path anymore
+            jjob['log_file'] = re.sub(analysis_folder, "", event['log_file']) if analysis_folder else event['log_file']
+            if event['status'] == "0":
+                jjob['status'] = "success"
+                jjob['done_file'] = event['done_file']
+            else:
+                jjob['status'] = "error"
+            jjob['job_end_date'] = event['date']
+
+# Write a sample JSON object, replacing the file only once fully written
+def write_sample_json(json_filepath, json_hash):
+    write_json(json_filepath, json_hash, indent=4)
+
+def write_json(filepath, json_hash, indent=None):
+    tmp_fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)))
+    with os.fdopen(tmp_fd, 'w') as tmp_file:
+        json.dump(json_hash, tmp_file, indent=indent)
+    os.chmod(tmp_filepath, 0666 & ~current_umask())
+    os.rename(tmp_filepath, filepath)
+
+def read_json(filepath):
+    with open(filepath, 'r') as json_file:
+        return json.load(json_file)
+
+def current_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Apply pending job events to a sample JSON file and clear them: FileLock must be held
+# Return False if there was no pending event
+def materialize(json_filepath, events=None):
+    if events is None:
+        events = pending_job_events(json_filepath)
+    if not events:
+        return False
+
+    if is_store(json_filepath):
+        # Only the steps of the events are read and written
+        index = read_json(store_index_filepath(json_filepath))
+        step_names = set(index['pipeline']['step'])
+        events_by_step = collections.OrderedDict()
+        for event in events:
+            events_by_step.setdefault(event['step'], []).append(event)
+        # Running jobs of the steps not read are unchanged
+        running_jobs = set([job for job in applied_running_jobs(json_filepath) if job[0] not in events_by_step])
+        for step_name, step_events in events_by_step.items():
+            steps = [read_store_step(json_filepath, step_name)] if step_name in step_names else []
+            apply_job_events(steps, step_events, index['pipeline']['general_information'].get('analysis_folder'), index['sample_name'])
+            for step in steps:
+                write_json(store_step_filepath(json_filepath, step_name), step)
+            running_jobs.update(running_jobs_of_steps(steps))
+        write_running_jobs(json_filepath, running_jobs)
+        # The store index modification time is the store update time, see last_update_time()
+        os.utime(store_index_filepath(json_filepath), None)
+    else:
+        json_hash = read_json(json_filepath)
+        apply_job_events(json_hash['pipeline']['step'], events, json_hash['pipeline']['general_information'].get('analysis_folder'), json_hash['sample_name'])
+        write_sample_json(json_filepath, json_hash)
+        write_running_jobs(json_filepath, running_jobs_of_steps(json_hash['pipeline']['step']))
+    os.remove(events_filepath(json_filepath))
+    return True
+
+def store_dirpath(json_filepath):
+    return json_filepath + ".d"
+
+def store_index_filepath(json_filepath):
+    return os.path.join(store_dirpath(json_filepath), "index.json")
+
+def store_step_filepath(json_filepath, step_name):
+    return os.path.join(store_dirpath(json_filepath), "steps", step_name + ".json")
+
+# The store index is written last, hence a store without index is an incomplete one
+def is_store(json_filepath):
+    return os.path.isfile(store_index_filepath(json_filepath))
+
+def sample_json_exists(json_filepath):
+    return is_store(json_filepath) or (os.path.exists(json_filepath) and os.stat(json_filepath).st_size > 0)
+
+def last_update_time(json_filepath):
+    return os.path.getmtime(store_index_filepath(json_filepath) if is_store(json_filepath) else json_filepath)
+
+def read_store_step(json_filepath, step_name):
+    return read_json(store_step_filepath(json_filepath, step_name))
+
+# Return the sample JSON document of a sample JSON file or store
+def assemble(json_filepath):
+    if not is_store(json_filepath):
+        return read_json(json_filepath)
+    json_hash = read_json(store_index_filepath(json_filepath))
+    json_hash['pipeline']['step'] = [read_store_step(json_filepath, step_name) for step_name in json_hash['pipeline']['step']]
+    return json_hash
+
+# Write a sample JSON document to a step store, its steps being given apart as an ordered dict of steps by name
+# Only the steps named in updated_step_names are written if given, the other ones being already in the store
+def write_store(json_filepath, json_hash, steps, updated_step_names=None):
+    steps_dirpath = os.path.dirname(store_step_filepath(json_filepath, ""))
+    if not os.path.isdir(steps_dirpath):
+        os.makedirs(steps_dirpath)
+    for step_name in steps.keys() if updated_step_names is None else updated_step_names:
+        write_json(store_step_filepath(json_filepath, step_name), steps[step_name])
+
+    index = dict(json_hash)
+    index['pipeline'] = dict(json_hash['pipeline'])
+    index['pipeline']['step'] = steps.keys()
+    write_json(store_index_filepath(json_filepath), index)
+
+def remove_store(json_filepath):
+    shutil.rmtree(store_dirpath(json_filepath), ignore_errors=True)
+
+# Write the parameters of utils/job2json.py, so that jobs read this small file instead of loading the pipeline config
+# portal_output_dir may contain environment variables, expanded by jobs
+def write_job2json_params(filepath, portal_output_dir, update_interval):
+    with open(filepath, 'w') as params_file:
+        json.dump({'portal_output_dir': portal_output_dir, 'json_update_interval': update_interval}, params_file)
+
+def load_job2json_params(filepath):
+    with open(filepath, 'r') as params_file:
+        return json.load(params_file)
@@ -20,12 +20,15 @@
 ################################################################################
 
 # Python Standard Modules
+import collections
+import hashlib
 import json
 import os
 import random
 
 # MUGQIC Modules
 from config import *
+from job_accounting import JobAccounting, cluster_cpu, cluster_memory, cluster_walltime, duration_seconds
 
 # Output comment separator line
 separator_line = "#" + "-" * 79
@@ -39,6 +42,8 @@ def create_scheduler(type, config_files):
         return DaemonScheduler(config_files)
     elif type == "slurm":
         return SlurmScheduler(config_files)
+    elif type == "local":
+        return LocalScheduler(config_files)
     else:
         raise Exception("Error: scheduler type \"" + type + "\" is invalid!")
 
@@ -99,7 +104,185 @@ mkdir -p $JOB_OUTPUT_DIR/$STEP
 """.format(separator_line=separator_line, step=step)
         )
 
-    def job2json(self, pipeline, step, job, job_status):
+    # With "cluster_submit_throttle=true", the submission script keeps the number of $USER jobs in the cluster queue
+    # under "cluster_max_jobs" instead of submitting all jobs at once: before each submission, it waits until enough
+    # jobs have left the queue, counting them with "cluster_queue_count_cmd" every "cluster_submit_throttle_interval" seconds.
+    # Free job slots are counted down after each submission, so that the queue is only polled once they are exhausted.
+    # Jobs are submitted in the script order, where dependency jobs always come first.
+    def throttle_max_jobs(self):
+        if not config.param('DEFAULT', 'cluster_submit_throttle', type='boolean', required=False):
+            return None
+        cluster_max_jobs = config.param('DEFAULT', 'cluster_max_jobs', type='posint', required=False)
+        if not cluster_max_jobs:
+            raise Exception("Error: parameter \"[DEFAULT] cluster_max_jobs\" must be defined with \"cluster_submit_throttle=true\"!")
+        return cluster_max_jobs
+
+    def print_throttle(self, pipeline):
+        cluster_max_jobs = self.throttle_max_jobs()
+        if cluster_max_jobs and pipeline.jobs:
+            print("""
+{separator_line}
+# Submit jobs only while there are less than {cluster_max_jobs} $USER jobs in the cluster queue
+{separator_line}
+MUGQIC_FREE_JOB_SLOTS=0
+mugqic_throttle() {{
+  while [ $MUGQIC_FREE_JOB_SLOTS -lt $1 ] ; do
+    MUGQIC_QUEUED_JOBS=$({queue_count_cmd}) || MUGQIC_QUEUED_JOBS=""
+    if [[ $MUGQIC_QUEUED_JOBS =~ ^[0-9]+$ ]] ; then
+      MUGQIC_FREE_JOB_SLOTS=$(({cluster_max_jobs} - MUGQIC_QUEUED_JOBS))
+    fi
+    if [ $MUGQIC_FREE_JOB_SLOTS -lt $1 ] ; then
+      echo "`date +%FT%H:%M:%S` ${{MUGQIC_QUEUED_JOBS:-Unknown number of}} queued jobs: waiting for $1 free job slot(s) to submit $2" >&2
+      sleep {interval}
+    fi
+  done
+  MUGQIC_FREE_JOB_SLOTS=$((MUGQIC_FREE_JOB_SLOTS - $1))
+}}""".format(
+                    separator_line=separator_line,
+                    cluster_max_jobs=cluster_max_jobs,
+                    queue_count_cmd=config.param('DEFAULT', 'cluster_queue_count_cmd', required=False) or self.queue_count_cmd,
+                    interval=config.param('DEFAULT', 'cluster_submit_throttle_interval', type='posint', required=False) or 60
+                )
+            )
+
+    # Return the command waiting for free job slots before submitting the given number of jobs, if throttled
+    def throttle_command(self, job_count, name):
+        cluster_max_jobs = self.throttle_max_jobs()
+        if cluster_max_jobs:
+            # Jobs more numerous than the maximum are submitted once the queue is empty
+            return "mugqic_throttle " + str(min(job_count, cluster_max_jobs)) + " " + name + "\n"
+        return ""
+
+    # Warn if more jobs than the cluster maximum are submitted at once
+    def check_max_jobs(self, pipeline):
+        cluster_max_jobs = config.param('DEFAULT', 'cluster_max_jobs', type='posint', required=False)
+        if cluster_max_jobs and len(pipeline.jobs) > cluster_max_jobs and not self.throttle_max_jobs():
+            log.warning("Number of jobs: " + str(len(pipeline.jobs)) + " > Cluster maximum number of jobs: " + str(cluster_max_jobs) + "! Set \"cluster_submit_throttle=true\" to submit them as queued jobs complete.")
+
+    # With "cluster_critical_path_priority=true", jobs are prioritized by the estimated duration of their critical path,
+    # i.e. the longest chain of dependent jobs from the job to the end of the pipeline, so that long chains of jobs
+    # are not queued behind short independent ones. The duration of a job is estimated, by order of preference, from:
+    # - the median walltime of previous successful runs of jobs with the same name prefix in the job accounting database
+    #   (at least "resource_tuning_min_runs" runs, see --tune-resources)
+    # - the "runtime_estimate" parameter of the job section, e.g. "[gatk_haplotype_caller] runtime_estimate=12:00:00"
+    # - the job cluster walltime
+    # Return the critical path duration of each job relatively to the longest one, and log the estimated makespan of all jobs
+    def critical_paths(self, pipeline):
+        if not pipeline.jobs or not config.param('DEFAULT', 'cluster_critical_path_priority', type='boolean', required=False):
+            return {}
+
+        job_accounting = JobAccounting(pipeline.job_accounting_filepath)
+        job_accounting.collect(os.path.join(pipeline.output_dir, "job_output"))
+        min_runs = config.param('DEFAULT', 'resource_tuning_min_runs', type='posint', required=False) or 5
+        prefix_durations = {}
+        durations = {}
+        for job in pipeline.jobs:
+            job_name_prefix = job.name.split(".")[0]
+            if job_name_prefix not in prefix_durations:
+                runtime_estimate = config.param(job_name_prefix, 'runtime_estimate', required=False)
+                prefix_durations[job_name_prefix] = job_accounting.resources(job_name_prefix, percent=50, min_runs=min_runs)[0] or (duration_seconds(runtime_estimate) if runtime_estimate else None)
+            # Jobs without any estimate last one hour
+            durations[job] = prefix_durations[job_name_prefix] or cluster_walltime(self.cluster_param(job, 'cluster_walltime')) or 3600
+        job_accounting.close()
+
+        # Jobs are sorted so that dependencies come first, hence critical paths are computed from the last job
+        dependent_jobs = collections.defaultdict(list)
+        for job in pipeline.jobs:
+            for dependency_job in job.dependency_jobs:
+                dependent_jobs[dependency_job].append(job)
+        critical_paths = {}
+        next_jobs = {}
+        for job in reversed(pipeline.jobs):
+            next_job = max(dependent_jobs[job], key=lambda dependent_job: critical_paths[dependent_job]) if dependent_jobs[job] else None
+            critical_paths[job] = durations[job] + (critical_paths[next_job] if next_job else 0)
+            next_jobs[job] = next_job
+
+        # The makespan is the critical path of the first job of the longest chain, if the cluster runs all ready jobs at once
+        job = max(pipeline.jobs, key=lambda job: critical_paths[job])
+        makespan = critical_paths[job]
+        critical_path_jobs = []
+        while job:
+            critical_path_jobs.append(job.name + " (" + format_duration(durations[job]) + ")")
+            job = next_jobs[job]
+        log.info("Estimated makespan: " + format_duration(makespan) + " for " + str(len(pipeline.jobs)) + " job" + ("s" if len(pipeline.jobs) > 1 else "") + " totalling " + format_duration(sum(durations.values())) + ", critical path:\n  " + "\n  ".join(critical_path_jobs) + "\n")
+        return dict([(job, critical_path / float(makespan)) for job, critical_path in critical_paths.items()])
+
+    # Return the cluster priority argument of the given jobs submitted together, from their longest critical path,
+    # "" if jobs are not prioritized
+    def priority_arg(self, jobs):
+        if not self._critical_paths:
+            return ""
+        rank = max([self._critical_paths[job] for job in jobs])
+        priority_range = config.param('DEFAULT', 'cluster_priority_range', type='posint', required=False) or self.priority_range
+        return " " + self.priority_option + str(self.priority_value(rank, priority_range))
+
+    # Return a job cluster setting, possibly tuned for this job, e.g. with --tune-resources
+    # Cluster settings section must match job name prefix before first "."
+    # e.g. "[trimmomatic] cluster_cpu=..." for job name "trimmomatic.readset1"
+    def cluster_param(self, job, option):
+        if option in job.cluster_params:
+            return job.cluster_params[option]
+        return config.param(job.name.split(".")[0], option)
+
+    # Return the JOB_DEPENDENCIES variable assignment of the given dependency job IDs
+    def job_dependencies(self, dependency_jobs):
+        if dependency_jobs:
+            # Chunk JOB_DEPENDENCIES on multiple lines to avoid lines too long
+            max_dependencies_per_line = 50
+            dependency_chunks = [dependency_jobs[i:i + max_dependencies_per_line] for i in range(0, len(dependency_jobs), max_dependencies_per_line)]
+            job_dependencies = "JOB_DEPENDENCIES=" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunks[0]])
+            for dependency_chunk in dependency_chunks[1:]:
+                job_dependencies += "\nJOB_DEPENDENCIES=$JOB_DEPENDENCIES:" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunk])
+            return job_dependencies
+        else:
+            return "JOB_DEPENDENCIES="
+
+    # Return the job command definition of the submission script: either the whole job command in $COMMAND,
+    # or with --job-scripts, the path of the job script file in $JOB_SCRIPT
+    def job_command(self, pipeline, step, job):
+        if pipeline.args.job_scripts:
+            return "JOB_SCRIPT=$JOB_OUTPUT_DIR/$STEP/" + self.write_job_script(pipeline, step, job)
+        else:
+            return """\
+COMMAND=$(cat << '{limit_string}'
+{job.command_with_modules}
+{limit_string}
+)""".format(job=job, limit_string=os.path.basename(job.done))
+
+    # Write the job script in job_output/<step>/ and return its file name
+    # The file is named after the MD5 of its content, hence it is only written once as long as the job is unchanged
+    def write_job_script(self, pipeline, step, job):
+        job_script = self.job_script(pipeline, step, job)
+        job_script_name = job.name + "." + hashlib.md5(job_script).hexdigest() + ".sh"
+        job_script_path = os.path.join(pipeline.output_dir, "job_output", step.name, job_script_name)
+        if not os.path.exists(job_script_path):
+            if not os.path.isdir(os.path.dirname(job_script_path)):
+                os.makedirs(os.path.dirname(job_script_path))
+            # Write to a temporary file first so that a partially written job script is never submitted
+            with open(job_script_path + ".tmp", 'w') as job_script_file:
+                job_script_file.write(job_script)
+            os.rename(job_script_path + ".tmp", job_script_path)
+        return job_script_name
+
+    def job_script(self, pipeline, step, job):
+        # Needs to be defined in scheduler child class supporting job scripts
+        raise NotImplementedError
+
+    # Return the command creating the job .done file once the job has succeeded:
+    # with content-based staleness, input and output file fingerprints are recorded in it
+    def job_done_command(self, pipeline, job):
+        if not pipeline.fingerprint_method:
+            return "touch $JOB_DONE"
+
+        return """module load {module_python} && {job_fingerprint_script} -m {method} -d $JOB_DONE {files} || touch $JOB_DONE ; module unload {module_python}""".format(
+            module_python=config.param('DEFAULT', 'module_python'),
+            job_fingerprint_script=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utils", "job_fingerprint.py"),
+            method=pipeline.fingerprint_method,
+            files=" ".join([job.fingerprint_path(file) for file in job.input_files + job.output_files])
+        )
+
+    # By default, job2json command is quoted to be included in a double-quoted string: use quote='"' otherwise
+    def job2json(self, pipeline, step, job, job_status, quote='\\"'):
         if not pipeline.args.json:
             return ""
 
@@ -107,42 +290,45 @@ mkdir -p $JOB_OUTPUT_DIR/$STEP
         return """\
 module load {module_python}
 {job2json_script} \\
-  -u \\"$USER\\" \\
-  -c \\"{config_files}\\" \\
-  -s \\"{step.name}\\" \\
-  -j \\"$JOB_NAME\\" \\
-  -d \\"$JOB_DONE\\" \\
-  -l \\"$JOB_OUTPUT\\" \\
-  -o \\"{jsonfiles}\\" \\
+  -u {quote}$USER{quote} \\
+  -p {quote}{params_file}{quote} \\
+  -s {quote}{step.name}{quote} \\
+  -j {quote}$JOB_NAME{quote} \\
+  -d {quote}$JOB_DONE{quote} \\
+  -l {quote}$JOB_OUTPUT{quote} \\
+  -o {quote}{jsonfiles}{quote} \\
   -f {status}
 module unload {module_python} {command_separator}""".format(
             job2json_script=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utils", "job2json.py"),
             module_python=config.param('DEFAULT', 'module_python'),
             step=step,
             jsonfiles=json_file_list,
-            config_files=",".join([ c.name for c in self._config_files ]),
+            params_file=pipeline.job2json_params_filepath,
             status=job_status,
-            command_separator="&&" if (job_status=='\\"running\\"') else ""
+            command_separator="&&" if ("running" in job_status) else "",
+            quote=quote
         ) if json_file_list else ""
 
 
 class PBSScheduler(Scheduler):
+    # Command printing the number of $USER jobs in the cluster queue, see throttle_max_jobs()
+    queue_count_cmd = "qstat -u $USER | awk '/^[0-9]/ { n++ } END { print n + 0 }'"
+
+    # Job priority from 0 to priority_range, the highest being run first, see critical_paths()
+    priority_option = "-p "
+    priority_range = 1023
+
+    def priority_value(self, rank, priority_range):
+        return int(round(rank * priority_range))
+
     def submit(self, pipeline):
+        self._critical_paths = self.critical_paths(pipeline)
         self.print_header(pipeline)
+        self.print_throttle(pipeline)
         for step in pipeline.step_range:
             if step.jobs:
                 self.print_step(step)
                 for job in step.jobs:
-                    if job.dependency_jobs:
-                        # Chunk JOB_DEPENDENCIES on multiple lines to avoid lines too long
-                        max_dependencies_per_line = 50
-                        dependency_chunks = [job.dependency_jobs[i:i + max_dependencies_per_line] for i in range(0, len(job.dependency_jobs), max_dependencies_per_line)]
-                        job_dependencies = "JOB_DEPENDENCIES=" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunks[0]])
-                        for dependency_chunk in dependency_chunks[1:]:
-                            job_dependencies += "\nJOB_DEPENDENCIES=$JOB_DEPENDENCIES:" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunk])
-                    else:
-                        job_dependencies = "JOB_DEPENDENCIES="
-
                     #sleepTime = random.randint(10, 100)
                     print("""
 {separator_line}
@@ -153,27 +339,25 @@ JOB_NAME={job.name}
 JOB_DONE={job.done}
 JOB_OUTPUT_RELATIVE_PATH=$STEP/${{JOB_NAME}}_$TIMESTAMP.o
 JOB_OUTPUT=$JOB_OUTPUT_DIR/$JOB_OUTPUT_RELATIVE_PATH
-COMMAND=$(cat << '{limit_string}'
-{job.command_with_modules}
-{limit_string}
-)""".format(
+{job_command}""".format(
                             job=job,
-                            job_dependencies=job_dependencies,
+                            job_dependencies=self.job_dependencies(job.dependency_jobs),
                             separator_line=separator_line,
-                            limit_string=os.path.basename(job.done)
+                            job_command=self.job_command(pipeline, step, job)
                         )
                     )
 
-                    cmd = """\
+                    cmd = "" if pipeline.args.job_scripts else """\
 echo "rm -f $JOB_DONE && {job2json_start} $COMMAND
 MUGQIC_STATE=\$PIPESTATUS
 echo MUGQICexitStatus:\$MUGQIC_STATE
 {job2json_end}
 if [ \$MUGQIC_STATE -eq 0 ] ; then
-  touch $JOB_DONE ;
+  {job_done_command} ;
 fi
 exit \$MUGQIC_STATE" | \\
 """.format(
+                        job_done_command=self.job_done_command(pipeline, job),
                         job2json_start=self.job2json(pipeline, step, job, '\\"running\\"'),
                         job2json_end=self.job2json(pipeline, step, job, '\\$MUGQIC_STATE')
                     )
@@ -188,9 +372,12 @@ exit \$MUGQIC_STATE" | \\
                         config.param(job_name_prefix, 'cluster_work_dir_arg') + " $OUTPUT_DIR " + \
                         config.param(job_name_prefix, 'cluster_output_dir_arg') + " $JOB_OUTPUT " + \
                         config.param(job_name_prefix, 'cluster_job_name_arg') + " $JOB_NAME " + \
-                        config.param(job_name_prefix, 'cluster_walltime') + " " + \
-                        config.param(job_name_prefix, 'cluster_queue') + " " + \
-                        config.param(job_name_prefix, 'cluster_cpu')
+                        self.cluster_param(job, 'cluster_walltime') + " " + \
+                        self.cluster_param(job, 'cluster_queue') + " " + \
+                        self.cluster_param(job, 'cluster_cpu') + \
+                        self.priority_arg([job])
+                    if pipeline.args.job_scripts:
+                        cmd += " -v JOB_OUTPUT=$JOB_OUTPUT"
                     #cmd += \
                         #config.param(job_name_prefix, 'cluster_submit_cmd') + " " + \
                         #config.param(job_name_prefix, 'cluster_other_arg') + " " + \
@@ -201,12 +388,15 @@ exit \$MUGQIC_STATE" | \\
 
                     if job.dependency_jobs:
                         cmd += " " + config.param(job_name_prefix, 'cluster_dependency_arg') + "$JOB_DEPENDENCIES"
+                    if pipeline.args.job_scripts:
+                        cmd += " $JOB_SCRIPT"
                     cmd += " " + config.param(job_name_prefix, 'cluster_submit_cmd_suffix')
 
                     if config.param(job_name_prefix, 'cluster_cmd_produces_job_id'):
                         cmd = job.id + "=$(" + cmd + ")"
                     else:
                         cmd += "\n" + job.id + "=" + job.name
+                    cmd = self.throttle_command(1, "$JOB_NAME") + cmd
 
                     # Write job parameters in job list file
                     cmd += "\necho \"$" + job.id + "\t$JOB_NAME\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH\" >> $JOB_LIST\n"
@@ -214,9 +404,28 @@ exit \$MUGQIC_STATE" | \\
                     print cmd
 
         # Check cluster maximum job submission
-        cluster_max_jobs = config.param('DEFAULT', 'cluster_max_jobs', type='posint', required=False)
-        if cluster_max_jobs and len(pipeline.jobs) > cluster_max_jobs:
-            log.warning("Number of jobs: " + str(len(pipeline.jobs)) + " > Cluster maximum number of jobs: " + str(cluster_max_jobs) + "!")
+        self.check_max_jobs(pipeline)
+
+    # Job script content with the same job commands as the ones echoed to the submit command above
+    def job_script(self, pipeline, step, job):
+        return """\
+#!/bin/bash
+JOB_NAME={job.name}
+JOB_DONE={job.done}
+rm -f $JOB_DONE && {job2json_start} {job.command_with_modules}
+MUGQIC_STATE=$PIPESTATUS
+echo MUGQICexitStatus:$MUGQIC_STATE
+{job2json_end}
+if [ $MUGQIC_STATE -eq 0 ] ; then
+  {job_done_command} ;
+fi
+exit $MUGQIC_STATE
+""".format(
+            job=job,
+            job_done_command=self.job_done_command(pipeline, job),
+            job2json_start=self.job2json(pipeline, step, job, '"running"', quote='"'),
+            job2json_end=self.job2json(pipeline, step, job, '$MUGQIC_STATE', quote='"')
+        )
 
 class BatchScheduler(Scheduler):
     def submit(self, pipeline):
@@ -241,33 +450,157 @@ MUGQIC_STATE=$PIPESTATUS
 echo "End MUGQIC Job $JOB_NAME at `date +%FT%H:%M:%S`"
 echo MUGQICexitStatus:$MUGQIC_STATE
 {job2json_end}
-if [ $MUGQIC_STATE -eq 0 ] ; then touch $JOB_DONE ; else exit $MUGQIC_STATE ; fi
+if [ $MUGQIC_STATE -eq 0 ] ; then {job_done_command} ; else exit $MUGQIC_STATE ; fi
 """.format(
                             job=job,
+                            job_done_command=self.job_done_command(pipeline, job),
                             separator_line=separator_line,
                             job2json_start=self.job2json(pipeline, step, job, '\\"running\\"'),
                             job2json_end=self.job2json(pipeline, step, job, '\\$MUGQIC_STATE')
                         )
                     )
 
-class SlurmScheduler(Scheduler):
+class LocalScheduler(Scheduler):
     def submit(self, pipeline):
         self.print_header(pipeline)
+        local_jobs = []
         for step in pipeline.step_range:
             if step.jobs:
                 self.print_step(step)
                 for job in step.jobs:
-                    if job.dependency_jobs:
-                        # Chunk JOB_DEPENDENCIES on multiple lines to avoid lines too long
-                        max_dependencies_per_line = 50
-                        dependency_chunks = [job.dependency_jobs[i:i + max_dependencies_per_line] for i in range(0, len(job.dependency_jobs), max_dependencies_per_line)]
-                        job_dependencies = "JOB_DEPENDENCIES=" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunks[0]])
-                        for dependency_chunk in dependency_chunks[1:]:
-                            job_dependencies += "\nJOB_DEPENDENCIES=$JOB_DEPENDENCIES:" + ":".join(["$" + dependency_job.id for dependency_job in dependency_chunk])
+                    local_jobs.append({
+                        'id': job.id,
+                        'name': job.name,
+                        'step': step.name,
+                        'dependencies': [dependency_job.id for dependency_job in job.dependency_jobs],
+                        'cpu': cluster_cpu(self.cluster_param(job, 'cluster_cpu')),
+                        'memory': cluster_memory(" ".join([self.cluster_param(job, param) for param in ['cluster_queue', 'cluster_cpu', 'cluster_other_arg']])),
+                        'script': os.path.join(pipeline.output_dir, "job_output", step.name, self.write_job_script(pipeline, step, job))
+                    })
+
+        if local_jobs:
+            local_cpu = config.param('DEFAULT', 'local_cpu', type='posint', required=False)
+            local_memory = config.param('DEFAULT', 'local_memory', type='posint', required=False)
+            print("""
+{separator_line}
+# Run all jobs on the local machine as their dependencies and available resources allow
+{separator_line}
+module load {module_python}
+{local_executor_script} -o $JOB_OUTPUT_DIR -t $TIMESTAMP -l $JOB_LIST{local_executor_options} << 'END_OF_JOBS'
+{local_jobs}
+END_OF_JOBS""".format(
+                    separator_line=separator_line,
+                    module_python=config.param('DEFAULT', 'module_python'),
+                    local_executor_script=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utils", "local_executor.py"),
+                    local_executor_options=(" -c " + str(local_cpu) if local_cpu else "") + (" -m " + str(local_memory) if local_memory else "") + (" -k" if config.param('DEFAULT', 'local_keep_going', type='boolean', required=False) else ""),
+                    local_jobs=json.dumps(local_jobs, indent=4)
+                )
+            )
+
+    # Job script content similar to the batch scheduler job commands
+    def job_script(self, pipeline, step, job):
+        return """\
+#!/bin/bash
+JOB_NAME={job.name}
+JOB_DONE={job.done}
+echo "Begin MUGQIC Job $JOB_NAME at `date +%FT%H:%M:%S`"
+rm -f $JOB_DONE && {job2json_start} {job.command_with_modules}
+MUGQIC_STATE=$PIPESTATUS
+echo "End MUGQIC Job $JOB_NAME at `date +%FT%H:%M:%S`"
+echo MUGQICexitStatus:$MUGQIC_STATE
+{job2json_end}
+if [ $MUGQIC_STATE -eq 0 ] ; then {job_done_command} ; fi
+exit $MUGQIC_STATE
+""".format(
+            job=job,
+            job_done_command=self.job_done_command(pipeline, job),
+            job2json_start=self.job2json(pipeline, step, job, '"running"', quote='"'),
+            job2json_end=self.job2json(pipeline, step, job, '$MUGQIC_STATE', quote='"')
+        )
+
+class SlurmScheduler(Scheduler):
+    # Cluster settings which must be identical for jobs to be submitted in the same job array
+    array_cluster_params = [
+        'cluster_submit_cmd',
+        'cluster_other_arg',
+        'cluster_work_dir_arg',
+        'cluster_output_dir_arg',
+        'cluster_job_name_arg',
+        'cluster_walltime',
+        'cluster_queue',
+        'cluster_cpu',
+        'cluster_dependency_arg',
+        'cluster_submit_cmd_suffix',
+        'cluster_cmd_produces_job_id'
+    ]
+
+    # Command printing the number of $USER jobs in the cluster queue, array tasks included, see throttle_max_jobs()
+    queue_count_cmd = "squeue -h -r -u $USER | wc -l"
+
+    # Job nice value from 0 to priority_range, the lowest being run first, see critical_paths()
+    priority_option = "--nice="
+    priority_range = 10000
+
+    def priority_value(self, rank, priority_range):
+        return int(round((1 - rank) * priority_range))
+
+    def submit(self, pipeline):
+        self._critical_paths = self.critical_paths(pipeline)
+        # With "cluster_job_array=true", jobs of the same step sharing the same cluster settings
+        # are submitted as a single Slurm job array instead of one sbatch call per job
+        job_array = config.param('DEFAULT', 'cluster_job_array', type='boolean', required=False)
+        job_array_max_size = config.param('DEFAULT', 'cluster_job_array_max_size', type='posint', required=False) or 1000
+        # Job arrays by member job, used to express dependencies on array tasks
+        self._job_arrays = {}
+
+        self.print_header(pipeline)
+        self.print_throttle(pipeline)
+        for step in pipeline.step_range:
+            if step.jobs:
+                self.print_step(step)
+                for step_job in self.step_job_arrays(step, job_array_max_size) if job_array else step.jobs:
+                    if isinstance(step_job, SlurmJobArray):
+                        self.submit_job_array(pipeline, step, step_job)
                     else:
-                        job_dependencies = "JOB_DEPENDENCIES="
+                        self.submit_job(pipeline, step, step_job)
 
-                    print("""
+        # Check cluster maximum job submission
+        self.check_max_jobs(pipeline)
+
+    # Return the step jobs, with jobs sharing the same cluster settings grouped in job arrays of at most max_size tasks
+    # Only jobs which do not depend on other jobs of the same step can be grouped, each job array being
+    # submitted at the position of its first task so that jobs submitted after it can depend on it
+    def step_job_arrays(self, step, max_size):
+        step_jobs = set(step.jobs)
+        groups = collections.OrderedDict()
+        for job in step.jobs:
+            job_name_prefix = job.name.split(".")[0]
+            if config.param(job_name_prefix, 'cluster_cmd_produces_job_id') and not step_jobs.intersection(job.dependency_jobs):
+                key = tuple([self.cluster_param(job, param) for param in self.array_cluster_params])
+            else:
+                # Job submitted on its own
+                key = job
+            groups.setdefault(key, []).append(job)
+
+        first_jobs = {}
+        for jobs in groups.values():
+            if len(jobs) > 1:
+                for i in range(0, len(jobs), max_size):
+                    if len(jobs[i:i + max_size]) > 1:
+                        first_jobs[jobs[i]] = jobs[i:i + max_size]
+
+        step_job_arrays = []
+        grouped_jobs = set()
+        for job in step.jobs:
+            if job in first_jobs:
+                step_job_arrays.append(SlurmJobArray(step, len([job_array for job_array in step_job_arrays if isinstance(job_array, SlurmJobArray)]) + 1, first_jobs[job]))
+                grouped_jobs.update(first_jobs[job])
+            elif job not in grouped_jobs:
+                step_job_arrays.append(job)
+        return step_job_arrays
+
+    def submit_job(self, pipeline, step, job):
+        print("""
 {separator_line}
 # JOB: {job.id}: {job.name}
 {separator_line}
@@ -276,18 +609,15 @@ JOB_NAME={job.name}
 JOB_DONE={job.done}
 JOB_OUTPUT_RELATIVE_PATH=$STEP/${{JOB_NAME}}_$TIMESTAMP.o
 JOB_OUTPUT=$JOB_OUTPUT_DIR/$JOB_OUTPUT_RELATIVE_PATH
-COMMAND=$(cat << '{limit_string}'
-{job.command_with_modules}
-{limit_string}
-)""".format(
-                            job=job,
-                            job_dependencies=job_dependencies,
-                            separator_line=separator_line,
-                            limit_string=os.path.basename(job.done)
-                        )
-                    )
+{job_command}""".format(
+                job=job,
+                job_dependencies=self.job_dependencies(job.dependency_jobs),
+                separator_line=separator_line,
+                job_command=self.job_command(pipeline, step, job)
+            )
+        )
 
-                    cmd = """\
+        cmd = "" if pipeline.args.job_scripts else """\
 echo "#! /bin/bash
 echo '#######################################'
 echo 'SLURM FAKE PROLOGUE (MUGQIC)'
@@ -299,7 +629,7 @@ rm -f $JOB_DONE && {job2json_start} $COMMAND
 MUGQIC_STATE=\$PIPESTATUS
 echo MUGQICexitStatus:\$MUGQIC_STATE
 {job2json_end}
-if [ \$MUGQIC_STATE -eq 0 ] ; then touch $JOB_DONE ; fi
+if [ \$MUGQIC_STATE -eq 0 ] ; then {job_done_command} ; fi
 echo '#######################################'
 echo 'SLURM FAKE EPILOGUE (MUGQIC)'
 date
@@ -308,45 +638,224 @@ sstat -j \$SLURM_JOBID.batch
 echo '#######################################'
 exit \$MUGQIC_STATE" | \\
 """.format(
-                        job=job,
-                        job2json_start=self.job2json(pipeline, step, job, '\\"running\\"'),
-                        job2json_end=self.job2json(pipeline, step, job, '\\$MUGQIC_STATE')
+            job=job,
+            job_done_command=self.job_done_command(pipeline, job),
+            job2json_start=self.job2json(pipeline, step, job, '\\"running\\"'),
+            job2json_end=self.job2json(pipeline, step, job, '\\$MUGQIC_STATE')
 )
 
-                    # Cluster settings section must match job name prefix before first "."
-                    # e.g. "[trimmomatic] cluster_cpu=..." for job name "trimmomatic.readset1"
-                    job_name_prefix = job.name.split(".")[0]
-                    cmd += \
-                        config.param(job_name_prefix, 'cluster_submit_cmd') + " " + \
-                        config.param(job_name_prefix, 'cluster_other_arg') + " " + \
-                        config.param(job_name_prefix, 'cluster_work_dir_arg') + " $OUTPUT_DIR " + \
-                        config.param(job_name_prefix, 'cluster_output_dir_arg') + " $JOB_OUTPUT " + \
-                        config.param(job_name_prefix, 'cluster_job_name_arg') + " $JOB_NAME " + \
-                        config.param(job_name_prefix, 'cluster_walltime') + " " + \
-                        config.param(job_name_prefix, 'cluster_queue') + " " + \
-                        config.param(job_name_prefix, 'cluster_cpu')
-                    if job.dependency_jobs:
-                        cmd += " " + config.param(job_name_prefix, 'cluster_dependency_arg') + "$JOB_DEPENDENCIES"
-                    cmd += " " + config.param(job_name_prefix, 'cluster_submit_cmd_suffix')
-
-                    if config.param(job_name_prefix, 'cluster_cmd_produces_job_id'):
-                        cmd = job.id + "=$(" + cmd + ")"
-                    else:
-                        cmd += "\n" + job.id + "=" + job.name
+        # Cluster settings section must match job name prefix before first "."
+        # e.g. "[trimmomatic] cluster_cpu=..." for job name "trimmomatic.readset1"
+        job_name_prefix = job.name.split(".")[0]
+        cmd += \
+            config.param(job_name_prefix, 'cluster_submit_cmd') + " " + \
+            config.param(job_name_prefix, 'cluster_other_arg') + " " + \
+            config.param(job_name_prefix, 'cluster_work_dir_arg') + " $OUTPUT_DIR " + \
+            config.param(job_name_prefix, 'cluster_output_dir_arg') + " $JOB_OUTPUT " + \
+            config.param(job_name_prefix, 'cluster_job_name_arg') + " $JOB_NAME " + \
+            self.cluster_param(job, 'cluster_walltime') + " " + \
+            self.cluster_param(job, 'cluster_queue') + " " + \
+            self.cluster_param(job, 'cluster_cpu') + \
+            self.priority_arg([job])
+        if pipeline.args.job_scripts:
+            cmd += " --export=ALL,JOB_OUTPUT=$JOB_OUTPUT"
+        if job.dependency_jobs:
+            cmd += " " + config.param(job_name_prefix, 'cluster_dependency_arg') + "$JOB_DEPENDENCIES"
+        if pipeline.args.job_scripts:
+            cmd += " $JOB_SCRIPT"
+        cmd += " " + config.param(job_name_prefix, 'cluster_submit_cmd_suffix')
+
+        if config.param(job_name_prefix, 'cluster_cmd_produces_job_id'):
+            cmd = job.id + "=$(" + cmd + ")"
+        else:
+            cmd += "\n" + job.id + "=" + job.name
+        cmd = self.throttle_command(1, "$JOB_NAME") + cmd
+
+        # Write job parameters in job list file
+        cmd += "\necho \"$" + job.id + "\t$JOB_NAME\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH\" >> $JOB_LIST\n"
+
+        #add 0.2s sleep to let slurm submiting the job correctly
+        cmd += "\nsleep 0.2\n"
+
+        print cmd
+
+    def submit_job_array(self, pipeline, step, job_array):
+        # Dependencies on job arrays whose task i is the only dependency of task i of this job array
+        # are expressed with "aftercorr" on the whole job array, others with "afterok" on each array task
+        job_name_prefix = job_array.jobs[0].name.split(".")[0]
+        correlated_job_arrays = []
+        if config.param(job_name_prefix, 'cluster_dependency_arg').endswith("afterok:"):
+            for dependency_job_array in collections.OrderedDict.fromkeys([self._job_arrays[dependency_job] for job in job_array.jobs for dependency_job in job.dependency_jobs if dependency_job in self._job_arrays]):
+                if len(dependency_job_array.jobs) == len(job_array.jobs) and all([[dependency_job for dependency_job in job.dependency_jobs if dependency_job in dependency_job_array.jobs] == [dependency_job_array.jobs[i]] for i, job in enumerate(job_array.jobs)]):
+                    correlated_job_arrays.append(dependency_job_array)
+        dependency_jobs = [dependency_job for dependency_job in collections.OrderedDict.fromkeys([dependency_job for job in job_array.jobs for dependency_job in job.dependency_jobs]) if self._job_arrays.get(dependency_job) not in correlated_job_arrays]
 
-                    # Write job parameters in job list file
-                    cmd += "\necho \"$" + job.id + "\t$JOB_NAME\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH\" >> $JOB_LIST\n"
+        print("""
+{separator_line}
+# JOB ARRAY: {job_array.id}: {job_array.name}
+{job_ids}
+{separator_line}
+ARRAY_NAME={job_array.name}
+{job_dependencies}
+ARRAY_OUTPUT_RELATIVE_PATH=$STEP/${{ARRAY_NAME}}_$TIMESTAMP
+ARRAY_SCRIPT=$JOB_OUTPUT_DIR/$ARRAY_OUTPUT_RELATIVE_PATH.sh
+cat > $ARRAY_SCRIPT << {limit_string}
+#! /bin/bash
+JOB_OUTPUT_DIR=$JOB_OUTPUT_DIR
+ARRAY_OUTPUT_RELATIVE_PATH=$ARRAY_OUTPUT_RELATIVE_PATH
+{limit_string}
+cat >> $ARRAY_SCRIPT << '{limit_string}'
+{array_commands}
+{limit_string}""".format(
+                job_array=job_array,
+                job_ids="\n".join(["#   " + str(i + 1) + ": " + job.id + ": " + job.name for i, job in enumerate(job_array.jobs)]),
+                job_dependencies=self.job_dependencies(dependency_jobs),
+                separator_line=separator_line,
+                array_commands=self.array_commands(pipeline, step, job_array),
+                limit_string=job_array.name.upper()
+            )
+        )
 
-                    #add 0.2s sleep to let slurm submiting the job correctly
-                    cmd += "\nsleep 0.2\n"
+        cmd = \
+            config.param(job_name_prefix, 'cluster_submit_cmd') + " " + \
+            config.param(job_name_prefix, 'cluster_other_arg') + " " + \
+            config.param(job_name_prefix, 'cluster_work_dir_arg') + " $OUTPUT_DIR " + \
+            config.param(job_name_prefix, 'cluster_output_dir_arg') + " $JOB_OUTPUT_DIR/$ARRAY_OUTPUT_RELATIVE_PATH.%a.o " + \
+            config.param(job_name_prefix, 'cluster_job_name_arg') + " $ARRAY_NAME " + \
+            self.cluster_param(job_array.jobs[0], 'cluster_walltime') + " " + \
+            self.cluster_param(job_array.jobs[0], 'cluster_queue') + " " + \
+            self.cluster_param(job_array.jobs[0], 'cluster_cpu') + \
+            self.priority_arg(job_array.jobs) + \
+            " --array=1-" + str(len(job_array.jobs))
+        if dependency_jobs or correlated_job_arrays:
+            cmd += " " + self.array_dependency_arg(job_name_prefix, dependency_jobs, correlated_job_arrays) + "$JOB_DEPENDENCIES"
+        cmd += " $ARRAY_SCRIPT " + config.param(job_name_prefix, 'cluster_submit_cmd_suffix')
+        cmd = self.throttle_command(len(job_array.jobs), "$ARRAY_NAME") + job_array.id + "=$(" + cmd + ")"
+
+        # Array tasks are identified by "<array job ID>_<task ID>" and written in job list file as any other job
+        for i, job in enumerate(job_array.jobs):
+            cmd += "\n" + job.id + "=${" + job_array.id + "}_" + str(i + 1)
+            cmd += "\necho \"$" + job.id + "\t" + job.name + "\t" + ":".join(["$" + dependency_job.id for dependency_job in job.dependency_jobs]) + "\t$ARRAY_OUTPUT_RELATIVE_PATH." + str(i + 1) + ".o\" >> $JOB_LIST"
+            self._job_arrays[job] = job_array
+
+        #add 0.2s sleep to let slurm submiting the job correctly
+        cmd += "\n\nsleep 0.2\n"
+
+        print cmd
+
+    # Return the commands of the job array script, running the job of the current array task
+    def array_commands(self, pipeline, step, job_array):
+        if pipeline.args.job_scripts:
+            # Job scripts already include the prologue and epilogue
+            return """\
+JOB_OUTPUT=$JOB_OUTPUT_DIR/$ARRAY_OUTPUT_RELATIVE_PATH.$SLURM_ARRAY_TASK_ID.o
+case $SLURM_ARRAY_TASK_ID in
+{array_tasks}
+*)
+echo "Error: array task $SLURM_ARRAY_TASK_ID does not exist!"
+exit 1
+;;
+esac
+export JOB_OUTPUT
+exec bash $JOB_SCRIPT""".format(
+                array_tasks="\n".join([str(i + 1) + ") JOB_SCRIPT=$JOB_OUTPUT_DIR/" + step.name + "/" + self.write_job_script(pipeline, step, job) + " ;;" for i, job in enumerate(job_array.jobs)])
+            )
 
-                    print cmd
+        return """\
+echo '#######################################'
+echo 'SLURM FAKE PROLOGUE (MUGQIC)'
+date
+scontrol show job $SLURM_JOBID
+sstat -j $SLURM_JOBID.batch
+echo '#######################################'
+JOB_OUTPUT=$JOB_OUTPUT_DIR/$ARRAY_OUTPUT_RELATIVE_PATH.$SLURM_ARRAY_TASK_ID.o
+case $SLURM_ARRAY_TASK_ID in
+{array_tasks}
+*)
+echo "Error: array task $SLURM_ARRAY_TASK_ID does not exist!"
+exit 1
+;;
+esac
+echo '#######################################'
+echo 'SLURM FAKE EPILOGUE (MUGQIC)'
+date
+scontrol show job $SLURM_JOBID
+sstat -j $SLURM_JOBID.batch
+echo '#######################################'
+exit $MUGQIC_STATE""".format(
+            array_tasks="\n".join(["""\
+{task_id})
+JOB_NAME={job.name}
+JOB_DONE={job.done}
+rm -f $JOB_DONE && {job2json_start} {job.command_with_modules}
+MUGQIC_STATE=$PIPESTATUS
+echo MUGQICexitStatus:$MUGQIC_STATE
+{job2json_end}
+if [ $MUGQIC_STATE -eq 0 ] ; then {job_done_command} ; fi
+;;""".format(
+                task_id=i + 1,
+                job=job,
+                job_done_command=self.job_done_command(pipeline, job),
+                job2json_start=self.job2json(pipeline, step, job, '"running"', quote='"'),
+                job2json_end=self.job2json(pipeline, step, job, '$MUGQIC_STATE', quote='"')
+            ) for i, job in enumerate(job_array.jobs)])
+        )
 
-        # Check cluster maximum job submission
-        cluster_max_jobs = config.param('DEFAULT', 'cluster_max_jobs', type='posint', required=False)
-        if cluster_max_jobs and len(pipeline.jobs) > cluster_max_jobs:
-            log.warning("Number of jobs: " + str(len(pipeline.jobs)) + " > Cluster maximum number of jobs: " + str(cluster_max_jobs) + "!")
+    # Job script content with the same job commands as the ones echoed to the submit command above
+    def job_script(self, pipeline, step, job):
+        return """\
+#!/bin/bash
+JOB_NAME={job.name}
+JOB_DONE={job.done}
+echo '#######################################'
+echo 'SLURM FAKE PROLOGUE (MUGQIC)'
+date
+scontrol show job $SLURM_JOBID
+sstat -j $SLURM_JOBID.batch
+echo '#######################################'
+rm -f $JOB_DONE && {job2json_start} {job.command_with_modules}
+MUGQIC_STATE=$PIPESTATUS
+echo MUGQICexitStatus:$MUGQIC_STATE
+{job2json_end}
+if [ $MUGQIC_STATE -eq 0 ] ; then {job_done_command} ; fi
+echo '#######################################'
+echo 'SLURM FAKE EPILOGUE (MUGQIC)'
+date
+scontrol show job $SLURM_JOBID
+sstat -j $SLURM_JOBID.batch
+echo '#######################################'
+exit $MUGQIC_STATE
+""".format(
+            job=job,
+            job_done_command=self.job_done_command(pipeline, job),
+            job2json_start=self.job2json(pipeline, step, job, '"running"', quote='"'),
+            job2json_end=self.job2json(pipeline, step, job, '$MUGQIC_STATE', quote='"')
+        )
 
+    # Return the cluster dependency argument for the given dependency jobs and correlated job arrays,
+    # to be followed by $JOB_DEPENDENCIES
+    def array_dependency_arg(self, job_name_prefix, dependency_jobs, correlated_job_arrays):
+        dependency_arg = config.param(job_name_prefix, 'cluster_dependency_arg')
+        if not correlated_job_arrays:
+            return dependency_arg
+        # e.g. "--depend=afterok:$JOB_DEPENDENCIES" becomes "--depend=aftercorr:$ARRAY_1_JOB_ID,afterok:$JOB_DEPENDENCIES"
+        aftercorr = "aftercorr:" + ":".join(["$" + job_array.id for job_array in correlated_job_arrays])
+        if dependency_jobs:
+            return dependency_arg[:-len("afterok:")] + aftercorr + ",afterok:"
+        else:
+            return dependency_arg[:-len("afterok:")] + aftercorr
+
+# Return a duration in seconds as "[<days>d ]<hours>:<minutes>:<seconds>"
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return (str(seconds // 86400) + "d " if seconds >= 86400 else "") + "%d:%02d:%02d" % (seconds % 86400 // 3600, seconds % 3600 // 60, seconds % 60)
+
+# Jobs of the same step submitted as a single Slurm job array, task i+1 running jobs[i]
+class SlurmJobArray:
+    def __init__(self, step, number, jobs):
+        self.name = step.name + "_array_" + str(number)
+        self.id = step.name + "_ARRAY_" + str(number) + "_JOB_ID"
+        self.jobs = jobs
 
 class DaemonScheduler(Scheduler):
     def submit(self, pipeline):
@@ -392,9 +901,9 @@ class DaemonScheduler(Scheduler):
                             'cluster_work_dir_arg': config.param(job.name.split(".")[0], 'cluster_work_dir_arg') + " " + pipeline.output_dir,
                             'cluster_output_dir_arg': config.param(job.name.split(".")[0], 'cluster_output_dir_arg') + " " + os.path.join(pipeline.output_dir, "job_output", step.name, job.name + ".o"),
                             'cluster_job_name_arg': config.param(job.name.split(".")[0], 'cluster_job_name_arg') + " " + job.name,
-                            'cluster_walltime': config.param(job.name.split(".")[0], 'cluster_walltime'),
-                            'cluster_queue': config.param(job.name.split(".")[0], 'cluster_queue'),
-                            'cluster_cpu': config.param(job.name.split(".")[0], 'cluster_cpu')
+                            'cluster_walltime': self.cluster_param(job, 'cluster_walltime'),
+                            'cluster_queue': self.cluster_param(job, 'cluster_queue'),
+                            'cluster_cpu': self.cluster_param(job, 'cluster_cpu')
                         },
                         "job_done": job.done
                     } for job in step.jobs]
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+################################################################################
+# Copyright (C) 2014, 2015 GenAP, McGill University and Genome Quebec Innovation Centre
+#
+# This file is part of MUGQIC Pipelines.
+#
+# MUGQIC Pipelines is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MUGQIC Pipelines is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with MUGQIC Pipelines.  If not, see <http://www.gnu.org/licenses/>.
+################################################################################
+
+# Python Standard Modules
+import collections
+import logging
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+# Return the (lstat, stat) results of a path, None meaning that the path does not exist
+# stat is only called for symbolic links, otherwise both results are identical
+def stat_path(path):
+    try:
+        path_lstat = os.lstat(path)
+    except OSError:
+        return None, None
+    if stat.S_ISLNK(path_lstat.st_mode):
+        try:
+            return path_lstat, os.stat(path)
+        except OSError:
+            # Broken symbolic link
+            return path_lstat, None
+    return path_lstat, path_lstat
+
+# Minimal stat result restored from a previous pipeline run (see core/job_manifest.py)
+class FileStat(object):
+
+    def __init__(self, st_mode, st_size, st_mtime):
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+
+# Cache of file system stats by absolute path, shared by all jobs of a pipeline
+# since files are not expected to change while jobs are being planned
+class StatCache(object):
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._stats = {}
+        self._stat_count = 0
+        self._hit_count = 0
+
+    # Number of paths actually stat'ed on file system
+    @property
+    def stat_count(self):
+        return self._stat_count
+
+    # Number of path lookups served from the cache
+    @property
+    def hit_count(self):
+        return self._hit_count
+
+    def _stat(self, path):
+        if path in self._stats:
+            self._hit_count += 1
+        else:
+            self._stat_count += 1
+            self._stats[path] = stat_path(path)
+        return self._stats[path]
+
+    # Like os.path.exists: symbolic links are followed
+    def exists(self, path):
+        return self._stat(path)[1] is not None
+
+    # Like os.lstat, but return None if path does not exist
+    def lstat(self, path):
+        return self._stat(path)[0]
+
+    # Like os.stat, but return None if path does not exist
+    def stat(self, path):
+        path_stat = self._stat(path)[1]
+        if path_stat and stat.S_ISLNK(path_stat.st_mode):
+            # Symbolic link restored from a previous pipeline run, whose target was not stat'ed
+            self._stat_count += 1
+            self._stats[path] = stat_path(path)
+            path_stat = self._stats[path][1]
+        return path_stat
+
+    # Like os.path.getsize, but return None if path does not exist: symbolic links are followed
+    def size(self, path):
+        path_stat = self.stat(path)
+        return path_stat.st_size if path_stat else None
+
+    # Return the (path, lstat, exists) tuples of all cached paths
+    def entries(self):
+        return [(path, stats[0], stats[1] is not None) for path, stats in self._stats.items()]
+
+    # Add a path stat known from elsewhere, without stat'ing it on file system
+    def prime(self, path, path_lstat, exists):
+        if path not in self._stats:
+            self._stats[path] = (path_lstat, path_lstat if exists else None)
+
+    # Stat concurrently all the given paths not cached yet, using a pool of threads
+    def prefetch(self, paths, threads):
+        new_paths = [path for path in collections.OrderedDict.fromkeys(paths) if path not in self._stats]
+        if threads > 1 and len(new_paths) > 1:
+            pool = ThreadPool(min(threads, len(new_paths)))
+            try:
+                stats = pool.map(stat_path, new_paths)
+            finally:
+                pool.close()
+                pool.join()
+            self._stats.update(zip(new_paths, stats))
+            self._stat_count += len(new_paths)
+            log.debug("Prefetched " + str(len(new_paths)) + " file stats with " + str(threads) + " threads")
+
+# Global stat cache object used throughout the whole pipeline
+stat_cache = StatCache()
@@ -37,6 +37,10 @@ class Step:
         self._jobs = []
         self._analyse_type = analyse_type
 
+        # Index of job positions in self.jobs by output file, maintained by add_job(),
+        # so that dependency lookup does not need to scan all step jobs
+        self._output_file_jobs = {}
+
     @property
     def name(self):
         return self._name
@@ -56,3 +60,21 @@ class Step:
     def add_job(self, job):
         self.jobs.append(job)
         job.id = self.name + "_" + str(len(self.jobs)) + "_JOB_ID"
+
+        for output_file in job.output_files:
+            self._output_file_jobs.setdefault(output_file, []).append(len(self.jobs) - 1)
+
+    # Return True if the given file is an output file of any step job
+    def produces(self, file):
+        return file in self._output_file_jobs
+
+    # Return the step jobs producing any of the given files, ordered as in self.jobs,
+    # along with the subset of the given files which are produced by these jobs
+    def producer_jobs(self, files):
+        job_positions = set()
+        produced_files = set()
+        for file in files:
+            if file in self._output_file_jobs:
+                job_positions.update(self._output_file_jobs[file])
+                produced_files.add(file)
+        return [self.jobs[position] for position in sorted(job_positions)], produced_files
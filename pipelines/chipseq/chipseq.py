@@ -195,7 +195,7 @@ pandoc --to=markdown \\
                     mkdir_job,
                     Job([readset_bam], [sample_bam], command="ln -s -f " + target_readset_bam + " " + sample_bam, removable_files=[sample_bam]),
                 ])
-                job.sample = [sample]
+                job.samples = [sample]
                 job.name = "symlink_readset_sample_bam." + sample.name
 
             elif len(sample.readsets) > 1:
@@ -203,7 +203,7 @@ pandoc --to=markdown \\
                     mkdir_job,
                     picard.merge_sam_files(readset_bams, sample_bam)
                 ])
-                job.sample = [sample]
+                job.samples = [sample]
                 job.name = "picard_merge_sam_files." + sample.name
 
             jobs.append(job)
@@ -226,7 +226,7 @@ pandoc --to=markdown \\
 
             job = picard.mark_duplicates([input], output, metrics_file)
             job.name = "picard_mark_duplicates." + sample.name
-            job.sample = [sample]
+            job.samples = [sample]
             jobs.append(job)
 
         report_file = os.path.join(self.output_dirs['report_output_directory'], "ChipSeq.picard_mark_duplicates.md")
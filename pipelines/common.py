@@ -108,7 +108,7 @@ wget "{server}?{request}&md5=$LOG_MD5" --quiet --output-document=/dev/null
 
     def submit_jobs(self):
         super(MUGQICPipeline, self).submit_jobs()
-        if self.jobs and self.args.job_scheduler in ["pbs", "batch", "slurm"]:
+        if self.jobs and self.args.job_scheduler in ["pbs", "batch", "slurm", "local"]:
             self.mugqic_log()
 
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+### test_cluster_submit_throttle
+### Test the throttled submission scripts of the Slurm and PBS job schedulers ("cluster_submit_throttle=true")
+### run with fake sbatch and qsub commands and a stub queue count command returning a scripted sequence of counts
+
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+MUGQIC_PIPELINES_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Maximum number of jobs in the cluster queue
+CLUSTER_MAX_JOBS = 3
+
+# Pipeline of 6 independent alignment jobs, 3 merge jobs of 2 alignments each and a report job of all merges
+PIPELINE = """\
+#!/usr/bin/env python
+import sys
+sys.path.append("{mugqic_pipelines_dir}")
+
+from core.job import Job
+from core.pipeline import Pipeline
+
+class ThrottleTest(Pipeline):
+    def __init__(self):
+        self.version = "test"
+        self._protocol = None
+        Pipeline.__init__(self)
+
+    def align(self):
+        return [Job(["input.txt"], ["align/S%d.txt" % i], name="align.S%d" % i, command="cp input.txt align/S%d.txt" % i) for i in range(1, 7)]
+
+    def merge(self):
+        return [Job(["align/S%d.txt" % (2 * i - 1), "align/S%d.txt" % (2 * i)], ["merge/P%d.txt" % i], name="merge.P%d" % i, command="cat align/S%d.txt align/S%d.txt > merge/P%d.txt" % (2 * i - 1, 2 * i, i)) for i in range(1, 4)]
+
+    def report(self):
+        return [Job(["merge/P%d.txt" % i for i in range(1, 4)], ["report.txt"], name="report", command="cat merge/P*.txt > report.txt")]
+
+    @property
+    def steps(self):
+        return [self.align, self.merge, self.report]
+
+ThrottleTest()
+"""
+
+EXPECTED_DEPENDENCIES = dict(
+    [("align.S%d" % i, []) for i in range(1, 7)] +
+    [("merge.P%d" % i, ["align.S%d" % (2 * i - 1), "align.S%d" % (2 * i)]) for i in range(1, 4)] +
+    [("report", ["merge.P1", "merge.P2", "merge.P3"])]
+)
+
+CONFIGS = {
+    'slurm': """\
+[DEFAULT]
+cluster_submit_cmd=sbatch
+cluster_submit_cmd_suffix= | grep "[0-9]" | cut -d\\  -f4
+cluster_walltime=--time=1:00:00
+cluster_cpu=-N 1 -n 1
+cluster_other_arg=--mail-type=NONE
+cluster_queue=--mem=1G
+cluster_work_dir_arg=-D
+cluster_output_dir_arg=-o
+cluster_job_name_arg=-J
+cluster_cmd_produces_job_id=true
+cluster_dependency_arg=--depend=afterok:
+""",
+    'pbs': """\
+[DEFAULT]
+cluster_submit_cmd=qsub
+cluster_submit_cmd_suffix= | grep "[0-9]"
+cluster_walltime=-l walltime=1:00:0
+cluster_cpu=-l nodes=1:ppn=1
+cluster_other_arg=-m n
+cluster_queue=-q sw
+cluster_work_dir_arg=-d
+cluster_output_dir_arg=-j oe -o
+cluster_job_name_arg=-N
+cluster_cmd_produces_job_id=true
+cluster_dependency_arg=-W depend=afterok:
+"""
+}
+
+THROTTLE_CONFIG = """\
+cluster_max_jobs={cluster_max_jobs}
+cluster_submit_throttle=true
+cluster_submit_throttle_interval=1
+cluster_queue_count_cmd={fake_cluster_dir}/queue_count
+"""
+
+# Fake submission commands log "submit <job ID> <job name> <dependency job IDs>" events and print their job ID;
+# the stub queue count command logs "poll <count>" events and prints the next scripted count, then 0
+FAKE_COMMANDS = {
+    'sbatch': """\
+#!/bin/bash
+cat > /dev/null
+NAME="" ; DEPENDENCIES=""
+while [ $# -gt 0 ] ; do
+  case $1 in
+    -J) NAME=$2 ; shift ;;
+    --depend=afterok:*) DEPENDENCIES=${1#--depend=afterok:} ;;
+  esac
+  shift
+done
+JOB_ID=$(cat $FAKE_CLUSTER_DIR/next_job_id)
+echo $(( JOB_ID + 1 )) > $FAKE_CLUSTER_DIR/next_job_id
+echo "submit $JOB_ID $NAME $DEPENDENCIES" >> $FAKE_CLUSTER_DIR/events
+echo "Submitted batch job $JOB_ID"
+""",
+    'qsub': """\
+#!/bin/bash
+cat > /dev/null
+NAME="" ; DEPENDENCIES=""
+while [ $# -gt 0 ] ; do
+  case $1 in
+    -N) NAME=$2 ; shift ;;
+    -W) [[ $2 == depend=afterok:* ]] && DEPENDENCIES=${2#depend=afterok:} ; shift ;;
+  esac
+  shift
+done
+JOB_ID=$(cat $FAKE_CLUSTER_DIR/next_job_id)
+echo $(( JOB_ID + 1 )) > $FAKE_CLUSTER_DIR/next_job_id
+echo "submit $JOB_ID.fake $NAME $DEPENDENCIES" >> $FAKE_CLUSTER_DIR/events
+echo "$JOB_ID.fake"
+""",
+    'queue_count': """\
+#!/bin/bash
+COUNTS=($(cat $FAKE_CLUSTER_DIR/queue_counts))
+COUNT=${COUNTS[0]:-0}
+echo "${COUNTS[@]:1}" > $FAKE_CLUSTER_DIR/queue_counts
+echo "poll $COUNT" >> $FAKE_CLUSTER_DIR/events
+echo $COUNT
+"""
+}
+
+# Queue counts returned by successive polls: the first submissions wait for 2 polls, later ones for 1 more
+QUEUE_COUNTS = [3, 1, 2, 0, 3, 0]
+
+class ClusterSubmitThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="test_cluster_submit_throttle.")
+        self.fake_cluster_dir = os.path.join(self.work_dir, "cluster")
+        self.output_dir = os.path.join(self.work_dir, "output")
+        for directory in [os.path.join(self.work_dir, "bin"), self.fake_cluster_dir, self.output_dir]:
+            os.makedirs(directory)
+
+        for command, content in FAKE_COMMANDS.items():
+            command_path = os.path.join(self.fake_cluster_dir if command == 'queue_count' else os.path.join(self.work_dir, "bin"), command)
+            with open(command_path, 'w') as command_file:
+                command_file.write(content)
+            os.chmod(command_path, 0755)
+        with open(os.path.join(self.fake_cluster_dir, "next_job_id"), 'w') as next_job_id_file:
+            next_job_id_file.write("1001\n")
+        with open(os.path.join(self.fake_cluster_dir, "queue_counts"), 'w') as queue_counts_file:
+            queue_counts_file.write(" ".join([str(count) for count in QUEUE_COUNTS]) + "\n")
+
+        with open(os.path.join(self.work_dir, "throttle_test.py"), 'w') as pipeline_file:
+            pipeline_file.write(PIPELINE.format(mugqic_pipelines_dir=MUGQIC_PIPELINES_DIR))
+        open(os.path.join(self.output_dir, "input.txt"), 'w').close()
+
+        self.environment = dict(os.environ,
+            PATH=os.path.join(self.work_dir, "bin") + os.pathsep + os.environ.get('PATH', ""),
+            FAKE_CLUSTER_DIR=self.fake_cluster_dir
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    # Create the job submission script of the test pipeline with the given job scheduler, then run it
+    def submit(self, scheduler):
+        config_file = os.path.join(self.work_dir, scheduler + ".ini")
+        with open(config_file, 'w') as config:
+            config.write(CONFIGS[scheduler] + THROTTLE_CONFIG.format(cluster_max_jobs=CLUSTER_MAX_JOBS, fake_cluster_dir=self.fake_cluster_dir))
+
+        submission_script = os.path.join(self.work_dir, scheduler + ".sh")
+        with open(submission_script, 'w') as script, open(os.devnull, 'w') as devnull:
+            subprocess.check_call([sys.executable, os.path.join(self.work_dir, "throttle_test.py"), "-c", config_file, "-s", "1-3", "-j", scheduler, "-o", self.output_dir], stdout=script, stderr=devnull, cwd=self.output_dir, env=self.environment)
+        with open(submission_script) as script:
+            self.assertEqual(script.read().count("\nmugqic_throttle 1 $JOB_NAME\n"), len(EXPECTED_DEPENDENCIES))
+
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(["bash", submission_script], stdout=devnull, stderr=devnull, cwd=self.output_dir, env=self.environment)
+
+    # Return the (event, arguments) tuples logged by the fake cluster commands
+    def events(self):
+        with open(os.path.join(self.fake_cluster_dir, "events")) as events_file:
+            return [(line.split()[0], line.split()[1:]) for line in events_file]
+
+    def check_submission(self):
+        events = self.events()
+        # Submissions as [job ID, job name, colon-separated dependency job IDs]
+        submissions = [(arguments + [""])[:3] for event, arguments in events if event == "submit"]
+        self.assertEqual(sorted([job_name for job_id, job_name, dependencies in submissions]), sorted(EXPECTED_DEPENDENCIES.keys()))
+        self.assertEqual([int(arguments[0]) for event, arguments in events if event == "poll"], QUEUE_COUNTS + [0])
+
+        # Jobs in the cluster queue: the polled count plus the jobs submitted since
+        queued_jobs = None
+        for event, arguments in events:
+            if event == "poll":
+                queued_jobs = int(arguments[0])
+            else:
+                self.assertIsNotNone(queued_jobs, "job " + arguments[1] + " submitted before polling the queue")
+                queued_jobs += 1
+                self.assertLessEqual(queued_jobs, CLUSTER_MAX_JOBS, "job " + arguments[1] + " submitted with " + str(queued_jobs - 1) + " queued jobs")
+
+        # Dependencies are submitted first, with the job IDs returned by the submission command
+        job_names = {}
+        for job_id, job_name, dependencies in submissions:
+            self.assertEqual(sorted([job_names.get(dependency_id) for dependency_id in dependencies.split(":") if dependency_id]), EXPECTED_DEPENDENCIES[job_name])
+            job_names[job_id] = job_name
+
+        # The job list has the job IDs and dependencies of all submitted jobs
+        job_lists = glob.glob(os.path.join(self.output_dir, "job_output", "ThrottleTest_job_list_*"))
+        self.assertEqual(len(job_lists), 1)
+        with open(job_lists[0]) as job_list:
+            job_list_entries = [line.rstrip("\n").split("\t") for line in job_list]
+        self.assertEqual([entry[:3] for entry in job_list_entries], submissions)
+        for job_id, job_name, dependencies, job_output in job_list_entries:
+            self.assertTrue(job_output.startswith(job_name.split(".")[0] + "/" + job_name + "_"))
+
+    def test_slurm(self):
+        self.submit("slurm")
+        self.check_submission()
+
+    def test_pbs(self):
+        self.submit("pbs")
+        self.check_submission()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+### test_job_retry
+### Test utils/job_retry.py on a hand-written Slurm job submission script, job list and job logs,
+### with fake sbatch, sacct and scancel commands
+
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# MUGQIC Modules
+from core.scheduler import separator_line
+
+JOB_RETRY = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utils", "job_retry.py")
+
+# Jobs of the submission script as (step, job ID variable, job name, dependency job ID variables, cluster resources)
+JOBS = [
+    ("trim", "trim_1_JOB_ID", "trim.S1", [], "--time=24:00:00 --mem=24G"),
+    ("trim", "trim_2_JOB_ID", "trim.S2", [], "--time=24:00:00 --mem=24G"),
+    ("merge_trim_stats", "merge_trim_stats_1_JOB_ID", "merge_trim_stats", ["trim_1_JOB_ID", "trim_2_JOB_ID"], "--time=24:00:00 --mem=4G"),
+    ("align", "align_1_JOB_ID", "align.S1", ["trim_1_JOB_ID"], "--time=96:00:00 --mem=60G"),
+    ("align", "align_2_JOB_ID", "align.S2", ["trim_2_JOB_ID"], "--time=96:00:00 --mem=60G"),
+    ("qc", "qc_1_JOB_ID", "qc.S1", [], "--time=24:00:00 --mem=8G")
+]
+
+# Job IDs and timestamp of the job list written by the submission script
+JOB_IDS = dict([(job_name, str(1001 + index)) for index, (step, job_id_variable, job_name, dependencies, resources) in enumerate(JOBS)])
+TIMESTAMP = "2019-06-01T10.00.00"
+
+# Job logs of the submission: trim.S1 runs out of memory, trim.S2 is done, align.S2 runs out of walltime and qc.S1 fails,
+# while merge_trim_stats and align.S1, depending on trim.S1, are still queued
+JOB_LOGS = {
+    "trim.S1": "slurmstepd: error: Detected 1 oom-kill event(s) in step 1001.batch cgroup.\nMUGQICexitStatus:137\n",
+    "trim.S2": "MUGQICexitStatus:0\n",
+    "align.S2": "slurmstepd: error: *** JOB 1005 ON cdr42 CANCELLED AT 2019-06-02T10:00:00 DUE TO TIME LIMIT ***\n",
+    "qc.S1": "MUGQICexitStatus:1\n"
+}
+
+# Job states reported by sacct: the out of memory failure of trim.S1 is only found in its log
+JOB_STATES = {
+    "trim.S1": "FAILED",
+    "trim.S2": "COMPLETED",
+    "merge_trim_stats": "PENDING",
+    "align.S1": "PENDING",
+    "align.S2": "TIMEOUT",
+    "qc.S1": "FAILED"
+}
+
+# Fake Slurm commands: sbatch logs its job ID and arguments, sacct prints the job states of a file, scancel logs its arguments
+FAKE_COMMANDS = {
+    'sbatch': """\
+#!/bin/bash
+cat > /dev/null
+JOB_ID=$(( $(cat $FAKE_SLURM_DIR/next_job_id) ))
+echo $(( JOB_ID + 1 )) > $FAKE_SLURM_DIR/next_job_id
+echo "$JOB_ID $@" >> $FAKE_SLURM_DIR/sbatch.log
+echo "Submitted batch job $JOB_ID"
+""",
+    'sacct': """\
+#!/bin/bash
+cat $FAKE_SLURM_DIR/states
+""",
+    'scancel': """\
+#!/bin/bash
+echo "$@" >> $FAKE_SLURM_DIR/scancel.log
+"""
+}
+
+# Return a Slurm job submission script of the jobs, as written by the Slurm scheduler
+def submission_script(output_dir):
+    lines = [
+        "#!/bin/bash",
+        "# Exit immediately on error",
+        "set -eu -o pipefail",
+        "",
+        separator_line,
+        "# Test SlurmScheduler Job Submission Bash script",
+        "# Version: test",
+        "# Created on: 2019-06-01T10:00:00",
+        "#   TOTAL: " + str(len(JOBS)) + " jobs",
+        separator_line,
+        "",
+        "OUTPUT_DIR=" + output_dir,
+        "JOB_OUTPUT_DIR=$OUTPUT_DIR/job_output",
+        "TIMESTAMP=`date +%FT%H.%M.%S`",
+        "JOB_LIST=$JOB_OUTPUT_DIR/Test_job_list_$TIMESTAMP",
+        "mkdir -p $OUTPUT_DIR",
+        "cd $OUTPUT_DIR"
+    ]
+    step = None
+    for job_step, job_id_variable, job_name, dependencies, resources in JOBS:
+        if job_step != step:
+            step = job_step
+            lines += ["", "", separator_line, "# STEP: " + step, separator_line, "STEP=" + step, "mkdir -p $JOB_OUTPUT_DIR/$STEP"]
+        lines += [
+            "",
+            "",
+            separator_line,
+            "# JOB: " + job_id_variable + ": " + job_name,
+            separator_line,
+            "JOB_NAME=" + job_name,
+            "JOB_DEPENDENCIES=" + ":".join(["$" + dependency for dependency in dependencies]),
+            "JOB_DONE=job_output/" + step + "/" + job_name + ".mugqic.done",
+            "JOB_OUTPUT_RELATIVE_PATH=$STEP/${JOB_NAME}_$TIMESTAMP.o",
+            "JOB_OUTPUT=$JOB_OUTPUT_DIR/$JOB_OUTPUT_RELATIVE_PATH",
+            job_id_variable + "=$(echo \"#! /bin/bash",
+            "rm -f $JOB_DONE && touch " + job_name + ".txt",
+            "MUGQIC_STATE=\\$PIPESTATUS",
+            "echo MUGQICexitStatus:\\$MUGQIC_STATE",
+            "if [ \\$MUGQIC_STATE -eq 0 ] ; then touch $JOB_DONE ; fi",
+            "exit \\$MUGQIC_STATE\" | \\",
+            "sbatch -D $OUTPUT_DIR -o $JOB_OUTPUT -J $JOB_NAME " + resources + " -N 1 -n 1" + (" --depend=afterok:$JOB_DEPENDENCIES" if dependencies else "") + " | grep \"[0-9]\" | cut -d\\  -f4)",
+            "echo \"$" + job_id_variable + "\t$JOB_NAME\t$JOB_DEPENDENCIES\t$JOB_OUTPUT_RELATIVE_PATH\" >> $JOB_LIST",
+            "",
+            "sleep 0.2"
+        ]
+    return "\n".join(lines) + "\n"
+
+class JobRetryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp(prefix="test_job_retry.")
+        os.makedirs(os.path.join(cls.work_dir, "bin"))
+        for command, content in FAKE_COMMANDS.items():
+            with open(os.path.join(cls.work_dir, "bin", command), 'w') as command_file:
+                command_file.write(content)
+            os.chmod(os.path.join(cls.work_dir, "bin", command), 0755)
+
+        cls.fake_slurm_dir = os.path.join(cls.work_dir, "slurm")
+        cls.environment = dict(os.environ,
+            PATH=os.path.join(cls.work_dir, "bin") + os.pathsep + os.environ.get('PATH', ""),
+            FAKE_SLURM_DIR=cls.fake_slurm_dir
+        )
+        cls.output_dir = os.path.join(cls.work_dir, "output")
+        cls.submission_script = os.path.join(cls.work_dir, "test.sh")
+        with open(cls.submission_script, 'w') as script_file:
+            script_file.write(submission_script(cls.output_dir))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir)
+
+    # Write the job list, job logs and done files of the submitted jobs, the next job ID being 1001 + number of jobs
+    def setUp(self):
+        for path in [self.fake_slurm_dir, self.output_dir]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        os.makedirs(self.fake_slurm_dir)
+        with open(os.path.join(self.fake_slurm_dir, "next_job_id"), 'w') as next_job_id_file:
+            next_job_id_file.write(str(1001 + len(JOBS)) + "\n")
+
+        for step in set([job[0] for job in JOBS]):
+            os.makedirs(os.path.join(self.output_dir, "job_output", step))
+        with open(os.path.join(self.output_dir, "job_output", "Test_job_list_" + TIMESTAMP), 'w') as job_list_file:
+            for step, job_id_variable, job_name, dependencies, resources in JOBS:
+                job_list_file.write("\t".join([JOB_IDS[job_name], job_name, ":".join([JOB_IDS[job[2]] for job in JOBS if job[1] in dependencies]), step + "/" + job_name + "_" + TIMESTAMP + ".o"]) + "\n")
+        for job_name, job_log in JOB_LOGS.items():
+            self.write_log(job_name, job_log)
+        self.set_done("trim.S2")
+
+        self.job_ids = self.submitted_job_ids()
+        self.set_states(JOB_STATES)
+
+    def run_job_retry(self, submission_scripts, *args):
+        command = [sys.executable, JOB_RETRY] + [arg for submission_script in submission_scripts for arg in ["-s", submission_script]] + [arg for job_list in self.job_lists() for arg in ["-l", job_list]] + list(args)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=self.output_dir, env=self.environment)
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        # Job list files and job retry scripts are named after the current second
+        time.sleep(1)
+        return stdout, stderr
+
+    def job_lists(self):
+        return sorted(glob.glob(os.path.join(self.output_dir, "job_output", "Test_job_list_*")))
+
+    def retry_scripts(self):
+        return sorted(glob.glob(os.path.join(self.output_dir, "job_output", "Test_job_retry_*.sh")))
+
+    # Job (ID, log path) by job name of the job list files, later submissions overriding earlier ones
+    def job_runs(self):
+        job_runs = {}
+        for job_list in self.job_lists():
+            with open(job_list) as job_list_file:
+                for line in job_list_file:
+                    fields = line.rstrip("\n").split("\t")
+                    job_runs[fields[1]] = (fields[0], os.path.join(self.output_dir, "job_output", fields[3]))
+        return job_runs
+
+    def submitted_job_ids(self):
+        return dict([(job_name, job_id) for job_name, (job_id, log_path) in self.job_runs().items()])
+
+    # sbatch arguments by job name, in submission order
+    def sbatch_calls(self):
+        sbatch_log = os.path.join(self.fake_slurm_dir, "sbatch.log")
+        if not os.path.exists(sbatch_log):
+            return []
+        with open(sbatch_log) as sbatch_log_file:
+            return [(re.search(r"-J (\S+)", line).group(1), line.rstrip("\n")) for line in sbatch_log_file]
+
+    def scancel_calls(self):
+        scancel_log = os.path.join(self.fake_slurm_dir, "scancel.log")
+        if not os.path.exists(scancel_log):
+            return []
+        with open(scancel_log) as scancel_log_file:
+            return [line.split() for line in scancel_log_file]
+
+    def set_states(self, states):
+        with open(os.path.join(self.fake_slurm_dir, "states"), 'w') as states_file:
+            for job_name, state in states.items():
+                states_file.write(self.job_ids[job_name] + "|" + state + "\n")
+
+    # Write the log of the last run of a job
+    def write_log(self, job_name, job_log):
+        with open(self.job_runs()[job_name][1], 'w') as log_file:
+            log_file.write(job_log)
+
+    # Write the done file of a job, as a successful job would
+    def set_done(self, job_name):
+        step = [job[0] for job in JOBS if job[2] == job_name][0]
+        open(os.path.join(self.output_dir, "job_output", step, job_name + ".mugqic.done"), 'w').close()
+
+    def test_dry_run(self):
+        stdout, stderr = self.run_job_retry([self.submission_script], "-n")
+
+        self.assertIn("# Test SlurmScheduler Job Retry Bash script", stdout)
+        self.assertIn("scancel " + self.job_ids["merge_trim_stats"] + " " + self.job_ids["align.S1"] + " || true", stdout)
+        self.assertEqual(re.findall(r"^# JOB: \S+: (\S+)$", stdout, re.MULTILINE), ["trim.S1", "merge_trim_stats", "align.S1", "align.S2"])
+        self.assertIn("--mem=49152M", stdout)
+        self.assertIn("--time=192:00:00", stdout)
+        self.assertIn("out of memory: 24576 MB -> 49152 MB", stderr)
+        self.assertIn("out of walltime: 96:00:00 -> 192:00:00", stderr)
+        self.assertIn("Job qc.S1 (" + self.job_ids["qc.S1"] + ") failed, not retried", stderr)
+        # Nothing is written, cancelled or submitted
+        self.assertEqual(self.retry_scripts(), [])
+        self.assertEqual(self.scancel_calls(), [])
+        self.assertEqual(self.sbatch_calls(), [])
+
+    def test_retry(self):
+        self.run_job_retry([self.submission_script])
+
+        self.assertEqual(len(self.retry_scripts()), 1)
+        self.assertEqual(self.scancel_calls(), [[self.job_ids["merge_trim_stats"], self.job_ids["align.S1"]]])
+        retry_calls = self.sbatch_calls()
+        self.assertEqual([job_name for job_name, sbatch_args in retry_calls], ["trim.S1", "merge_trim_stats", "align.S1", "align.S2"])
+        retry_args = dict(retry_calls)
+        retry_job_ids = self.submitted_job_ids()
+
+        self.assertIn("--mem=49152M", retry_args["trim.S1"])
+        # Queued dependents depend on the retried job, and no longer on done jobs
+        self.assertIn("--depend=afterok:" + retry_job_ids["trim.S1"] + " ", retry_args["merge_trim_stats"] + " ")
+        self.assertIn("--depend=afterok:" + retry_job_ids["trim.S1"] + " ", retry_args["align.S1"] + " ")
+        self.assertIn("--mem=60G", retry_args["align.S1"])
+        # All dependencies of the job out of walltime are done
+        self.assertIn("--time=192:00:00", retry_args["align.S2"])
+        self.assertNotIn("--depend", retry_args["align.S2"])
+        # The failed job is not retried
+        self.assertEqual(retry_job_ids["qc.S1"], self.job_ids["qc.S1"])
+
+    def test_second_retry(self):
+        self.run_job_retry([self.submission_script])
+        retry_script = self.retry_scripts()[0]
+
+        # The retried trim.S1 runs out of memory again, its dependents are still queued
+        self.job_ids = self.submitted_job_ids()
+        self.write_log("trim.S1", JOB_LOGS["trim.S1"])
+        self.set_states({
+            "trim.S1": "OUT_OF_MEMORY",
+            "merge_trim_stats": "PENDING",
+            "align.S1": "PENDING",
+            "align.S2": "RUNNING"
+        })
+        self.run_job_retry([self.submission_script, retry_script])
+
+        self.assertEqual(len(self.retry_scripts()), 2)
+        self.assertEqual(self.scancel_calls()[-1], [self.job_ids["merge_trim_stats"], self.job_ids["align.S1"]])
+        retry_calls = self.sbatch_calls()[4:]
+        self.assertEqual([job_name for job_name, sbatch_args in retry_calls], ["trim.S1", "merge_trim_stats", "align.S1"])
+        retry_args = dict(retry_calls)
+        retry_job_ids = self.submitted_job_ids()
+        self.assertIn("--mem=98304M", retry_args["trim.S1"])
+        self.assertIn("--depend=afterok:" + retry_job_ids["trim.S1"] + " ", retry_args["align.S1"] + " ")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+### test_watch_portal_folder
+### Test utils/watch_portal_folder.py against a local stand-in of the portal HTTP server
+
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# MUGQIC Modules
+from utils import watch_portal_folder
+
+WATCH_PORTAL_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "utils", "watch_portal_folder.py")
+
+class PortalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), PortalRequestHandler)
+        # Received requests as (time, path, JSON body)
+        self.requests = []
+        # Responses as (status, delay in seconds) returned to the next requests, then 200 without delay
+        self.responses = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def paths(self):
+        return [path for request_time, path, body in self.requests]
+
+# Portal API stand-in: records each request and returns the next scripted response
+class PortalRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length'))))
+        with self.server.lock:
+            self.server.requests.append((time.time(), self.path, body))
+            status, delay = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        time.sleep(delay)
+        content = json.dumps({'ok': status == 200})
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', "application/json")
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        except IOError:
+            # Client timed out and closed the connection
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class WatchPortalFolderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="test_watch_portal_folder.")
+        self.watch_folder = os.path.join(self.work_dir, "watch")
+        self.cache_folder = os.path.join(self.work_dir, "cache")
+        os.makedirs(self.watch_folder)
+        os.makedirs(self.cache_folder)
+
+        self.server = PortalServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.options = watch_portal_folder.dotdict({
+            'watch_folder': self.watch_folder,
+            'cache_folder': self.cache_folder,
+            'url': self.server.url,
+            'threads': 2,
+            'retries': 3,
+            'retry_delay': 0.2,
+            'timeout': 1
+        })
+        self.options.session = watch_portal_folder.create_session(self.options.threads)
+        self.options.pool = watch_portal_folder.ThreadPool(self.options.threads)
+
+    def tearDown(self):
+        self.options.pool.close()
+        self.options.pool.join()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    # Write a sample JSON file as job2json.py does, with the given modification time
+    def write_sample_json(self, sample_name, document, mtime=None):
+        filepath = os.path.join(self.watch_folder, "user." + sample_name + "." + str(len(os.listdir(self.watch_folder))) + ".json")
+        with open(filepath, 'w') as sample_file:
+            json.dump(document, sample_file)
+        if mtime:
+            os.utime(filepath, (mtime, mtime))
+        return filepath
+
+    def write_cache(self, sample_name, document):
+        with open(os.path.join(self.cache_folder, sample_name + ".json"), 'w') as cache_file:
+            json.dump(document, cache_file)
+
+    def read_cache(self, sample_name):
+        with open(os.path.join(self.cache_folder, sample_name + ".json")) as cache_file:
+            return json.load(cache_file)
+
+    def sample_document(self, sample_name, status):
+        return {'sample_name': sample_name, 'pipeline': {'steps': [{'step_name': "trimmomatic", 'job': [{'job_name': "trimmomatic." + sample_name, 'status': status}]}]}}
+
+    def test_coalesce_sample_files(self):
+        now = time.time()
+        # The "success" file is the newest one
+        for status, mtime in [("running", now - 60), ("success", now), ("running", now - 30)]:
+            self.write_sample_json("S1", self.sample_document("S1", status), mtime)
+        self.write_sample_json("S2", self.sample_document("S2", "running"))
+
+        watch_portal_folder.run(self.options)
+
+        # A single request per sample, with the newest file
+        self.assertEqual(sorted(self.server.paths()), ["/api/samples/external-update/user"] * 2)
+        documents = dict([(body['sample_name'], body) for request_time, path, body in self.server.requests])
+        self.assertEqual(documents["S1"], self.sample_document("S1", "success"))
+        self.assertEqual(os.listdir(self.watch_folder), [])
+        self.assertEqual(self.read_cache("S1"), self.sample_document("S1", "success"))
+
+    def test_retry_with_backoff(self):
+        self.server.responses = [(503, 0), (429, 0), (500, 0)]
+        self.write_sample_json("S1", self.sample_document("S1", "running"))
+
+        watch_portal_folder.run(self.options)
+
+        self.assertEqual(self.server.paths(), ["/api/samples/external-update/user"] * 4)
+        request_times = [request_time for request_time, path, body in self.server.requests]
+        delays = [request_times[index + 1] - request_times[index] for index in range(3)]
+        # Delays are doubled from retry_delay
+        for delay, expected_delay in zip(delays, [0.2, 0.4, 0.8]):
+            self.assertGreaterEqual(delay, expected_delay * 0.9)
+            self.assertLess(delay, expected_delay * 2)
+        self.assertEqual(os.listdir(self.watch_folder), [])
+
+    def test_retry_diff_rejected_with_429(self):
+        self.write_cache("S1", self.sample_document("S1", "running"))
+        self.server.responses = [(429, 0)]
+        self.write_sample_json("S1", self.sample_document("S1", "success"))
+
+        watch_portal_folder.run(self.options)
+
+        self.assertEqual(self.server.paths(), ["/api/samples/external-update-diff/user"] * 2)
+        self.assertEqual(self.read_cache("S1"), self.sample_document("S1", "success"))
+
+    def test_diff_not_resent_after_server_error(self):
+        self.write_cache("S1", self.sample_document("S1", "running"))
+        self.server.responses = [(500, 0)]
+        self.write_sample_json("S1", self.sample_document("S1", "success"))
+
+        watch_portal_folder.run(self.options)
+
+        # The diff may have been applied: the full document is sent instead
+        self.assertEqual(self.server.paths(), ["/api/samples/external-update-diff/user", "/api/samples/external-update/user"])
+        self.assertEqual(self.server.requests[1][2], self.sample_document("S1", "success"))
+        self.assertEqual(os.listdir(self.watch_folder), [])
+        self.assertEqual(self.read_cache("S1"), self.sample_document("S1", "success"))
+
+    def test_diff_not_resent_after_read_timeout(self):
+        self.write_cache("S1", self.sample_document("S1", "running"))
+        self.server.responses = [(200, self.options.timeout + 0.5)]
+        self.write_sample_json("S1", self.sample_document("S1", "success"))
+
+        watch_portal_folder.run(self.options)
+
+        self.assertEqual(self.server.paths(), ["/api/samples/external-update-diff/user", "/api/samples/external-update/user"])
+        self.assertEqual(self.read_cache("S1"), self.sample_document("S1", "success"))
+
+    def test_full_document_fallback_failure(self):
+        self.write_cache("S1", self.sample_document("S1", "running"))
+        # The diff and all attempts of the full document fail
+        self.server.responses = [(500, 0)] * (self.options.retries + 2)
+        filepath = self.write_sample_json("S1", self.sample_document("S1", "success"))
+
+        watch_portal_folder.run(self.options)
+
+        self.assertEqual(self.server.paths(), ["/api/samples/external-update-diff/user"] + ["/api/samples/external-update/user"] * (self.options.retries + 1))
+        # The file is kept and the cache entry removed, so that the full document is sent next time
+        self.assertEqual(os.listdir(self.watch_folder), [os.path.basename(filepath)])
+        self.assertFalse(os.path.exists(os.path.join(self.cache_folder, "S1.json")))
+
+        watch_portal_folder.run(self.options)
+
+        self.assertEqual(self.server.paths()[-1], "/api/samples/external-update/user")
+        self.assertEqual(len(self.server.requests), self.options.retries + 3)
+        self.assertEqual(os.listdir(self.watch_folder), [])
+        self.assertEqual(self.read_cache("S1"), self.sample_document("S1", "success"))
+
+    # Run the watcher in its own process until the given number of requests is received and the folder is empty
+    def watch(self, args, request_count):
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen([sys.executable, WATCH_PORTAL_FOLDER, "-w", self.watch_folder, "-c", self.cache_folder, "-u", self.server.url, "-i", "1"] + args, stdout=devnull, stderr=devnull)
+        try:
+            # Files written once the watcher is started
+            time.sleep(0.5)
+            self.write_sample_json("S1", self.sample_document("S1", "running"))
+            self.write_sample_json("S2", self.sample_document("S2", "running"))
+            deadline = time.time() + 10
+            while (len(self.server.requests) < request_count or os.listdir(self.watch_folder)) and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            process.terminate()
+            process.wait()
+
+    def test_polling(self):
+        self.watch(["-p"], 2)
+
+        self.assertEqual(sorted([body['sample_name'] for request_time, path, body in self.server.requests]), ["S1", "S2"])
+        self.assertEqual(os.listdir(self.watch_folder), [])
+
+    def test_inotify(self):
+        self.watch(["-d", "0.2"], 2)
+
+        self.assertEqual(sorted([body['sample_name'] for request_time, path, body in self.server.requests]), ["S1", "S2"])
+        self.assertEqual(os.listdir(self.watch_folder), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+### benchmark_pipelines
+### Measure how pipeline job creation scales with cohort size on synthetic readsets, references and a stub 'module' command
+
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import getopt
+import tempfile
+import threading
+import time
+
+# mugqic_pipelines directory
+PIPELINES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "pipelines")
+
+# Benchmarked pipelines: whether readsets have a BED file, config files, step range covering all steps of the protocol and extra arguments.
+# Extra arguments may contain {design}, {chipseq_design} and {pairs} replaced by synthetic design and tumor pair files.
+BENCHMARKS = [
+    ('dnaseq', {'bed': False, 'config': ["dnaseq/dnaseq.base.ini"], 'steps': "1-34", 'args': ["-t", "mugqic"]}),
+    ('dnaseq_high_coverage', {'bed': True, 'config': ["dnaseq_high_coverage/dnaseq_high_coverage.base.ini"], 'steps': "1-15", 'args': []}),
+    ('tumor_pair', {'bed': True, 'config': ["dnaseq/dnaseq.base.ini", "tumor_pair/tumor_pair.base.ini"], 'steps': "1-44", 'args': ["-p", "{pairs}"]}),
+    ('rnaseq', {'bed': False, 'config': ["rnaseq/rnaseq.base.ini"], 'steps': "1-25", 'args': ["-d", "{design}"]}),
+    ('rnaseq_light', {'bed': False, 'config': ["rnaseq_light/rnaseq_light.base.ini"], 'steps': "1-6", 'args': ["-d", "{design}"]}),
+    ('rnaseq_denovo_assembly', {'bed': False, 'config': ["rnaseq_denovo_assembly/rnaseq_denovo_assembly.base.ini"], 'steps': "1-23", 'args': ["-d", "{design}"]}),
+    ('chipseq', {'bed': False, 'config': ["chipseq/chipseq.base.ini"], 'steps': "1-19", 'args': ["-d", "{chipseq_design}"]}),
+    ('methylseq', {'bed': False, 'config': ["methylseq/methylseq.base.ini"], 'steps': "1-13", 'args': []}),
+    ('hicseq', {'bed': False, 'config': ["hicseq/hicseq.base.ini"], 'steps': "1-16", 'args': ["-t", "hic", "-e", "DpnII"]}),
+    ('ampliconseq', {'bed': False, 'config': ["ampliconseq/ampliconseq.base.ini"], 'steps': "1-34", 'args': ["-t", "qiime", "-d", "{design}"]})
+]
+
+# Assemblies used by benchmarked pipeline configs
+ASSEMBLIES = [("Homo_sapiens", "GRCh37"), ("Homo_sapiens", "hg19")]
+
+# Chromosome lengths of the synthetic genome dictionary, so that jobs split by chromosome are as numerous as with a real genome
+CHROMOSOMES = [
+    ("1", 249250621), ("2", 243199373), ("3", 198022430), ("4", 191154276), ("5", 180915260), ("6", 171115067),
+    ("7", 159138663), ("8", 146364022), ("9", 141213431), ("10", 135534747), ("11", 135006516), ("12", 133851895),
+    ("13", 115169878), ("14", 107349540), ("15", 102531392), ("16", 90354753), ("17", 81195210), ("18", 78077248),
+    ("19", 59128983), ("20", 63025520), ("21", 48129895), ("22", 51304566), ("X", 155270560), ("Y", 59373566), ("MT", 16569)
+]
+
+def getarg(argument):
+    sample_counts = [10, 100, 1000]
+    pipelines = [name for name, benchmark in BENCHMARKS]
+    schedulers = ["batch"]
+    work_dir = ""
+    timeout = 3600
+    output = ""
+    keep = False
+
+    options, args = getopt.getopt(argument[1:], "n:p:j:t:w:o:kh", ['samples=', 'pipelines=', 'job_scheduler=', 'timeout=', 'work_dir=', 'output=', 'keep', 'help'])
+
+    for option, value in options:
+        if option in ("-n", "--samples"):
+            if not re.search("^\d+(,\d+)*$", str(value)) or 0 in [int(count) for count in str(value).split(",")]:
+                sys.exit("Error - samples (-n, --samples) must be a comma-separated list of positive integers\n")
+            else :
+                sample_counts = sorted(set([int(count) for count in str(value).split(",")]))
+        if option in ("-p", "--pipelines"):
+            unknown_pipelines = [name for name in str(value).split(",") if name not in dict(BENCHMARKS)]
+            if unknown_pipelines:
+                sys.exit("Error - pipelines (-p, --pipelines) " + ", ".join(unknown_pipelines) + " unknown, must be among: " + ", ".join([name for name, benchmark in BENCHMARKS]) + "\n")
+            else :
+                pipelines = str(value).split(",")
+        if option in ("-j", "--job_scheduler"):
+            if [scheduler for scheduler in str(value).split(",") if scheduler not in ["batch", "slurm", "pbs"]]:
+                sys.exit("Error - job_scheduler (-j, --job_scheduler) must be a comma-separated list of batch, slurm or pbs\n")
+            else :
+                schedulers = str(value).split(",")
+        if option in ("-t", "--timeout"):
+            if not str(value).isdigit() or int(value) < 1:
+                sys.exit("Error - timeout (-t, --timeout) must be a positive integer\n")
+            else :
+                timeout = int(value)
+        if option in ("-w", "--work_dir"):
+            if str(value) == "" :
+                sys.exit("Error - work_dir (-w, --work_dir) not provided...\n")
+            else :
+                work_dir = os.path.abspath(str(value))
+        if option in ("-o", "--output"):
+            output = str(value)
+        if option in ("-k", "--keep"):
+            keep = True
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit()
+
+    return sample_counts, pipelines, schedulers, timeout, work_dir, output, keep
+
+def usage():
+    print "\n-------------------------------------------------------------------------------------------"
+    print "benchmark_pipelines.py creates synthetic cohorts (readset files, design and tumor pair files, BED file,"
+    print "genome references and a stub 'module' command), runs the job creation of each pipeline on all its steps"
+    print "for each cohort size and job scheduler, and prints its wall time, peak memory, number of jobs and of job"
+    print "dependencies. The time exponent is the slope of log(time) over log(samples) from the previous cohort size:"
+    print "about 1 when job creation scales linearly, 2 or more when it scales quadratically. Once a pipeline times out,"
+    print "larger cohort sizes are skipped for it."
+    print "-------------------------------------------------------------------------------------------\n"
+    print "USAGE : benchmark_pipelines.py [option]"
+    print "       -n    --samples           : comma-separated cohort sizes in number of samples - Default : 10,100,1000"
+    print "       -p    --pipelines         : comma-separated pipelines among: " + ", ".join([name for name, benchmark in BENCHMARKS])
+    print "                                   Default : all"
+    print "       -j    --job_scheduler     : comma-separated job schedulers among batch, slurm, pbs - Default : batch"
+    print "       -t    --timeout           : maximum job creation time of a pipeline in seconds - Default : 3600"
+    print "       -w    --work_dir          : directory of synthetic inputs and pipeline outputs - Default : temporary directory"
+    print "       -o    --output            : JSON file where results are also written"
+    print "       -k    --keep              : keep the work directory"
+    print "       -h    --help              : this help \n"
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'a').close()
+
+# Stub 'module' command so that 'module load' commands of generated scripts or pipeline config checks succeed
+def create_module_command(work_dir):
+    module_command = os.path.join(work_dir, "bin", "module")
+    touch(module_command)
+    with open(module_command, 'w') as module_file:
+        module_file.write("#!/bin/bash\nexit 0\n")
+    os.chmod(module_command, 0755)
+
+# Genome FASTA, index, dictionary, BWA index and genome ini file of each assembly in a MUGQIC_INSTALL_HOME tree
+def create_references(install_home):
+    for scientific_name, assembly in ASSEMBLIES:
+        assembly_dir = os.path.join(install_home, "genomes", "species", scientific_name + "." + assembly)
+        prefix = scientific_name + "." + assembly
+        chromosomes = [("chr" + chromosome if assembly == "hg19" else chromosome, length) for chromosome, length in CHROMOSOMES]
+
+        touch(os.path.join(assembly_dir, "genome", prefix + ".fa"))
+        with open(os.path.join(assembly_dir, "genome", prefix + ".fa"), 'w') as fasta:
+            for chromosome, length in chromosomes:
+                fasta.write(">" + chromosome + "\nN\n")
+        with open(os.path.join(assembly_dir, "genome", prefix + ".fa.fai"), 'w') as fai:
+            for chromosome, length in chromosomes:
+                fai.write("\t".join([chromosome, str(length), "0", "60", "61"]) + "\n")
+        with open(os.path.join(assembly_dir, "genome", prefix + ".dict"), 'w') as dictionary:
+            dictionary.write("@HD\tVN:1.0\tSO:unsorted\n")
+            for chromosome, length in chromosomes:
+                dictionary.write("\t".join(["@SQ", "SN:" + chromosome, "LN:" + str(length)]) + "\n")
+        touch(os.path.join(assembly_dir, "genome", "bwa_index", prefix + ".fa"))
+        with open(os.path.join(assembly_dir, prefix + ".ini"), 'w') as ini:
+            ini.write("[DEFAULT]\nscientific_name=" + scientific_name + "\nassembly=" + assembly + "\nsource=Synthetic\nversion=1\n")
+
+def sample_name(index):
+    return "S" + "%05d" % (index + 1)
+
+# Readset files of the given number of samples, each sequenced on 2 lanes in paired-end, with empty FASTQ files,
+# without and with the BED file of targeted sequencing
+def create_cohort(work_dir, sample_count, bed_file):
+    for prefix, bed in [("readset", ""), ("bed_readset", bed_file)]:
+        with open(os.path.join(work_dir, prefix + "." + str(sample_count) + ".tsv"), 'w') as readsets:
+            readsets.write("\t".join(["Sample", "Readset", "Library", "RunType", "Run", "Lane", "Adapter1", "Adapter2", "QualityOffset", "BED", "FASTQ1", "FASTQ2", "BAM"]) + "\n")
+            for index in range(sample_count):
+                sample = sample_name(index)
+                for lane in ["1", "2"]:
+                    fastqs = [os.path.join("raw", sample + "_L" + lane + "_R" + read + ".fastq.gz") for read in ["1", "2"]]
+                    for fastq in fastqs:
+                        touch(os.path.join(work_dir, fastq))
+                    readsets.write("\t".join([sample, sample + "_L" + lane, "lib" + sample, "PAIRED_END", "run1", lane, "AGATCGGAAGAGCACACGTCTGAACTCCAGTCA", "AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGT", "33", bed] + fastqs + [""]) + "\n")
+
+    # Design with one contrast of half of the samples against the other half, and one of the first 2 samples only
+    with open(os.path.join(work_dir, "design." + str(sample_count) + ".tsv"), 'w') as design:
+        design.write("\t".join(["Sample", "half", "first"]) + "\n")
+        for index in range(sample_count):
+            design.write("\t".join([sample_name(index), "1" if index < sample_count / 2 else "2", str(index + 1) if index < 2 else "0"]) + "\n")
+
+    # ChIP-Seq design with the first sample as the single input of all contrasts and one contrast per other sample, alternately narrow and broad
+    with open(os.path.join(work_dir, "chipseq_design." + str(sample_count) + ".tsv"), 'w') as design:
+        design.write("\t".join(["Sample"] + [sample_name(index) + ("," + "NB"[index % 2]) for index in range(1, sample_count)]) + "\n")
+        for index in range(sample_count):
+            design.write("\t".join([sample_name(index)] + ["1" if index == 0 else "2" if index == contrast_index else "0" for contrast_index in range(1, sample_count)]) + "\n")
+
+    # Tumor pairs of consecutive samples
+    with open(os.path.join(work_dir, "pairs." + str(sample_count) + ".csv"), 'w') as pairs:
+        for index in range(0, sample_count - 1, 2):
+            pairs.write(",".join(["P" + "%05d" % (index / 2 + 1), sample_name(index), sample_name(index + 1)]) + "\n")
+
+def create_bed_file(work_dir):
+    bed_file = os.path.join(work_dir, "targets.bed")
+    with open(bed_file, 'w') as bed:
+        for chromosome, length in CHROMOSOMES:
+            for start in range(0, min(length, 10000000), 1000000):
+                bed.write("\t".join([chromosome, str(start), str(start + 1000)]) + "\n")
+    return bed_file
+
+# Reference files are only checked by the pipeline config or job dependencies when a job needs them:
+# create the dummy reference files, directories or file prefixes whose missing paths made the pipeline fail,
+# if in the synthetic MUGQIC_INSTALL_HOME. Return whether any path was created.
+def create_missing_references(log_content, install_home):
+    missing_paths = []
+    for path_type, path in re.findall("^(?:Exception: )?(?:Error: )?(File|Directory|Prefix) path \"(.*)\" (?:does not exist|does not match)", log_content, re.MULTILINE):
+        missing_paths.append((path_type, path))
+    # Job input files neither created by other jobs nor on file system
+    for paths in re.findall("^Exception: Error: missing input files for job \S+: (.*) neither found", log_content, re.MULTILINE):
+        missing_paths.extend([("File", path) for path in paths.split(", ")])
+    # First candidate of each list of candidate input files
+    for candidates in re.findall("^Exception: Error: missing candidate input files: \[\['([^']*)'", log_content, re.MULTILINE):
+        missing_paths.append(("File", candidates))
+    # BLAST databases are checked from their .phr files
+    for path in re.findall("^Exception: Error: (.*) BLAST db files do not exist!", log_content, re.MULTILINE):
+        missing_paths.append(("Prefix", path))
+
+    created = False
+    for path_type, path in missing_paths:
+        path = os.path.abspath(path.replace("$MUGQIC_INSTALL_HOME", install_home))
+        if not path.startswith(install_home + os.sep):
+            continue
+        if path_type == "Directory":
+            if not os.path.isdir(path):
+                os.makedirs(path)
+                created = True
+        elif path_type == "Prefix":
+            if not os.path.exists(path + ".00.phr"):
+                touch(path + ".00.phr")
+                created = True
+        elif not os.path.exists(path):
+            touch(path)
+            created = True
+    return created
+
+# Run the job creation of the given pipeline in its own process, returning its wall time and peak RSS
+# as well as its numbers of jobs and dependencies parsed from its log
+def run_pipeline(name, benchmark, scheduler, sample_count, timeout, work_dir, environment):
+    inputs = dict([(prefix, os.path.join(work_dir, prefix + "." + str(sample_count) + extension)) for prefix, extension in [("readset", ".tsv"), ("bed_readset", ".tsv"), ("design", ".tsv"), ("chipseq_design", ".tsv"), ("pairs", ".csv")]])
+    output_dir = os.path.join(work_dir, "output", name + "." + scheduler + "." + str(sample_count))
+
+    command = [sys.executable, os.path.join(PIPELINES_DIR, name, name + ".py"),
+        "-c"] + [os.path.join(PIPELINES_DIR, config_file) for config_file in benchmark['config']] + [
+        "-s", benchmark['steps'],
+        "-r", inputs['bed_readset'] if benchmark['bed'] else inputs['readset'],
+        "-j", scheduler,
+        "-o", output_dir] + [arg.format(**inputs) for arg in benchmark['args']]
+
+    result = {'pipeline': name, 'scheduler': scheduler, 'samples': sample_count}
+    # Run again as long as missing dummy references can be created
+    while True:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        with open(os.path.join(output_dir, name + ".sh"), 'w') as script, open(os.path.join(output_dir, name + ".log"), 'w') as log:
+            start_time = time.time()
+            process = subprocess.Popen(command, stdout=script, stderr=log, cwd=output_dir, env=environment)
+            # The pipeline is killed by a timer thread if it runs longer than the timeout
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+            pid, status, rusage = os.wait4(process.pid, 0)
+            result['seconds'] = time.time() - start_time
+            timer.cancel()
+            timed_out = result['seconds'] >= timeout and status != 0
+        with open(os.path.join(output_dir, name + ".log")) as log:
+            log_content = log.read()
+        if status == 0 or timed_out or not create_missing_references(log_content, environment['MUGQIC_INSTALL_HOME']):
+            break
+
+    # ru_maxrss is in KB on Linux
+    result['peak_rss_mb'] = rusage.ru_maxrss / 1024.0
+    result['status'] = "TIMEOUT" if timed_out else "OK" if status == 0 else "FAILED"
+    total_match = re.search("^INFO:core.pipeline:TOTAL: (\d+) job", log_content, re.MULTILINE)
+    dependency_match = re.search("^INFO:core.pipeline:Job dependencies: (\d+) of (\d+) dependenc", log_content, re.MULTILINE)
+    result['jobs'] = int(total_match.group(1)) if total_match else None
+    result['dependencies'] = int(dependency_match.group(2)) if dependency_match else (0 if total_match else None)
+    result['reduced_dependencies'] = int(dependency_match.group(2)) - int(dependency_match.group(1)) if dependency_match else result['dependencies']
+    if result['status'] == "FAILED":
+        errors = [line for line in log_content.splitlines() if line.strip()]
+        result['error'] = errors[-1] if errors else "exit status " + str(status)
+    return result
+
+# Slope of log(time) over log(samples) from the previous cohort size of the same pipeline and job scheduler
+def time_exponent(result, previous_result):
+    if previous_result and previous_result['status'] == "OK" and result['status'] == "OK" and previous_result['seconds'] > 0:
+        return math.log(result['seconds'] / previous_result['seconds']) / math.log(float(result['samples']) / previous_result['samples'])
+    return None
+
+def main():
+    sample_counts, pipelines, schedulers, timeout, work_dir, output, keep = getarg(sys.argv)
+
+    if work_dir:
+        if os.path.exists(work_dir):
+            sys.exit("Error - work_dir (-w, --work_dir) " + work_dir + " already exists\n")
+        os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="benchmark_pipelines.")
+
+    create_module_command(work_dir)
+    create_references(os.path.join(work_dir, "mugqic_install_home"))
+    bed_file = create_bed_file(work_dir)
+    for sample_count in sample_counts:
+        create_cohort(work_dir, sample_count, bed_file)
+
+    environment = dict(os.environ,
+        PATH=os.path.join(work_dir, "bin") + os.pathsep + os.environ.get('PATH', ""),
+        MUGQIC_INSTALL_HOME=os.path.join(work_dir, "mugqic_install_home")
+    )
+
+    results = []
+    print "\t".join(["#pipeline", "scheduler", "samples", "status", "seconds", "time_exponent", "peak_rss_mb", "jobs", "dependencies", "reduced_dependencies"])
+    try:
+        for name in pipelines:
+            for scheduler in schedulers:
+                previous_result = None
+                for sample_count in sample_counts:
+                    if previous_result and previous_result['status'] == "TIMEOUT":
+                        break
+                    result = run_pipeline(name, dict(BENCHMARKS)[name], scheduler, sample_count, timeout, work_dir, environment)
+                    result['time_exponent'] = time_exponent(result, previous_result)
+                    results.append(result)
+                    previous_result = result
+                    print "\t".join([
+                        name,
+                        scheduler,
+                        str(sample_count),
+                        result['status'],
+                        "%.2f" % result['seconds'],
+                        "%.2f" % result['time_exponent'] if result['time_exponent'] is not None else "N/A",
+                        "%.1f" % result['peak_rss_mb'],
+                        str(result['jobs']) if result['jobs'] is not None else "N/A",
+                        str(result['dependencies']) if result['dependencies'] is not None else "N/A",
+                        str(result['reduced_dependencies']) if result['reduced_dependencies'] is not None else "N/A"
+                    ] + ([result['error']] if 'error' in result else []))
+                    sys.stdout.flush()
+    finally:
+        if output:
+            with open(output, 'w') as output_file:
+                json.dump({'work_dir': work_dir if keep else None, 'results': results}, output_file, indent=4)
+        if keep:
+            print >> sys.stderr, "Work directory kept in " + work_dir
+        else:
+            shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
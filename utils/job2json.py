@@ -4,22 +4,17 @@
 ### job2json
 
 import os
-import errno
 import sys
 import getopt
 import re
 import json
 import datetime
-import time
-import random
-
-from uuid import uuid4
 
 # Append mugqic_pipelines directory to Python library path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
 # MUGQIC Modules
-from core.config import *
+from core.sample_json import FileLock, append_job_event, pending_job_events, materialization_due, materialize, assemble, load_job2json_params
 
 def getarg(argument):
     step_name = ""
@@ -28,10 +23,11 @@ def getarg(argument):
     job_done = ""
     json_files = ""
     config_files = []
+    params_file = ""
     user = ""
     status = True
 
-    options, _ = getopt.getopt(argument[1:], "s:j:l:d:o:c:u:f:h", ['step_name', 'job_name', 'job_log', 'job_done', 'json_outfiles', 'config', 'user', 'status', 'help'])
+    options, _ = getopt.getopt(argument[1:], "s:j:l:d:o:c:p:u:f:h", ['step_name', 'job_name', 'job_log', 'job_done', 'json_outfiles', 'config', 'params=', 'user', 'status', 'help'])
 
     if len(options) == 0:
         usage()
@@ -63,6 +59,11 @@ def getarg(argument):
                 sys.exit("Error - config_files (-c, --config) not provided...\n")
             else :
                 config_files = str(value).split(',')
+        if option in ("-p", "--params"):
+            if str(value) == "" :
+                sys.exit("Error - params (-p, --params) not provided...\n")
+            else :
+                params_file = str(value)
         if option in ("-u", "--user"):
             if str(value) == "" :
                 sys.exit("Error - user (-u, --user) not provided...\n")
@@ -79,12 +80,17 @@ def getarg(argument):
             usage()
             sys.exit()
 
-    return step_name, job_name, job_log, job_done, json_files, config_files, user, status
+    if not config_files and not params_file:
+        sys.exit("Error : config (-c, --config) or params (-p, --params) must be provided")
+
+    return step_name, job_name, job_log, job_done, json_files, config_files, params_file, user, status
 
 def usage():
     print "\n-------------------------------------------------------------------------------------------"
-    print "job2json.py will append a JSON section describing a pipeline job that has just finished"
-    print "to a JSON file which was pre-generated when the pipeline was launched."
+    print "job2json.py will append a JSON section describing a pipeline job that has just started or finished"
+    print "to the event log of JSON files which were pre-generated when the pipeline was launched."
+    print "Events are applied to the JSON files every json_update_interval seconds (Default : 60),"
+    print "or as soon as no job of the sample is running anymore."
     print "This script is usually launched automatically before and after each pipeline job."
     print "This program was written by Edouard HENRION"
     print "For more information, contact: edouard.henrion@computationalgenomics.ca"
@@ -94,6 +100,8 @@ def usage():
     print "       -j    --job_name      : name of the current job"
     print "       -l    --job_log       : name of the log file for the current job"
     print "       -d    --job_done      : name of the done file for the current job"
+    print "       -c    --config        : comma-separated list of config files"
+    print "       -p    --params        : job2json parameters file written by the pipeline, read instead of config files"
     print "       -o    --json_outfiles : comma-separated list of names of json files which need to be appended affected by the current job"
     print "       -f    --status        : boolean value to indicate if the job has failed (False/0) or succeeded (True/1) - Default : True"
     print "       -h    --help          : this help \n"
@@ -101,93 +109,54 @@ def usage():
 def main():
     #print "command line used :\n" + " ".join(sys.argv[:])
 
-    step_name, job_name, job_log, job_done, json_files, config_files, user, status = getarg(sys.argv)
-
-    #print config_files
-    config.parse_files(config_files)
+    step_name, job_name, job_log, job_done, json_files, config_files, params_file, user, status = getarg(sys.argv)
+
+    # Job events are appended to the event log of each sample JSON file, the sample JSON file itself and its
+    # copy for the monitoring interface being only updated every json_update_interval seconds, or when no job
+    # of the sample is running anymore ("json_update_interval=0" to update them on every event)
+    if params_file:
+        # Fast path: parameters precomputed by the pipeline, without loading the config
+        params = load_job2json_params(params_file)
+        update_interval = params['json_update_interval']
+        portal_output_dir = os.path.expandvars(params['portal_output_dir'])
+        if portal_output_dir != '' and not os.path.isdir(portal_output_dir):
+            sys.exit("Error: directory path \"" + portal_output_dir + "\" does not exist or is not a valid directory!")
+    else:
+        update_interval, portal_output_dir = config_params(config_files)
+
+    event = {
+        'step': step_name,
+        'job': job_name,
+        'status': status,
+        'date': re.sub("\.\d+$", "", str(datetime.datetime.now()))
+    }
+    if status != "running":
+        event['log_file'] = job_log
+        event['done_file'] = job_done
 
     for jfile in json_files.split(","):
+        with FileLock(jfile):
+            append_job_event(jfile, event)
+            events = pending_job_events(jfile)
+            if materialization_due(jfile, events, update_interval):
+                materialize(jfile, events)
+
+                # Print a copy of it for the monitoring interface
+                if portal_output_dir != '':
+                    current_json = assemble(jfile)
+                    # Imported here since uuid loads libuuid through ctypes, which slows down job2json startup
+                    from uuid import uuid4
+                    with open(os.path.join(portal_output_dir, user + '.' + current_json['sample_name'] + '.' + uuid4().get_hex() + '.json'), 'w') as out_json:
+                        json.dump(current_json, out_json, indent=4)
+
+# Return json_update_interval and portal_output_dir from config files, as used by job submission scripts
+# created by previous pipeline versions
+def config_params(config_files):
+    from core.config import config
+    config.parse_files(config_files)
 
-        # First lock the file to avoid multiple and synchronous writing atemps
-        lock(jfile)
-
-        with open(jfile, 'r') as json_file:
-            current_json = json.load(json_file)
-        json_file.close()
-
-        # Make sure the job_log file is not in absolute path anymore
-        if current_json['pipeline']['general_information']['analysis_folder']:
-            job_log = re.sub(current_json['pipeline']['general_information']['analysis_folder'], "", job_log)
-
-        step_found = False
-        job_found = False
-
-        # Find the current step which should already exist in the json object (already created by bfx/jsonator.py)
-        for jstep in current_json['pipeline']['step']:
-            if jstep['name'] == step_name:
-                step_found = True
-
-                # Find the current job which should already exist in the json object (already created by bfx/jsonator.py)
-                for jjob in jstep['job']:
-                    if jjob['name'] == job_name:
-                        job_found = True
-                        if  status == "running":
-                            jjob['job_start_date'] = re.sub("\.\d+$", "", str(datetime.datetime.now()))
-                            jjob['status'] = "running"
-                        else:
-                            jjob['log_file'] = job_log
-                            if status == "0":
-                                jjob['status'] = "success"
-                                jjob['done_file'] = job_done
-                            else:
-                                jjob['status'] = "error"
-                            jjob['job_end_date'] = re.sub("\.\d+$", "", str(datetime.datetime.now()))
-
-                # If job does not exists already, raise an exception
-                if not job_found :
-                    sys.exit("Error : job " + job_name + ", within step " + step_name + ", was not found in " + " json_file...")
-
-        # If step does not exists already, raise an exception
-        if not step_found :
-            sys.exit("Error : step " + step_name + " was not found in " + " json_file...")
-
-        # Print to file
-        with open(jfile, 'w') as out_json:
-            json.dump(current_json, out_json, indent=4)
-
-        # Print a copy of it for the monitoring interface
-        portal_output_dir = config.param('DEFAULT', 'portal_output_dir', required=False, type='dirpath')
-        if portal_output_dir != '':
-            with open(os.path.join(portal_output_dir, user + '.' + current_json['sample_name'] + '.' + uuid4().get_hex() + '.json'), 'w') as out_json:
-                json.dump(current_json, out_json, indent=4)
-
-        # Finally unlock the file
-        unlock(jfile)
-
-def lock(filepath):
-    unlocked = True
-    while unlocked :
-        try :
-            os.makedirs(filepath + '.lock')
-        except OSError as exception :
-            if exception.errno == errno.EEXIST and os.path.isdir(filepath + '.lock'):
-                # The lock folder already exists, we need to wait for it to be deleted
-                sleep_time = random.randint(1, 100)
-                time.sleep(sleep_time)
-                pass
-            else :
-                # An unexpected error has occured : let's stop the program and raise the error"
-                raise exception
-        else :
-            # The lock folder was successfully created !"
-            unlocked = False
-
-def unlock(filepath):
-    try :
-        os.rmdir(filepath + '.lock')
-    except :
-        raise
-
+    update_interval = config.param('DEFAULT', 'json_update_interval', type='int', required=False)
+    return update_interval if update_interval != "" else 60, config.param('DEFAULT', 'portal_output_dir', required=False, type='dirpath')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+### job_accounting
+### Collect resources used by completed pipeline jobs into a job accounting database and print their percentiles
+
+import logging
+import os
+import sys
+import getopt
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# MUGQIC Modules
+from core.job_accounting import JobAccounting, percentile
+
+def getarg(argument):
+    database = ""
+    output_dirs = []
+    percent = 95
+
+    options, args = getopt.getopt(argument[1:], "d:o:p:h", ['database=', 'output_dir=', 'percentile=', 'help'])
+
+    for option, value in options:
+        if option in ("-d", "--database"):
+            if str(value) == "" :
+                sys.exit("Error - database (-d, --database) not provided...\n")
+            else :
+                database = str(value)
+        if option in ("-o", "--output_dir"):
+            if not os.path.isdir(os.path.join(str(value), "job_output")):
+                sys.exit("Error - output_dir (-o, --output_dir) " + str(value) + " has no job_output directory\n")
+            else :
+                output_dirs.append(str(value))
+        if option in ("-p", "--percentile"):
+            try:
+                percent = float(value)
+            except ValueError:
+                sys.exit("Error - percentile (-p, --percentile) must be a number\n")
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit()
+
+    if database == "":
+        usage()
+        sys.exit("Error : database (-d, --database) not provided")
+
+    return database, output_dirs, percent
+
+def usage():
+    print "\n-------------------------------------------------------------------------------------------"
+    print "job_accounting.py collects the walltime, memory and CPU time used by completed jobs of pipeline"
+    print "output directories, parsed from the job logs listed in their job_output/ job list files, into a job"
+    print "accounting database, then prints resource percentiles of successful jobs by job name prefix."
+    print "The same database can be given to pipelines with '--tune-resources' (see [DEFAULT] job_accounting_db)."
+    print "-------------------------------------------------------------------------------------------\n"
+    print "USAGE : job_accounting.py [option]"
+    print "       -d    --database      : job accounting database file"
+    print "       -o    --output_dir    : pipeline output directory whose jobs are collected, can be repeated"
+    print "       -p    --percentile    : percentile of printed resources - Default : 95"
+    print "       -h    --help          : this help \n"
+
+def main():
+    database, output_dirs, percent = getarg(sys.argv)
+    logging.basicConfig(level=logging.INFO)
+    job_accounting = JobAccounting(os.path.abspath(database))
+    for output_dir in output_dirs:
+        job_accounting.collect(os.path.join(os.path.abspath(output_dir), "job_output"))
+
+    print "\t".join(["#job_name_prefix", "successful_runs", "walltime_p" + str(percent) + "_hours", "memory_p" + str(percent) + "_mb", "used_cpus_p" + str(percent)])
+    for job_name_prefix in sorted(job_accounting.job_name_prefixes()):
+        runs = job_accounting.successful_runs(job_name_prefix)
+        walltimes = [run[1] for run in runs if run[1] is not None]
+        max_rsses = [run[2] for run in runs if run[2] is not None]
+        used_cpus = [run[4] / run[1] for run in runs if run[4] is not None and run[1]]
+        print "\t".join([
+            job_name_prefix,
+            str(len(runs)),
+            "%.2f" % (percentile(walltimes, percent) / 3600) if walltimes else "N/A",
+            "%d" % percentile(max_rsses, percent) if max_rsses else "N/A",
+            "%.1f" % percentile(used_cpus, percent) if used_cpus else "N/A"
+        ])
+    job_accounting.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+### job_fingerprint
+### Record the content fingerprints of a job input and output files in its .done file
+
+import os
+import sys
+import getopt
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# MUGQIC Modules
+from core.fingerprint import methods, write_done_file
+
+def getarg(argument):
+    method = "sampled"
+    job_done = ""
+
+    options, files = getopt.getopt(argument[1:], "m:d:h", ['method=', 'job_done=', 'help'])
+
+    for option, value in options:
+        if option in ("-m", "--method"):
+            if str(value) not in methods:
+                sys.exit("Error - method (-m, --method) must be one of: " + ", ".join(methods) + "\n")
+            else :
+                method = str(value)
+        if option in ("-d", "--job_done"):
+            if str(value) == "" :
+                sys.exit("Error - job_done (-d, --job_done) not provided...\n")
+            else :
+                job_done = str(value)
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit()
+
+    if job_done == "":
+        usage()
+        sys.exit("Error : job_done (-d, --job_done) not provided")
+
+    return method, job_done, files
+
+def usage():
+    print "\n-------------------------------------------------------------------------------------------"
+    print "job_fingerprint.py creates a job .done file containing the content fingerprints of the job"
+    print "input and output files, so that the job up-to-date status does not depend on file modification times."
+    print "This script is usually launched automatically at the end of each successful pipeline job"
+    print "when the pipeline is run with '--staleness hash' or '--staleness full_hash'."
+    print "-------------------------------------------------------------------------------------------\n"
+    print "USAGE : job_fingerprint.py [option] file1 [file2 ...]"
+    print "       -m    --method        : fingerprint method, one of: " + ", ".join(methods) + " - Default : sampled"
+    print "       -d    --job_done      : name of the done file for the current job"
+    print "       -h    --help          : this help \n"
+
+def main():
+    method, job_done, files = getarg(sys.argv)
+    write_done_file(job_done, files, method)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+### job_retry
+### Resubmit cluster jobs which ran out of memory or walltime with escalated resources, along with their pending dependent jobs
+
+import collections
+import datetime
+import logging
+import os
+import re
+import subprocess
+import sys
+import getopt
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# MUGQIC Modules
+from core.job_accounting import memory_patterns, walltime_patterns, cluster_memory, cluster_walltime, replace_cluster_value
+from core.scheduler import separator_line
+
+log = logging.getLogger("job_retry")
+
+# Job log messages of jobs killed by PBS or Slurm for exceeding their memory or walltime
+oom_patterns = [r"oom-kill", r"Exceeded job memory limit", r"job killed: mem \S+ exceeded limit"]
+timeout_patterns = [r"DUE TO TIME LIMIT", r"job killed: walltime \S+ exceeded limit"]
+
+# Slurm job states as reported by sacct
+slurm_queued_states = ["PENDING", "RUNNING", "REQUEUED", "RESIZING", "SUSPENDED", "CONFIGURING", "COMPLETING"]
+slurm_state_reasons = {"OUT_OF_MEMORY": "oom", "TIMEOUT": "timeout"}
+
+cancel_commands = {"PBSScheduler": "qdel", "SlurmScheduler": "scancel"}
+
+def getarg(argument):
+    submission_scripts = []
+    job_lists = []
+    memory_factor = 2.0
+    walltime_factor = 2.0
+    dry_run = False
+
+    options, args = getopt.getopt(argument[1:], "s:l:m:w:nh", ['submission_script=', 'job_list=', 'memory_factor=', 'walltime_factor=', 'dry_run', 'help'])
+
+    for option, value in options:
+        if option in ("-s", "--submission_script"):
+            if not os.path.isfile(str(value)):
+                sys.exit("Error - submission_script (-s, --submission_script) " + str(value) + " not found\n")
+            else :
+                submission_scripts.append(str(value))
+        if option in ("-l", "--job_list"):
+            if not os.path.isfile(str(value)):
+                sys.exit("Error - job_list (-l, --job_list) " + str(value) + " not found\n")
+            else :
+                job_lists.append(str(value))
+        if option in ("-m", "--memory_factor"):
+            try:
+                memory_factor = float(value)
+            except ValueError:
+                sys.exit("Error - memory_factor (-m, --memory_factor) must be a number\n")
+            if memory_factor <= 1:
+                sys.exit("Error - memory_factor (-m, --memory_factor) must be greater than 1\n")
+        if option in ("-w", "--walltime_factor"):
+            try:
+                walltime_factor = float(value)
+            except ValueError:
+                sys.exit("Error - walltime_factor (-w, --walltime_factor) must be a number\n")
+            if walltime_factor <= 1:
+                sys.exit("Error - walltime_factor (-w, --walltime_factor) must be greater than 1\n")
+        if option in ("-n", "--dry_run"):
+            dry_run = True
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit()
+
+    if not submission_scripts or not job_lists:
+        usage()
+        sys.exit("Error : submission_script (-s, --submission_script) and job_list (-l, --job_list) must be provided")
+
+    return submission_scripts, job_lists, memory_factor, walltime_factor, dry_run
+
+def usage():
+    print "\n-------------------------------------------------------------------------------------------"
+    print "job_retry.py resubmits the PBS or Slurm jobs of a pipeline which were killed for exceeding their"
+    print "memory or walltime, with their memory or walltime multiplied by the given factor, along with all"
+    print "their dependent jobs which are not done yet, queued ones being cancelled first."
+    print "Failures are detected from the job logs listed in job list files (MUGQICexitStatus and scheduler"
+    print "messages) and, with Slurm, from job states reported by sacct. Jobs failing for other reasons are"
+    print "only reported. Jobs submitted in Slurm job arrays (cluster_job_array=true) cannot be resubmitted."
+    print "Resubmission commands are taken from the job submission script, then written in a job retry script"
+    print "in the job_output/ directory and run. Job retry scripts and their job lists can be given again,"
+    print "after the original ones, for further retries."
+    print "-------------------------------------------------------------------------------------------\n"
+    print "USAGE : job_retry.py [option]"
+    print "       -s    --submission_script : job submission script output by the pipeline, can be repeated"
+    print "       -l    --job_list          : job list file written by the job submission script, can be repeated"
+    print "       -m    --memory_factor     : memory multiplication factor of jobs out of memory - Default : 2"
+    print "       -w    --walltime_factor   : walltime multiplication factor of jobs out of walltime - Default : 2"
+    print "       -n    --dry_run           : print the job retry script instead of running it"
+    print "       -h    --help              : this help \n"
+
+# Job section of a submission script
+class ScriptJob(object):
+
+    def __init__(self, step, id, name, lines):
+        self.step = step
+        self.id = id
+        self.name = name
+        self.lines = lines
+
+    @property
+    def done(self):
+        for line in self.lines:
+            if line.startswith("JOB_DONE="):
+                return line[len("JOB_DONE="):]
+        return None
+
+    # Index of the line of the cluster submit command, recognized by its job output and job name arguments
+    @property
+    def submit_line_index(self):
+        for index, line in enumerate(self.lines):
+            if re.search(r"\s\$JOB_OUTPUT\s", line) and re.search(r"\s\$JOB_NAME\s", line):
+                return index
+        return None
+
+    @property
+    def cluster_args(self):
+        index = self.submit_line_index
+        return self.lines[index].split(" | ")[0] if index is not None else ""
+
+# Parse job submission scripts
+# Return pipeline name, scheduler name, output directory, header lines (variables and throttle function)
+# and an ordered dict of jobs by name, later scripts overriding earlier ones
+def parse_submission_scripts(submission_scripts):
+    pipeline = scheduler = output_dir = None
+    header = None
+    jobs = collections.OrderedDict()
+    for submission_script in submission_scripts:
+        with open(submission_script) as script_file:
+            lines = script_file.read().splitlines()
+
+        step = None
+        script_header = []
+        section = "comment"
+        script_job = None
+        skipped_lines = 0
+        for index, line in enumerate(lines):
+            next_line = lines[index + 1] if index + 1 < len(lines) else ""
+            if line == separator_line and re.match(r"# (STEP|JOB|JOB ARRAY|CANCEL): ", next_line):
+                section = "jobs"
+                script_job = None
+                match = re.match(r"# JOB: (\S+): (\S+)$", next_line)
+                if match:
+                    script_job = ScriptJob(step, match.group(1), match.group(2), [])
+                    jobs[script_job.name] = script_job
+                    # Skip job title and separator lines
+                    skipped_lines = 2
+                continue
+            if skipped_lines:
+                skipped_lines -= 1
+                continue
+            if line == separator_line:
+                # End of job lines
+                script_job = None
+
+            match = re.match(r"# (\S+) (\S+Scheduler) Job (?:Submission|Retry) Bash script$", line)
+            if match and section == "comment":
+                pipeline, scheduler = match.groups()
+            if line.startswith("OUTPUT_DIR=") and section == "comment":
+                output_dir = line[len("OUTPUT_DIR="):]
+                section = "header"
+            if line.startswith("STEP="):
+                step = line[len("STEP="):]
+
+            if section == "header":
+                script_header.append(line)
+            elif script_job:
+                script_job.lines.append(line)
+
+        if header is None:
+            while script_header and not script_header[-1]:
+                script_header.pop()
+            header = script_header
+
+    return pipeline, scheduler, output_dir, header, jobs
+
+# Parse job list files
+# Return an ordered dict of (job ID, dependency job IDs, log path) by job name, later runs overriding earlier ones,
+# and a dict of job names by job ID
+def parse_job_lists(job_lists):
+    job_runs = collections.OrderedDict()
+    job_names = {}
+    for job_list in job_lists:
+        with open(job_list) as job_list_file:
+            for line in job_list_file:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 4:
+                    continue
+                job_id, job_name, dependencies, log_path = fields[:4]
+                job_runs[job_name] = (job_id, [dependency for dependency in dependencies.split(":") if dependency], os.path.join(os.path.dirname(os.path.abspath(job_list)), log_path))
+                job_names[job_id] = job_name
+    return job_runs, job_names
+
+# Return Slurm job states by job ID from sacct, an empty dict if sacct is not available
+def slurm_job_states(job_ids):
+    states = {}
+    max_job_ids = 500
+    for chunk in [job_ids[i:i + max_job_ids] for i in range(0, len(job_ids), max_job_ids)]:
+        try:
+            output = subprocess.check_output(["sacct", "-n", "-P", "-X", "-o", "JobID,State", "-j", ",".join(chunk)])
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning("sacct failed (" + str(e) + "): job states are only read from job logs")
+            return {}
+        for line in output.splitlines():
+            fields = line.split("|")
+            if len(fields) >= 2 and fields[1]:
+                # e.g. "CANCELLED by 1234"
+                states[fields[0]] = fields[1].split()[0]
+    return states
+
+# Return the state of a job run: "done", "queued", "oom", "timeout" or "failed"
+# Jobs not completed yet and not reported as failed by Slurm are considered queued
+def job_state(done_path, log_path, slurm_state):
+    if done_path and os.path.isfile(done_path):
+        return "done"
+    if slurm_state in slurm_state_reasons:
+        return slurm_state_reasons[slurm_state]
+
+    exit_status = None
+    reason = None
+    try:
+        with open(log_path) as log_file:
+            for line in log_file:
+                match = re.search(r"MUGQICexitStatus:(\d+)", line)
+                if match:
+                    exit_status = int(match.group(1))
+                elif [pattern for pattern in oom_patterns if re.search(pattern, line)]:
+                    reason = "oom"
+                elif [pattern for pattern in timeout_patterns if re.search(pattern, line)]:
+                    reason = "timeout"
+    except IOError:
+        # Job not started yet, or PBS job log not copied yet
+        pass
+
+    if reason:
+        return reason
+    if exit_status == 0 and slurm_state not in slurm_queued_states or slurm_state == "COMPLETED":
+        return "done"
+    if exit_status is not None or slurm_state and slurm_state not in slurm_queued_states:
+        return "failed"
+    return "queued"
+
+def format_walltime(seconds):
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+# Return the cluster arguments of a job with its memory or walltime multiplied by the given factor,
+# and a description of the change, or (None, reason) if the resource is not set in cluster arguments
+def escalate_resources(cluster_args, state, memory_factor, walltime_factor):
+    if state == "oom":
+        memory = cluster_memory(cluster_args)
+        if not memory:
+            return None, "out of memory, but no memory is set in cluster arguments"
+        mb = int(memory * memory_factor)
+        return replace_cluster_value(memory_patterns, cluster_args, lambda match: str(mb) + ("M" if match.group(1).startswith("--") else "mb")), "out of memory: " + str(memory) + " MB -> " + str(mb) + " MB"
+    else:
+        walltime = cluster_walltime(cluster_args)
+        if not walltime:
+            return None, "out of walltime, but no walltime is set in cluster arguments"
+        seconds = int(walltime * walltime_factor)
+        return replace_cluster_value(walltime_patterns, cluster_args, lambda match: format_walltime(seconds)), "out of walltime: " + format_walltime(walltime) + " -> " + format_walltime(seconds)
+
+# Return the job lines to resubmit it with the given dependencies and cluster arguments
+def retry_job_lines(script_job, dependencies, cluster_args):
+    lines = []
+    for line in script_job.lines:
+        if line.startswith("JOB_DEPENDENCIES="):
+            # Multiple dependency lines are replaced by a single one
+            if not [previous_line for previous_line in lines if previous_line.startswith("JOB_DEPENDENCIES=")]:
+                lines.append("JOB_DEPENDENCIES=" + ":".join(dependencies))
+        else:
+            lines.append(line)
+
+    while lines and not lines[-1]:
+        lines.pop()
+
+    index = script_job.submit_line_index
+    if not dependencies:
+        # Remove the dependency argument, e.g. "--depend=afterok:$JOB_DEPENDENCIES" or "-W depend=afterok:$JOB_DEPENDENCIES"
+        cluster_args = re.sub(r"(\s+-W)?\s+\S*\$JOB_DEPENDENCIES", "", cluster_args)
+    lines[index] = cluster_args + lines[index][len(script_job.cluster_args):]
+    return lines
+
+def main():
+    submission_scripts, job_lists, memory_factor, walltime_factor, dry_run = getarg(sys.argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    pipeline, scheduler, output_dir, header, script_jobs = parse_submission_scripts(submission_scripts)
+    if scheduler not in cancel_commands:
+        sys.exit("Error: " + str(scheduler) + " job submission scripts are not supported, only PBS and Slurm ones")
+    job_runs, job_names = parse_job_lists(job_lists)
+
+    slurm_states = slurm_job_states([job_id for job_id, dependencies, log_path in job_runs.values()]) if scheduler == "SlurmScheduler" else {}
+    states = {}
+    for job_name, (job_id, dependencies, log_path) in job_runs.items():
+        script_job = script_jobs.get(job_name)
+        states[job_name] = job_state(os.path.join(output_dir, script_job.done) if script_job and script_job.done else None, log_path, slurm_states.get(job_id))
+
+    # Jobs are resubmitted in submission script order, where dependency jobs always come first
+    retried_jobs = collections.OrderedDict()
+    cancelled_job_ids = []
+    for job_name, script_job in script_jobs.items():
+        if job_name not in job_runs or states[job_name] == "done":
+            continue
+        job_id, dependencies, log_path = job_runs[job_name]
+        dependency_names = [job_names.get(dependency) for dependency in dependencies]
+        retried_dependencies = [dependency for dependency in dependency_names if dependency in retried_jobs]
+        if states[job_name] in ("oom", "timeout"):
+            cluster_args, reason = escalate_resources(script_job.cluster_args, states[job_name], memory_factor, walltime_factor)
+            if not cluster_args:
+                log.info("Job " + job_name + " (" + job_id + ") not retried: " + reason)
+                continue
+        elif retried_dependencies:
+            cluster_args, reason = script_job.cluster_args, "depends on " + ", ".join(retried_dependencies)
+        else:
+            continue
+
+        # Dependencies are either retried jobs, or jobs still queued, referred to by their cluster job ID
+        failed_dependencies = [dependency for dependency in dependency_names if dependency not in retried_jobs and dependency in states and states[dependency] not in ("done", "queued")]
+        if failed_dependencies:
+            log.info("Job " + job_name + " (" + job_id + ") not retried: depends on failed jobs " + ", ".join(failed_dependencies))
+            continue
+        retry_dependencies = ["$" + script_jobs[dependency].id if dependency in retried_jobs else job_id_dependency for dependency, job_id_dependency in zip(dependency_names, dependencies) if dependency in retried_jobs or states.get(dependency) == "queued"]
+
+        if states[job_name] == "queued":
+            cancelled_job_ids.append(job_id)
+        retried_jobs[job_name] = retry_job_lines(script_job, retry_dependencies, cluster_args)
+        log.info("Job " + job_name + " (" + job_id + ") retried: " + reason)
+
+    for job_name, state in states.items():
+        if state == "failed" and job_name not in retried_jobs:
+            log.info("Job " + job_name + " (" + job_runs[job_name][0] + ") failed, not retried: see " + job_runs[job_name][2])
+
+    if not retried_jobs:
+        log.info("No job to retry")
+        return
+
+    lines = """\
+#!/bin/bash
+# Exit immediately on error
+set -eu -o pipefail
+
+{separator_line}
+# {pipeline} {scheduler} Job Retry Bash script
+# Created on: {timestamp}
+# TOTAL: {job_count} job{plural}
+{separator_line}
+""".format(separator_line=separator_line, pipeline=pipeline, scheduler=scheduler, timestamp=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), job_count=len(retried_jobs), plural="s" if len(retried_jobs) > 1 else "").splitlines()
+    lines += [""] + header
+
+    if cancelled_job_ids:
+        lines += ["", separator_line, "# CANCEL: queued jobs depending on retried jobs", separator_line]
+        max_job_ids = 100
+        for chunk in [cancelled_job_ids[i:i + max_job_ids] for i in range(0, len(cancelled_job_ids), max_job_ids)]:
+            lines.append(cancel_commands[scheduler] + " " + " ".join(chunk) + " || true")
+
+    step = None
+    for job_name, job_lines in retried_jobs.items():
+        if script_jobs[job_name].step != step:
+            step = script_jobs[job_name].step
+            lines += ["", separator_line, "# STEP: " + step, separator_line, "STEP=" + step, "mkdir -p $JOB_OUTPUT_DIR/$STEP"]
+        lines += ["", separator_line, "# JOB: " + script_jobs[job_name].id + ": " + job_name, separator_line] + job_lines
+
+    if dry_run:
+        print "\n".join(lines)
+    else:
+        retry_script = os.path.join(output_dir, "job_output", pipeline + "_job_retry_" + datetime.datetime.now().strftime("%Y-%m-%dT%H.%M.%S") + ".sh")
+        with open(retry_script, 'w') as retry_script_file:
+            retry_script_file.write("\n".join(lines) + "\n")
+        log.info("Job retry script " + retry_script + " written, running it...")
+        sys.exit(subprocess.call(["bash", retry_script]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+### local_executor
+### Run pipeline jobs on the local machine, in parallel as their dependencies and the available resources allow
+
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import getopt
+import time
+
+def getarg(argument):
+    cpus = multiprocessing.cpu_count()
+    memory = total_memory()
+    keep_going = False
+    job_output_dir = ""
+    timestamp = ""
+    job_list = ""
+
+    options, args = getopt.getopt(argument[1:], "c:m:ko:t:l:h", ['cpus=', 'memory=', 'keep_going', 'job_output_dir=', 'timestamp=', 'job_list=', 'help'])
+
+    for option, value in options:
+        if option in ("-c", "--cpus"):
+            if not str(value).isdigit() or int(value) < 1:
+                sys.exit("Error - cpus (-c, --cpus) must be a positive integer\n")
+            else :
+                cpus = int(value)
+        if option in ("-m", "--memory"):
+            if not str(value).isdigit() or int(value) < 1:
+                sys.exit("Error - memory (-m, --memory) must be a positive integer\n")
+            else :
+                memory = int(value)
+        if option in ("-k", "--keep_going"):
+            keep_going = True
+        if option in ("-o", "--job_output_dir"):
+            if str(value) == "" :
+                sys.exit("Error - job_output_dir (-o, --job_output_dir) not provided...\n")
+            else :
+                job_output_dir = str(value)
+        if option in ("-t", "--timestamp"):
+            if str(value) == "" :
+                sys.exit("Error - timestamp (-t, --timestamp) not provided...\n")
+            else :
+                timestamp = str(value)
+        if option in ("-l", "--job_list"):
+            job_list = str(value)
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit()
+
+    if job_output_dir == "" or timestamp == "":
+        usage()
+        sys.exit("Error : job_output_dir (-o, --job_output_dir) and timestamp (-t, --timestamp) must be provided")
+
+    return cpus, memory, keep_going, job_output_dir, timestamp, job_list
+
+def usage():
+    print "\n-------------------------------------------------------------------------------------------"
+    print "local_executor.py runs pipeline jobs on the local machine, in parallel as long as their"
+    print "dependencies are completed and their CPUs and memory fit in the given limits."
+    print "Jobs are read on standard input as a JSON list, as written by the 'local' job scheduler."
+    print "This script is usually launched automatically by the pipeline job submission script."
+    print "-------------------------------------------------------------------------------------------\n"
+    print "USAGE : local_executor.py [option] < jobs.json"
+    print "       -c    --cpus              : maximum number of CPUs used by running jobs - Default : all CPUs"
+    print "       -m    --memory            : maximum memory used by running jobs in MB - Default : total memory"
+    print "       -k    --keep_going        : keep running jobs which do not depend on failed jobs - Default : stop on first failure"
+    print "       -o    --job_output_dir    : job output directory, job logs are written in <job_output_dir>/<step>/"
+    print "       -t    --timestamp         : timestamp of job log file names"
+    print "       -l    --job_list          : job list file where each launched job process ID, name, dependencies and log file are written"
+    print "       -h    --help              : this help \n"
+
+# Total memory of the machine in MB, 0 if unknown
+def total_memory():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    return 0
+
+def log(message):
+    print time.strftime("%Y-%m-%dT%H:%M:%S") + " " + message
+    sys.stdout.flush()
+
+def run_jobs(jobs, cpus, memory, keep_going, job_output_dir, timestamp, job_list):
+    job_ids = set([job['id'] for job in jobs])
+    # Dependencies on jobs not run by this executor (e.g. already up to date) are considered completed
+    for job in jobs:
+        job['dependencies'] = set([dependency for dependency in job['dependencies'] if dependency in job_ids])
+        # A job requesting more resources than available runs alone
+        job['cpu'] = min(job['cpu'], cpus)
+        job['memory'] = min(job['memory'], memory) if memory else 0
+
+    pending_jobs = list(jobs)
+    running_jobs = {}
+    completed_job_ids = set()
+    failed_job_ids = set()
+    skipped_job_ids = set()
+    free_cpus = cpus
+    free_memory = memory
+
+    try:
+        while pending_jobs or running_jobs:
+            if not failed_job_ids or keep_going:
+                for job in list(pending_jobs):
+                    if job['dependencies'].intersection(failed_job_ids.union(skipped_job_ids)):
+                        pending_jobs.remove(job)
+                        skipped_job_ids.add(job['id'])
+                        log("Skip MUGQIC Job " + job['name'] + ": a dependency job failed")
+                    elif job['dependencies'].issubset(completed_job_ids) and job['cpu'] <= free_cpus and job['memory'] <= free_memory:
+                        pending_jobs.remove(job)
+                        job_output = os.path.join(job_output_dir, job['step'], job['name'] + "_" + timestamp + ".o")
+                        environment = dict(os.environ, JOB_OUTPUT=job_output)
+                        with open(job_output, 'w') as job_output_file, open(os.devnull) as null_input:
+                            # Each job runs in its own process group so that it can be terminated with all its children
+                            process = subprocess.Popen(["bash", job['script']], stdin=null_input, stdout=job_output_file, stderr=subprocess.STDOUT, env=environment, preexec_fn=os.setsid)
+                        running_jobs[process] = job
+                        if job_list:
+                            # Same format as the job list of cluster job schedulers, log file path being relative to the job list directory
+                            with open(job_list, 'a') as job_list_file:
+                                job_list_file.write("\t".join([str(process.pid), job['name'], ":".join(sorted(job['dependencies'])), os.path.relpath(job_output, os.path.dirname(os.path.abspath(job_list)))]) + "\n")
+                        free_cpus -= job['cpu']
+                        free_memory -= job['memory']
+                        log("Begin MUGQIC Job " + job['name'] + " (" + str(job['cpu']) + " CPU" + ("s" if job['cpu'] > 1 else "") + (", " + str(job['memory']) + " MB" if job['memory'] else "") + ")")
+            elif pending_jobs:
+                skipped_job_ids.update([job['id'] for job in pending_jobs])
+                pending_jobs = []
+
+            if not running_jobs:
+                if pending_jobs:
+                    # Only possible with circular dependencies
+                    sys.exit("Error: jobs " + ", ".join([job['name'] for job in pending_jobs]) + " can never be run!")
+                break
+
+            time.sleep(0.5)
+            for process, job in running_jobs.items():
+                if process.poll() is not None:
+                    del running_jobs[process]
+                    free_cpus += job['cpu']
+                    free_memory += job['memory']
+                    if process.returncode == 0:
+                        completed_job_ids.add(job['id'])
+                        log("End MUGQIC Job " + job['name'])
+                    else:
+                        failed_job_ids.add(job['id'])
+                        log("Error: MUGQIC Job " + job['name'] + " failed with exit status " + str(process.returncode) + (", waiting for running jobs to complete" if running_jobs and not keep_going else ""))
+    except KeyboardInterrupt:
+        for process, job in running_jobs.items():
+            os.killpg(process.pid, signal.SIGTERM)
+            log("Terminated MUGQIC Job " + job['name'])
+        raise
+
+    log(str(len(completed_job_ids)) + " job" + ("s" if len(completed_job_ids) > 1 else "") + " completed, " + str(len(failed_job_ids)) + " failed, " + str(len(skipped_job_ids)) + " not run")
+    return 1 if failed_job_ids else 0
+
+def main():
+    cpus, memory, keep_going, job_output_dir, timestamp, job_list = getarg(sys.argv)
+    jobs = json.load(sys.stdin)
+    sys.exit(run_jobs(jobs, cpus, memory, keep_going, job_output_dir, timestamp, job_list))
+
+if __name__ == '__main__':
+    main()
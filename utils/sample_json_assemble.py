@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+### sample_json_assemble
+### Write the sample JSON documents of sample JSON files, whether single files or step stores (json_step_store=True)
+
+import getopt
+import json
+import os
+import sys
+
+# Append mugqic_pipelines directory to Python library path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# MUGQIC Modules
+from core.sample_json import FileLock, assemble
+
+def getarg(argument):
+    json_files = []
+    output_files = []
+
+    options, _ = getopt.getopt(argument[1:], "j:o:h", ['json_files=', 'output_files=', 'help'])
+
+    for option, value in options:
+        if option in ("-j", "--json_files"):
+            json_files = str(value).split(',')
+        if option in ("-o", "--output_files"):
+            output_files = str(value).split(',')
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit()
+
+    if not json_files or json_files == ['']:
+        usage()
+        sys.exit("Error - json_files (-j, --json_files) not provided...\n")
+    if output_files and len(output_files) != len(json_files):
+        sys.exit("Error - as many output_files (-o, --output_files) as json_files (-j, --json_files) must be provided...\n")
+    if not output_files and len(json_files) > 1:
+        sys.exit("Error - output_files (-o, --output_files) must be provided for several json_files (-j, --json_files)...\n")
+
+    return json_files, output_files
+
+def usage():
+    print "\n-------------------------------------------------------------------------------------------"
+    print "sample_json_assemble.py writes the sample JSON document of sample JSON files created by pipelines"
+    print "run with --json, such as the copies of sample JSON files read by the monitoring interface."
+    print "Sample JSON files stored as step stores (json_step_store=True) are assembled into a single document."
+    print "-------------------------------------------------------------------------------------------\n"
+    print "USAGE : sample_json_assemble.py [option]"
+    print "       -j    --json_files   : comma-separated list of sample JSON files (json/<sample>.json in the pipeline output directory)"
+    print "       -o    --output_files : comma-separated list of output files, one per sample JSON file - Default : standard output, for a single sample JSON file"
+    print "       -h    --help         : this help \n"
+
+def main():
+    json_files, output_files = getarg(sys.argv)
+
+    for i, json_file in enumerate(json_files):
+        # Jobs may be updating the sample JSON file
+        with FileLock(json_file):
+            json_hash = assemble(json_file)
+        if output_files:
+            with open(output_files[i], 'w') as output_file:
+                json.dump(json_hash, output_file, indent=4)
+        else:
+            json.dump(json_hash, sys.stdout, indent=4)
+            sys.stdout.write("\n")
+
+if __name__ == '__main__':
+    main()
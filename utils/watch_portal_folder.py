@@ -6,8 +6,14 @@ import sys
 import json
 import time
 import getopt
+import select
 import shutil
+import struct
+import ctypes
+import ctypes.util
 import requests
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from multiprocessing.pool import ThreadPool
 from deepdiff import DeepDiff
 
 
@@ -25,12 +31,35 @@ def main():
 
     print('Checking for JSON files in %s' % options.watch_folder)
 
+    # Samples are sent by a bounded pool of threads sharing the connections of a single session
+    options.session = create_session(options.threads)
+    options.pool = ThreadPool(options.threads)
+
     if options.update_interval is None:
         run(options)
         sys.exit()
 
+    watcher = None
+    if not options.poll:
+        try:
+            watcher = InotifyWatcher(options.watch_folder)
+        except (OSError, AttributeError) as e:
+            print(e)
+            print(yellow('inotify is not available, checking folder every %i seconds' % options.update_interval))
+
+    if watcher is None:
+        while True:
+            time.sleep(options.update_interval)
+            run(options)
+
+    # Files written before the watch started
+    run(options)
     while True:
-        time.sleep(options.update_interval)
+        # Folder is also checked every update_interval seconds in case of missed events
+        if watcher.wait(options.update_interval):
+            # Let files written meanwhile be sent along, since only the newest file of each sample is sent
+            time.sleep(options.delay)
+            watcher.wait(0)
         run(options)
 
 
@@ -45,6 +74,12 @@ def run(options):
         sample_name = None
         filename_parts = filename.split('.')
 
+        try:
+            mtime = os.path.getmtime(filepath)
+        except OSError:
+            print(red('  File %s does not exist anymore. Skipping' % filename))
+            continue
+
         if len(filename_parts) < 4:
             # Old filename format: $USER.[UUID].json: we need to read the content to know the sample_name
             if not os.path.isfile(filepath):
@@ -73,7 +108,8 @@ def run(options):
         print('  Read %s (%i/%i)' % (filename, i + 1, len(files)))
         details.append({
             "filepath": filepath,
-            "sample_name": sample_name
+            "sample_name": sample_name,
+            "mtime": mtime
         })
 
     print('Read %i files' % len(details))
@@ -81,13 +117,21 @@ def run(options):
     details_by_sample = group_by(details, lambda detail: detail['sample_name'])
     for sample_name in details_by_sample:
         details = details_by_sample[sample_name]
-        details.sort(key=lambda detail: os.path.getmtime(detail['filepath']))
+        details.sort(key=lambda detail: detail['mtime'])
         details.reverse()
 
     print('Found %i samples' % len(details_by_sample.keys()))
 
-    for sample_name in details_by_sample:
-        send_files(options, sample_name, details_by_sample[sample_name])
+    options.pool.map(send_sample_files, [(options, sample_name, details_by_sample[sample_name]) for sample_name in details_by_sample], 1)
+
+# Send the files of a sample from a pool thread, where an exception would abort the sending of all samples
+def send_sample_files(args):
+    options, sample_name, details = args
+    try:
+        send_files(options, sample_name, details)
+    except Exception as e:
+        print(red('Got error while sending sample %s. Skipping.' % sample_name))
+        print(e)
 
 def send_files(options, sample_name, details):
 
@@ -101,7 +145,7 @@ def send_files(options, sample_name, details):
         data = read_json(filepath)
     except Exception as e:
         print(e)
-        print(red('Failed to read file "%s": ' % filename))
+        print(red('Failed to read file "%s": ' % filepath))
         return
 
     previous_data = None
@@ -115,9 +159,10 @@ def send_files(options, sample_name, details):
     url = None
     username = filepath.split('/')[-1].split('.')[0]
     should_send = True
+    full_url = options.url + '/api/samples/external-update/' + username
 
     if not previous_data:
-        url = options.url + '/api/samples/external-update/' + username
+        url = full_url
     else:
         url = options.url + '/api/samples/external-update-diff/' + username
         operations = get_diff(previous_data, data)
@@ -125,15 +170,24 @@ def send_files(options, sample_name, details):
         if len(operations) == 0:
             print(yellow('No difference for file %s. No request made.' % filepath))
             should_send = False
-        else:
-            data = {
-                'sample_name': data['sample_name'],
-                'operations': operations,
-            }
 
     if should_send:
         try:
-            response = requests.post(url, json=data)
+            if not previous_data:
+                response = post(options, url, data)
+            else:
+                # Diff operations are index based: a diff which may have been applied is not sent again
+                try:
+                    response = post(options, url, {'sample_name': data['sample_name'], 'operations': operations}, idempotent=False)
+                    error = 'status %d' % response.status_code if response.status_code >= 500 else None
+                except requests.exceptions.RequestException as e:
+                    error = e
+                if error:
+                    # The full document is sent instead, and is sent again next time if this fails, without the cache entry
+                    print(yellow('Request to %s failed (%s), sending the full document' % (url, error)))
+                    os.remove(cache_filepath)
+                    url = full_url
+                    response = post(options, url, data)
             result   = response.json()
         except Exception as e:
             print(red('Got error while sending file. Skipping.'))
@@ -148,13 +202,48 @@ def send_files(options, sample_name, details):
         if response.status_code == 200 and result.get('ok') is True:
             print('Sent %s (deleting %i files)' % (filepath, len(details)))
         else:
-            print(red('Request failed %d ' % response.status_code) + ('[%s] %s: %s : %s' % (bold(url), file, response.reason, response.text)))
+            print(red('Request failed %d ' % response.status_code) + ('[%s] %s: %s : %s' % (bold(url), filepath, response.reason, response.text)))
             return
 
     shutil.copy(filepath, cache_filepath)
     for detail in details:
         os.remove(detail['filepath'])
 
+def create_session(threads):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Post data, retrying with exponential backoff on connection errors, server errors and 429 responses.
+# Requests which are not idempotent are only retried if they were not sent, or were rejected with a 429 response.
+def post(options, url, data, idempotent=True):
+    delay = options.retry_delay
+    for attempt in range(options.retries + 1):
+        if attempt > 0:
+            print(yellow('Request to %s failed (%s), retrying in %g seconds' % (url, error, delay)))
+            time.sleep(delay)
+            delay *= 2
+        try:
+            response = options.session.post(url, json=data, timeout=options.timeout)
+        except requests.exceptions.RequestException as e:
+            if attempt == options.retries or not (idempotent or failed_before_sending(e)):
+                raise
+            error = e
+            continue
+        if response.status_code != 429 and (response.status_code < 500 or not idempotent):
+            break
+        error = 'status %d' % response.status_code
+    return response
+
+# Whether a request failed while connecting, e.g. connection refused or connect timeout, so that the server did not receive it
+def failed_before_sending(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
 def read_json(filepath):
     return json.loads(read_file(filepath))
 
@@ -177,6 +266,13 @@ def usage():
     print("    -c, --cache     - folder for caching JSONs")
     print("    -u, --url       - URL to send the JSON files to")
     print("    -i, --interval  - folder check interval (in seconds) (default: None - doesnt watch)")
+    print("                      with inotify, files are sent as soon as written and the folder is checked at this interval")
+    print("    -p, --poll      - check folder at interval only, without inotify (default with inotify unavailable)")
+    print("    -d, --delay     - delay (in seconds) before sending written files, to coalesce further writes (default: 2)")
+    print("    -t, --threads   - number of samples sent concurrently (default: 4)")
+    print("    -r, --retries   - number of retries of failed requests, with exponential backoff (default: 3), diff requests only if they were not sent")
+    print("    -b, --backoff   - delay (in seconds) before the first retry of a failed request, doubled for each next retry (default: 1)")
+    print("    -T, --timeout   - request timeout (in seconds) (default: 60)")
     print("    -h, --help      - display this message")
 
 def get_arguments():
@@ -185,8 +281,14 @@ def get_arguments():
     options.cache_folder    = '/tmp/watch_portal_folder'
     options.url             = 'http://localhost:3000'
     options.update_interval = None
+    options.poll            = False
+    options.delay           = 2
+    options.threads         = 4
+    options.retries         = 3
+    options.retry_delay     = 1
+    options.timeout         = 60
 
-    optli, arg = getopt.getopt(sys.argv[1:], 'w:c:u:i:h', ['watch=', 'cache=', 'url=', 'interval=', 'help'])
+    optli, arg = getopt.getopt(sys.argv[1:], 'w:c:u:i:pd:t:r:b:T:h', ['watch=', 'cache=', 'url=', 'interval=', 'poll', 'delay=', 'threads=', 'retries=', 'backoff=', 'timeout=', 'help'])
 
     if len(optli) == 0:
         usage()
@@ -213,6 +315,30 @@ def get_arguments():
                 exit('Error: --interval not provided\n')
             else:
                 options.update_interval = int(value)
+        if option in ('-p', '--poll'):
+            options.poll = True
+        if option in ('-d', '--delay'):
+            options.delay = float(value)
+        if option in ('-t', '--threads'):
+            if int(value) < 1:
+                exit('Error: --threads must be at least 1\n')
+            else:
+                options.threads = int(value)
+        if option in ('-r', '--retries'):
+            if int(value) < 0:
+                exit('Error: --retries must not be negative\n')
+            else:
+                options.retries = int(value)
+        if option in ('-b', '--backoff'):
+            if float(value) < 0:
+                exit('Error: --backoff must not be negative\n')
+            else:
+                options.retry_delay = float(value)
+        if option in ('-T', '--timeout'):
+            if float(value) <= 0:
+                exit('Error: --timeout must be positive\n')
+            else:
+                options.timeout = float(value)
         if option in ('-h', '--help'):
             usage()
             exit()
@@ -236,6 +362,39 @@ class dotdict(dict):
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+# Watches a folder for files written or moved into it with Linux inotify, through the C library
+class InotifyWatcher(object):
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_Q_OVERFLOW  = 0x00004000
+    event_header   = struct.Struct('iIII')
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        if libc.inotify_add_watch(self.fd, folder.encode() if not isinstance(folder, bytes) else folder, self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on %s' % folder)
+
+    # Wait up to timeout seconds for events and read all of them
+    # Return True if JSON files were written, or if events were lost
+    def wait(self, timeout):
+        written = False
+        while select.select([self.fd], [], [], timeout)[0]:
+            buffer = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = self.event_header.unpack_from(buffer, offset)
+                offset += self.event_header.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW or name.endswith(b'.json'):
+                    written = True
+            timeout = 0
+        return written
+
 def group_by(seq, key=lambda x: x):
     result = {}
     for value in seq: